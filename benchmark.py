@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import datetime
+import subprocess
+import contextlib
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+
+from global_variables import app_tags
+from data_snapshot import DataSnapshot
+
+def generate_app_data(n_users=1000, n_events=100, n_tags=len(app_tags), n_skills=20, n_hobbies=20, n_degrees=10,
+                      seed=42):
+    '''
+    Generate random documents with the same shape of the collections of the app database (users, events, tags,
+    degrees, skills, hobbies, usertypes), to measure the performance of the models at any scale. The ids are
+    deterministic, so the same parameters always give the same data.
+
+    Input:
+    - n_users, n_events : int
+        Number of users and events.
+    - n_tags : int
+        Number of tags, at most the number of tags of the app (app_tags), which are mapped to the cluster tags.
+    - n_skills, n_hobbies, n_degrees : int
+        Size of the catalogs.
+    - seed : int
+        Seed of the random generator.
+
+    Output:
+    - collections : dict
+        Dictionary with the name of each collection as key and the list of its documents as value.
+    '''
+    rng = np.random.RandomState(seed)
+    counter = iter(range(1, 10**12))
+    new_ids = lambda n: [ObjectId(f"{next(counter):024x}") for _ in range(n)]
+    now = datetime.datetime.now()
+
+    catalog = lambda ids, names: [{"_id" : id_, "name" : name} for id_, name in zip(ids, names)]
+    tags = catalog(new_ids(min(n_tags, len(app_tags))), app_tags)
+    degrees = catalog(new_ids(n_degrees), [f"Grado {i}" for i in range(n_degrees)])
+    skills = catalog(new_ids(n_skills), [f"Skill {i}" for i in range(n_skills)])
+    hobbies = catalog(new_ids(n_hobbies), [f"Hobby {i}" for i in range(n_hobbies)])
+    usertypes = catalog(new_ids(2), ["Usuario EDEM", "Empresa"])
+    sample = lambda items, low, high: [items[j] for j in rng.choice(len(items), rng.randint(low, high + 1), replace=False)]
+
+    events = []
+    for i, event_id in enumerate(new_ids(n_events)):
+        events.append({"_id" : event_id, "event_name" : f"Evento {i}", "description" : f"Descripción del evento {i}",
+                       "place" : "Valencia",
+                       "time" : (now + datetime.timedelta(days=int(rng.randint(-100, 300)))).strftime("%m-%d-%Y"),
+                       "eventTags" : [tag["_id"] for tag in sample(tags, 1, min(5, len(tags)))],
+                       "attendees" : [], "updatedAt" : now})
+    users_ids = new_ids(n_users)
+    events_ids = [event["_id"] for event in events]
+    users = []
+    for i, user_id in enumerate(users_ids):
+        users.append({"_id" : user_id, "username" : f"user{i}",
+                      "suscriptions" : sample(events_ids, 1, max(1, min(10, n_events//2))),
+                      "gender" : ["Hombre", "Mujer", "No especifica"][rng.randint(3)],
+                      "degree" : degrees[rng.randint(len(degrees))]["_id"], "age" : int(rng.randint(18, 46)),
+                      "following" : sample(users_ids, 0, min(5, n_users - 1)),
+                      "skills" : [x["_id"] for x in sample(skills, 0, min(4, len(skills)))],
+                      "hobbies" : [x["_id"] for x in sample(hobbies, 0, min(4, len(hobbies)))],
+                      "userType" : usertypes[rng.randint(2)]["_id"], "updatedAt" : now})
+    return {"users" : users, "events" : events, "tags" : tags, "degrees" : degrees, "skills" : skills,
+            "hobbies" : hobbies, "usertypes" : usertypes}
+
+def snapshot_from_collections(collections):
+    '''
+    Build the DataSnapshot of the generated collections, as connection_db_mongodb does.
+    '''
+    tables = {name : pd.DataFrame(documents) for name, documents in collections.items()}
+    tables["users"] = tables["users"].drop(["updatedAt"], axis=1)
+    tables["users"] = tables["users"].dropna().reset_index(drop=True)
+    tables["events"] = tables["events"].dropna().reset_index(drop=True)
+    return DataSnapshot.from_dataframes(tables)
+
+def _measure(results, name, function, repeat, rows=None, rows_name="rows", **info):
+    times, output = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start)
+    results[name] = dict({"seconds" : times, "min" : min(times), "median" : float(np.median(times))}, **info)
+    if rows is not None:
+        results[name][rows_name] = int(rows(output))
+    return output
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmarks(n_users=1000, n_events=100, n_skills=20, n_hobbies=20, n_degrees=10, repeat=3,
+                   reference_users=200, search_params=None, endpoints=True, seed=42):
+    '''
+    Time the hot paths of the API on generated data: building the training dataframes (the original loops on
+    reference_users users, and the current versions on all the users), the users matching, the training of the
+    SVD model, the scoring of the events and both bulk endpoints through the Flask test client (with an in
+    memory mongoDB, mongomock). Everything runs in a temporary directory, so the models, snapshots and results
+    of the API are not touched.
+
+    Input:
+    - n_users, n_events, n_skills, n_hobbies, n_degrees : int
+        Scale of the generated data (see generate_app_data).
+    - repeat : int
+        Number of times each stage is timed.
+    - reference_users : int
+        Number of users for the original loop versions, which are much slower. 0 to skip them.
+    - search_params : dict
+        Parameters of the search of train_SVD_model (for instance budget_seconds, n_jobs).
+    - endpoints : bool
+        If True, also time the endpoints (requires mongomock).
+    - seed : int
+        Seed of the generated data.
+
+    Output:
+    - report : dict
+        Parameters, environment (commit, versions of python and the libraries) and, for each stage, the times of
+        each repetition with their min and median in seconds.
+    '''
+    import recommending_events_model as events_model
+    from data_preprocessing_utilities import (create_training_df_recommendation, create_training_df_recommendation_vectorized,
+                                              create_training_df_userMatching)
+    from users_features import UsersFeatureEncoder
+    from matching_users_model import match_users
+
+    collections = generate_app_data(n_users, n_events, n_skills=n_skills, n_hobbies=n_hobbies, n_degrees=n_degrees,
+                                    seed=seed)
+    snapshot = snapshot_from_collections(collections)
+    users, events, tags = snapshot.users, snapshot.events, snapshot.tags
+    search_params = search_params or {}
+    results = {}
+    previous_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        os.chdir(work_dir)
+        if reference_users:
+            reference = users.iloc[:reference_users].reset_index(drop=True)
+            _measure(results, "create_training_df_recommendation", lambda: create_training_df_recommendation(reference, events, tags),
+                     repeat, rows=lambda out: len(out[0]), users=len(reference))
+            _measure(results, "create_training_df_userMatching",
+                     lambda: create_training_df_userMatching(reference, snapshot.hobbies, snapshot.skills, snapshot.degrees),
+                     repeat, rows=len, users=len(reference))
+        df_real_users, df_real_events = _measure(results, "create_training_df_recommendation_vectorized",
+                                                 lambda: create_training_df_recommendation_vectorized(users, events, tags),
+                                                 repeat, rows=lambda out: len(out[0]), users=len(users))
+        features = _measure(results, "UsersFeatureEncoder",
+                            lambda: UsersFeatureEncoder.from_catalogs(snapshot.degrees, snapshot.hobbies, snapshot.skills).transform(users),
+                            repeat, rows=len, users=len(users))
+        _measure(results, "match_users", lambda: match_users(features, n_matches=4), repeat, rows=len)
+
+        def train():
+            # Without the registry and the tuning cache of the previous repetition, so the model is trained again
+            shutil.rmtree("models", ignore_errors=True)
+            os.makedirs("models")
+            events_model._svd_model = None
+            return events_model.train_SVD_model(df_real_users, df_real_events, **search_params)
+        _measure(results, "train_SVD_model", train, repeat, rows=len)
+        model = events_model.get_SVD_model()
+        _measure(results, "make_predictions", lambda: events_model.make_predictions(df_real_users, df_real_events, model),
+                 repeat, rows=len)
+
+        if endpoints:
+            results.update(_benchmark_endpoints(collections, repeat))
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "commit" : _git_commit(),
+        "date" : str(datetime.datetime.now()),
+        "environment" : {"python" : platform.python_version(), "numpy" : np.__version__, "pandas" : pd.__version__,
+                         "cpu_count" : os.cpu_count()},
+        "parameters" : {"n_users" : n_users, "n_events" : n_events, "n_skills" : n_skills, "n_hobbies" : n_hobbies,
+                        "n_degrees" : n_degrees, "repeat" : repeat, "reference_users" : reference_users,
+                        "search_params" : search_params, "seed" : seed},
+        "results" : results
+    }
+
+def _benchmark_endpoints(collections, repeat):
+    '''
+    Time /events_recommendations and /match_all_users through the Flask test client, with the generated
+    collections in mongomock instead of the real database. The first call of each endpoint also syncs the
+    snapshot of the database, so it is recorded apart as "cold". The "computed" calls empty the response cache
+    before each repetition and wait for the background job which computes the results (see _get_computed), with
+    the hyperparameters of the SVD model taken from the tuning cache of train_SVD_model; the "cached" calls are
+    served from the response cache.
+    '''
+    import mongomock
+    import pymongo
+
+    client = mongomock.MongoClient()
+    for name, documents in collections.items():
+        client.app_dt[name].insert_many([dict(document) for document in documents])
+    mongo_client = pymongo.MongoClient
+    # The snapshot in the temporary directory, and no scheduler retraining during the measures
+    environment = {"MONGO_SNAPSHOT_PATH" : os.path.join(os.getcwd(), "data", "mongo_snapshot.pkl"),
+                   "RETRAIN_INTERVAL_SECONDS" : "0"}
+    previous_environment = {name : os.environ.get(name) for name in environment}
+    pymongo.MongoClient = lambda *args, **kwargs: client
+    os.environ.update(environment)
+    try:
+        import main
+        test_client = main.app.test_client()
+        results = {}
+        for path in ["/events_recommendations", "/match_all_users"]:
+            computed = lambda: _get_computed(test_client, main.response_cache, path)
+            _measure(results, f"GET {path} (cold)", computed, 1, rows=len, rows_name="bytes")
+            _measure(results, f"GET {path} (computed)", computed, repeat, rows=len, rows_name="bytes")
+            _measure(results, f"GET {path} (cached)", lambda: test_client.get(path).get_data(), repeat, rows=len,
+                     rows_name="bytes")
+        return results
+    finally:
+        pymongo.MongoClient = mongo_client
+        for name, value in previous_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        # The pooled client of the process is the one of mongomock, it is created again with the real one
+        import data_preprocessing_utilities
+        data_preprocessing_utilities._mongo_clients.clear()
+
+def _get_computed(test_client, response_cache, path):
+    '''
+    GET path with the response cache empty: the endpoint submits a background job which computes the results
+    (see main.cached_bulk_results), so the job is polled until it finishes and the fresh results are asked again.
+    Returns the body of the response with the fresh results.
+    '''
+    response_cache.clear()
+    response = test_client.get(path)
+    if response.status_code == 202:
+        status_url = response.get_json()["status_url"]
+    else:
+        status_url = response.headers.get("X-Job-Status-URL")
+    if status_url is not None:
+        job = test_client.get(status_url).get_json()
+        while job["status"] in ("queued", "running"):
+            time.sleep(0.01)
+            job = test_client.get(status_url).get_json()
+        if job["status"] == "failed":
+            raise RuntimeError(f"The job of {path} failed:\n{job['error']}")
+        response = test_client.get(path)
+    return response.get_data()
+
+def compare(old_path, new_path):
+    '''
+    Print the median time of each stage in two reports of run_benchmarks, and the ratio new/old.
+    '''
+    with open(old_path, encoding="utf-8") as file:
+        old = json.load(file)
+    with open(new_path, encoding="utf-8") as file:
+        new = json.load(file)
+    print(f"{'stage':50} {old['commit'] or 'old':>12} {new['commit'] or 'new':>12} {'ratio':>8}")
+    for name in dict(old["results"], **new["results"]):
+        old_time = old["results"].get(name, {}).get("median")
+        new_time = new["results"].get(name, {}).get("median")
+        ratio = f"{new_time/old_time:8.2f}" if old_time and new_time else f"{'-':>8}"
+        print(f"{name:50} {old_time if old_time is not None else float('nan'):12.4f} "
+              f"{new_time if new_time is not None else float('nan'):12.4f} {ratio}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark of the recommendation models on generated data")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--skills", type=int, default=20)
+    parser.add_argument("--hobbies", type=int, default=20)
+    parser.add_argument("--degrees", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reference-users", type=int, default=200)
+    parser.add_argument("--budget-seconds", type=float, default=None)
+    parser.add_argument("--no-endpoints", action="store_true")
+    parser.add_argument("--output", default=None, help="json file of the report (default benchmarks/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two reports and exit")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    search_params = {} if args.budget_seconds is None else {"budget_seconds" : args.budget_seconds}
+    # The models are quiet, but the libraries may print (surprise, joblib)
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_benchmarks(args.users, args.events, args.skills, args.hobbies, args.degrees, args.repeat,
+                                args.reference_users, search_params, not args.no_endpoints)
+    output = args.output or os.path.join("benchmarks", f"{report['commit'] or 'benchmark'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=4)
+    for name, result in report["results"].items():
+        print(f"{name:50} median {result['median']:.4f} s")
+    print(f"Report saved in {output}")
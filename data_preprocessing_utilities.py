@@ -1,10 +1,17 @@
+import hashlib
 import numpy as np
 import random
 import pymongo
 import pandas as pd
+from scipy import sparse
 from dotenv import load_dotenv
 import os
+import shutil
+import threading
 from global_variables import * 
+from mongo_sync import MongoSync
+from data_snapshot import DataSnapshot
+import parallel_frames
 
 def configure():
   '''
@@ -21,91 +28,121 @@ def gr(result):
     '''
     return [x for x in result]
 
-def connection_db_mongodb():
+_mongo_sync = None
+
+def get_mongo_sync():
+    '''
+    Return the MongoSync of the process (see mongo_sync.py), creating it the first time. Its snapshot is saved in
+    MONGO_SNAPSHOT_PATH (data/mongo_snapshot.pkl by default).
+    '''
+    global _mongo_sync
+    if _mongo_sync is None:
+        _mongo_sync = MongoSync(os.getenv("MONGO_SNAPSHOT_PATH", default="data/mongo_snapshot.pkl"))
+    return _mongo_sync
+
+_mongo_clients = {}
+_mongo_clients_lock = threading.Lock()
+
+def get_mongo_client(url=None):
+    '''
+    Return the pymongo.MongoClient of url (by default URL_MONGODB), created only once per process. The client
+    keeps a pool of connections which is shared by all the requests and threads, instead of connecting to the
+    database in every call.
+    '''
+    configure()
+    url = url or os.getenv('URL_MONGODB')
+    with _mongo_clients_lock:
+        if url not in _mongo_clients:
+            _mongo_clients[url] = pymongo.MongoClient(url, maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", default=20)))
+        return _mongo_clients[url]
+
+_data_snapshot = None
+
+def connection_db_mongodb(check_deletions=False):
     '''
     Connect to the mongodb database at URL_MONGODB and extract the relevant information from the collections
-    users, events, tags, degrees, skills, hobbies. It returns the collections and the column names as tuples.
+    users, events, tags, degrees, skills, hobbies, usertypes. The collections are read from a local snapshot which
+    is updated only with the documents changed since the previous call (see get_mongo_sync), all the collections
+    at the same time with the pooled client of get_mongo_client. Only the fields used by the models are read,
+    and only the users and events which have all of them (see mongo_sync.mongo_collections).
+
+    The collections are returned in a DataSnapshot (see data_snapshot.py) with one DataFrame per collection, with
+    the ObjectIds encoded as str, which the endpoints use directly. If nothing changed in the database since the
+    previous call, the same DataSnapshot is returned without building the DataFrames again.
+
+    Input:
+    check_deletions: bool
+      If True, the documents deleted in the database are also removed from the snapshot, which reads the _id of
+      all the users and events (see MongoSync.refresh): only the background jobs do it.
 
-    OSS: An error occurs only when this function is called on the Railway and AWS Server at the moment of returning
-    pandas dataframe as outputs. We do not understand why this happens, it must be some encoding problem. To
-    solve this problem we return the dataframe in the format of a list, and then we transform it back to DataFrame
-    outside of the function. (Yes, it seems crazy we are also confused!)
+    OSS: Before, the collections were returned as tuples of columns and values because of an encoding problem
+    on the Railway and AWS servers when returning DataFrames with ObjectIds. The DataSnapshot has no ObjectIds.
 
     Output:
-    df_users.columns: tuple
-      list of the columns of the collection df_users
-    df_users.values: tuple
-      list of the values of the collection df_users
-    df_events.columns: tuple
-      list of the columns of the collection df_events
-    df_events.values: tuple
-      list of the values of the collection df_events
-    df_tags.columns: tuple
-      list of the columns of the collection df_tags
-    df_tags.values: tuple
-      list of the values of the collection df_tags
-    df_degrees.columns: tuple
-      list of the columns of the collection df_degrees
-    df_degrees.values: tuple
-      list of the values of the collection df_degrees
-    df_skills.columns: tuple
-      list of the columns of the collection df_skills
-    df_skills.values: tuple
-      list of the values of the collection df_skills
-    df_hobbies.columns: tuple
-      list of the columns of the collection df_hobbies
-    df_hobbies.values: tuple
-      list of the values of the collection df_hobbies
-    df_usertypes.columns: tuple
-      list of the columns of the collection df_usertypes
-    df_usertypes.values: tuple
-      list of the values of the collection df_usertypes
+    snapshot: DataSnapshot
+      The tables users, events, tags, degrees, skills, hobbies, usertypes, accessible as snapshot.users, etc.
     '''
-    #Connection to mongoDB Database
-    configure()
-    client = pymongo.MongoClient(os.getenv('URL_MONGODB'))
-    db = client.app_dt
-
-    collection = db.users
-    projection = {'_id': 1, 'suscriptions': 1, 'gender' : 1, 'degree' : 1, 'age' : 1, 'following' : 1,
-                   'skills' : 1, 'hobbies' : 1, "userType" : 1, "username" : 1}
-    df_users = pd.DataFrame(gr(collection.find({}, projection)))
-
-    collection = db.usertypes
-    projection = {'_id': 1, 'name' : 1}
-    df_usertypes = pd.DataFrame(gr(collection.find()))
-
-    collection = db.events
-    df_events = pd.DataFrame(gr(collection.find()))
-
-    collection = db.tags
-    projection = {'_id': 1, 'name': 1}
-    df_tags = pd.DataFrame(gr(collection.find({}, projection)))
-
-    collection = db.degrees
-    projection = {'_id': 1, 'name': 1}
-    df_degrees = pd.DataFrame(gr(collection.find({}, projection)))
-
-    collection = db.skills
-    projection = {'_id': 1, 'name': 1}
-    df_skills = pd.DataFrame(gr(collection.find({}, projection)))
-
-    collection = db.hobbies
-    projection = {'_id': 1, 'name': 1}
-    df_hobbies = pd.DataFrame(gr(collection.find({}, projection)))
-
-    # I drop nans, because some users,events might not have all the information I need
-    # For instance some of the users created by FS developers for testing
-    df_users = df_users.dropna().reset_index(drop=True)
-    df_events = df_events.dropna().reset_index(drop=True)
-    return (tuple(df_users.columns), tuple(df_users.values),
-           tuple(df_events.columns), tuple(df_events.values),
-           tuple(df_tags.columns), tuple(df_tags.values),
-           tuple(df_degrees.columns), tuple(df_degrees.values),
-           tuple(df_skills.columns), tuple(df_skills.values),
-           tuple(df_hobbies.columns), tuple(df_hobbies.values),
-           tuple(df_usertypes.columns), tuple(df_usertypes.values)
-    )
+    global _data_snapshot
+    #Connection to mongoDB Database, with the client (and its pool of connections) of the process
+    db = get_mongo_client().app_dt
+
+    #Only the documents changed since the last call are pulled, and applied to the local snapshot
+    sync = get_mongo_sync()
+    sync.refresh(db, check_deletions=check_deletions)
+    return _snapshot_from_sync(sync)
+
+def _snapshot_from_sync(sync):
+    global _data_snapshot
+    # Read before the tables: if a reload changes them meanwhile, the next call builds them again
+    version = sync.version
+    if _data_snapshot is not None and _data_snapshot.version == version:
+        return _data_snapshot
+
+    tables = {name : sync.dataframe(name) for name in ["users", "events", "tags", "degrees", "skills", "hobbies",
+                                                       "usertypes"]}
+    # The users and events without all the information I need (for instance some of the users created by FS
+    # developers for testing) are not read, the filters of mongo_collections exclude them in the database
+    _data_snapshot = DataSnapshot.from_dataframes(tables, version)
+    return _data_snapshot
+
+def local_snapshot(reload=False):
+    '''
+    Return the DataSnapshot of the local snapshot of the collections (the last one saved by MongoSync), without
+    connecting to mongoDB: the requests use it, and the preload before the first request (see
+    main.preload_artifacts). The changes saved by the refreshes of other processes (the background jobs of the
+    other gunicorn workers) are applied first (see MongoSync.reload_if_changed).
+
+    Input:
+    reload: bool
+      If True, the snapshot saved in MONGO_SNAPSHOT_PATH is read again from scratch.
+    '''
+    global _mongo_sync
+    if reload and _mongo_sync is not None:
+        # The version goes on from the previous one, the caches by version (profiles, encoder) must not be reused
+        version = _mongo_sync.version + 1
+        _mongo_sync = None
+        get_mongo_sync().version = version
+    sync = get_mongo_sync()
+    sync.reload_if_changed()
+    return _snapshot_from_sync(sync)
+
+
+def dataframe_fingerprint(df):
+  '''
+  Content fingerprint of a dataframe: two dataframes with the same columns and values (in the same order)
+  have the same fingerprint. It is used to know when the data changed, and reuse results computed on the same data.
+
+  Input:
+  df: pandas.DataFrame
+    The dataframe to fingerprint
+
+  Output:
+  fingerprint: str
+    Hexadecimal sha1 of the columns and the values of the dataframe
+  '''
+  sha = hashlib.sha1(str(list(df.columns)).encode("utf-8"))
+  sha.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+  return sha.hexdigest()
 
 
 def create_training_df_recommendation(df_users, df_events, df_tags):
@@ -188,6 +225,152 @@ def create_training_df_recommendation(df_users, df_events, df_tags):
   return df_users_new, df_events_new
 
 
+def build_recommendation_matrices(df_users, df_events, df_tags):
+  '''
+  Build the sparse matrices needed to create the training dataframes for the events recommendation model.
+  The ids of users, events and tags are mapped once into row/column indices, so that all the counting of
+  cluster tags can be done with matrix products instead of looping over every user-event pair.
+
+  Inputs:
+  df_users: pandas.Dataframe
+     The pandas dataframe from the collection users
+  df_events: pandas.Dataframe
+     The pandas dataframe from the collection events
+  df_tags: pandas.Dataframe
+     The pandas dataframe from the collection tags
+
+  Output:
+  participation: scipy.sparse.csr_matrix
+    Binary users x events matrix, 1 if the event is in the suscriptions of the user
+  events_clusters: numpy.ndarray
+    Events x cluster_tags matrix with the number of tags of each event belonging to each cluster tag
+  '''
+  event_index = {id_event : i for i, id_event in enumerate(df_events["_id"])}
+  participation = build_participation(df_users["suscriptions"], event_index, len(df_events))
+  return participation, build_events_clusters(df_events, df_tags)
+
+
+def build_participation(suscriptions, event_index, n_events):
+  '''
+  Build the binary users x events participation matrix from the suscriptions lists of the users.
+
+  Inputs:
+  suscriptions: iterable
+     For each user, the list with the ids of the events he/she is subscribed to
+  event_index: dict
+     Dictionary with the id of each event as key and its column as value (events not in it are ignored)
+  n_events: int
+     Number of events
+
+  Output:
+  participation: scipy.sparse.csr_matrix
+    Binary users x events matrix, 1 if the event is in the suscriptions of the user
+  '''
+  rows, cols = [], []
+  for i, user_suscriptions in enumerate(suscriptions):
+    for id_event in user_suscriptions:
+      if id_event in event_index:
+        rows.append(i)
+        cols.append(event_index[id_event])
+  participation = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                    shape=(len(suscriptions), n_events))
+  #the same event can appear twice in the suscriptions, but participation is binary
+  participation.data[:] = 1
+  return participation
+
+
+def build_events_clusters(df_events, df_tags):
+  '''
+  Build the events x cluster_tags matrix with the number of tags of each event belonging to each cluster tag.
+
+  Inputs:
+  df_events: pandas.Dataframe
+     The pandas dataframe from the collection events
+  df_tags: pandas.Dataframe
+     The pandas dataframe from the collection tags
+
+  Output:
+  events_clusters: numpy.ndarray
+    Events x cluster_tags matrix (int64)
+  '''
+  tag_index = {id_tag : i for i, id_tag in enumerate(df_tags["_id"])}
+  #events x tags incidence matrix (a repeated tag is counted twice, as in the loop version)
+  rows, cols = [], []
+  for i, tags_ids in enumerate(df_events["eventTags"]):
+    for tag_id in tags_ids:
+      if tag_id in tag_index:
+        rows.append(i)
+        cols.append(tag_index[tag_id])
+  events_tags = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                  shape=(len(df_events), len(df_tags)))
+
+  #tags x cluster_tags incidence matrix from mapping_tags
+  tags_clusters = np.zeros((len(df_tags), len(cluster_tags)), dtype=np.int64)
+  for j, cluster in enumerate(cluster_tags):
+    tags_clusters[:, j] = df_tags["name"].isin(mapping_tags[cluster]).values
+
+  return np.asarray(events_tags @ tags_clusters)
+
+
+def events_frame(df_events, events_clusters):
+  '''
+  Dataframe of the events for the training of the recommending system: id_event, time and the cluster tags
+  of events_clusters (see build_events_clusters).
+  '''
+  df_events_new = pd.DataFrame(events_clusters, columns=cluster_tags)
+  df_events_new.insert(0, "id_event", df_events["_id"].values)
+  df_events_new.insert(1, "time", df_events["time"].values)
+  return df_events_new
+
+
+def create_training_df_recommendation_vectorized(df_users, df_events, df_tags, n_jobs=1, chunk_size=None):
+  '''
+  Same as create_training_df_recommendation, but the dataframes are built with a couple of matrix products
+  (see build_recommendation_matrices) instead of looping over every user-event pair. The output has the same
+  rows, columns and values of create_training_df_recommendation, with integer columns for participation and tags.
+
+  Inputs:
+  df_users: pandas.Dataframe
+     The pandas dataframe from the collection users
+  df_events: pandas.Dataframe
+     The pandas dataframe from the collection events
+  df_tags: pandas.Dataframe
+     The pandas dataframe from the collection tags
+  n_jobs: int
+     Number of processes building the rows of chunks of chunk_size users (see
+     parallel_frames.build_users_frame_parallel), -1 for one per CPU. With 1, or less users than
+     parallel_frames.min_parallel_users, the dataframes are built in this process
+  chunk_size: int
+     Number of users of each chunk, by default 4 chunks per process
+
+  Output:
+
+  df_users_new: pandas.DataFrame
+    A pandas dataframe for the users and their participation to events,
+    in the format used for training the recommending system
+  df_events_new: pandas.DataFrame
+    A pandas dataframe for the events and their tags,
+    in the format used for training the recommending system
+  '''
+  n_users, n_events = len(df_users), len(df_events)
+  if n_jobs != 1 and n_users >= parallel_frames.min_parallel_users:
+    events_clusters = build_events_clusters(df_events, df_tags)
+    df_users_new = parallel_frames.build_users_frame_parallel(df_users, df_events, events_clusters, n_jobs, chunk_size)
+    return df_users_new, events_frame(df_events, events_clusters)
+
+  participation, events_clusters = build_recommendation_matrices(df_users, df_events, df_tags)
+  #cluster tags of the events each user participated to
+  users_clusters = np.asarray(participation @ events_clusters)
+
+  df_events_new = events_frame(df_events, events_clusters)
+
+  df_users_new = pd.DataFrame(np.repeat(users_clusters, n_events, axis=0), columns=cluster_tags)
+  df_users_new.insert(0, "id_user", np.repeat(df_users["_id"].values, n_events))
+  df_users_new.insert(1, "id_event", np.tile(df_events["_id"].values, n_users))
+  df_users_new.insert(2, "participation", participation.toarray().ravel())
+  return df_users_new, df_events_new
+
+
 
 def create_training_df_userMatching(df_users, df_hobbies, df_skills, df_degrees):
   '''
@@ -265,92 +448,129 @@ def create_training_df_userMatching(df_users, df_hobbies, df_skills, df_degrees)
   return df_users_matching
 
 
-def create_artificial_users():
+def _generate_artificial_users(n_users, n_events, seed):
   '''
-  This function create artificial users and events to train the recommendation models. We build 50 fake events,
-  and 1000 fake users.
+  Generate the artificial users and events used by create_artificial_users, in the compact form of arrays per
+  user (instead of one row per user and event). The random draws are done in the same order as in the original
+  loop version, with their own random generators, so the corpus is the same for the same seed and it does not
+  change the global random state.
 
   Output:
-   A dataframe in the form of user-item matrix, as needed by the SVD matrix factorization model.
-  
+  corpus: dict
+    Dictionary of numpy arrays: num_eventos, estudio, edad, sexo, emprende (one value per user),
+    categorias (users x cluster_tags) and participacion (users x events)
   '''
-  random.seed(42)
-
-  # Generar el DataFrame
-  tabla = []
-
-  np.random.seed(42)
-
-  for i in range(50):
-      #evento = {"Evento": "Evento " + str(i + 1)}
-      evento = {"id_event": i+1}
+  py_random = random.Random(seed)
+  rng = np.random.RandomState(seed)
+
+  #Cada evento tiene 3 etiquetas aleatorias de cluster_tags
+  eventos_categorias = np.zeros((n_events, len(cluster_tags)), dtype=np.int64)
+  for i in range(n_events):
+      etiquetas_asignadas = py_random.sample(cluster_tags, 3)
+      eventos_categorias[i] = [1 if elemento in etiquetas_asignadas else 0 for elemento in cluster_tags]
+
+  num_eventos = np.zeros(n_users, dtype=np.int64)
+  participacion = np.zeros((n_users, n_events), dtype=np.int8)
+  estudio = np.zeros(n_users, dtype=np.int8)
+  edad = np.zeros(n_users, dtype=np.int64)
+  sexo = np.zeros(n_users, dtype=np.int8)
+  emprende = np.zeros(n_users, dtype=np.int64)
+  for i in range(n_users):
+      #generar el número de eventos al cual el usuario participa, sacados de una distribución normal de media 15 y sigma 5
+      n = int(rng.normal(15, 5))
+      #OSS si el numero de eventos es 0 da problemas, pues pongo que minimo ha asistido a 1
+      if n==0:
+          n=1
+      # Generar a cual eventos aleatorios el usuario ha participado, dependiendo de num_eventos
+      deck = list(range(0,n_events))
+      rng.shuffle(deck)
+      participacion[i, np.array(deck[0:n], dtype=np.int64)] = 1
+      num_eventos[i] = max(n, 0)
+      estudio[i] = rng.choice(len(artificial_estudios), p=[0.73, 0.21, 0.06])
+      if artificial_estudios[estudio[i]] == "Grado":
+          edad[i] = rng.randint(18, 26)
+          sexo[i] = rng.choice(len(artificial_sexos), p=[0.64, 0.36])
+      elif artificial_estudios[estudio[i]] == "Master":
+          edad[i] = rng.randint(24, 31)
+          sexo[i] = rng.choice(len(artificial_sexos), p=[0.66, 0.34])
+      else:  # Bootcamp
+          edad[i] = rng.randint(19, 46)
+          sexo[i] = rng.choice(len(artificial_sexos), p=[0.81, 0.19])
+      emprende[i] = rng.choice([0, 1], p=[0.4, 0.6])
 
-      etiquetas_asignadas = random.sample(cluster_tags, 3)
-      for elemento in cluster_tags:
-          evento[elemento] = 1 if elemento in etiquetas_asignadas else 0
-      tabla.append(evento)
+  #Los tags de los eventos a los cuales cada usuario ha participado
+  categorias = participacion.astype(np.int64) @ eventos_categorias
+  return {"num_eventos" : num_eventos, "estudio" : estudio, "edad" : edad, "sexo" : sexo, "emprende" : emprende,
+          "categorias" : categorias, "participacion" : participacion}
 
-  df_eventos = pd.DataFrame(tabla)
 
-  np.random.seed(42)  # Para reproducibilidad de los datos aleatorios
+def load_artificial_users(n_users=1000, n_events=50, seed=42, cache_dir="data"):
+  '''
+  Load the artificial corpus generated by _generate_artificial_users, generating it only the first time.
+  The corpus is saved in cache_dir, in a directory for each seed and size, with one .npy file per array, and
+  it is loaded with memory-mapping, so after the first time there is no generation cost.
+
+  Input:
+  n_users: int
+    Number of artificial users
+  n_events: int
+    Number of artificial events
+  seed: int
+    Seed of the random generators
+  cache_dir: str
+    Directory where the corpus is saved
 
-  # Crear diccionario de etiquetas para asignar a los eventos
-  diccionario_eventos = {}
-  #Las categorias son las mismas columnas de los tags en el df_eventos
-  categorias = list(df_eventos.columns[1:])
+  Output:
+  corpus: dict
+    Dictionary of read-only numpy arrays, see _generate_artificial_users
+  '''
+  path = os.path.join(cache_dir, f"artificial_users_{n_users}_{n_events}_{seed}")
+  names = ["num_eventos", "estudio", "edad", "sexo", "emprende", "categorias", "participacion"]
+  if not os.path.exists(path):
+    corpus = _generate_artificial_users(n_users, n_events, seed)
+    #Save in a tmp directory and rename it, so another process never loads a half written corpus
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name in names:
+      np.save(os.path.join(tmp_path, f"{name}.npy"), corpus[name])
+    try:
+      os.rename(tmp_path, path)
+    except OSError:
+      #another process saved the same corpus in the meantime
+      shutil.rmtree(tmp_path, ignore_errors=True)
+  return {name : np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in names}
+
+
+def create_artificial_users(n_users=1000, n_events=50, seed=42):
+  '''
+  This function create artificial users and events to train the recommendation models. By default we build
+  50 fake events, and 1000 fake users. The corpus is generated only once for each seed and size, and then loaded
+  from disk (see load_artificial_users).
+
+  Input:
+  n_users: int
+    Number of artificial users
+  n_events: int
+    Number of artificial events
+  seed: int
+    Seed of the random generators
 
-  # Generar datos para el dataframe
-  data = []
-  for i in range(1000):
-      id_usuario = i + 1
-      #generar el número de eventos al cual el usuario participa, sacados de una distribución normal de media 15 y sigma 5
-      num_eventos = int(np.random.normal(15, 5))  
-      #OSS si el numero de eventos es 0 da problemas, pues pongo que minimo ha asistido a 1
-      if num_eventos==0:
-          num_eventos=1
-      # Generar a cual eventos aleatorios el usuario ha participado, dependiendo de num_eventos
-      deck = list(range(0,len(df_eventos)))
-      np.random.shuffle(deck)
-      #index eventos es un array que tendrá los id_events (en realidad id_events-1) a los cuales el usuario ha participado
-      index_eventos =np.array(deck[0:num_eventos])
-      #pongo 1 solo a los eventos al cual el usuario ha participado
-      participacion_eventos = np.zeros(len(df_eventos),dtype=int)
-      participacion_eventos[index_eventos]=1
-      #Ahora quiero obtener los tags de cada evento al cual el usuario ha participado
-      #Antes de todo defino los id de los eventos al cual el usuario ha participado, que serán index_eventos + 1
-      #Eso porque index_eventos son valores entre 0 y 49, y los id_eventos los hemos puestos empezando de 1 y no 0
-      id_eventos = index_eventos + 1
-
-      #Ahora voy al df_eventos y le pongo mascara para selecionar solo los eventos con los id_event a los cuales el usuario
-      # ha participado. Seleciono solo las columnas de los tags (iloc[:,1:]), y sumo todos los valores que hay en cada columna.
-      # Me quedo con un DataSeries con los tags y los valores de las sumas, yo solo quiero los valores y le pongo values.
-      valores_categorias = df_eventos[df_eventos["id_event"].isin(id_eventos)].iloc[:,1:].sum().values
-      eventos_categoria = {categorias[i] : valores_categorias[i] for i in range(len(categorias))}
+  Output:
+   A dataframe in the form of user-item matrix, as needed by the SVD matrix factorization model.
   
-      if num_eventos < 0:
-          num_eventos = 0
-      estudio = np.random.choice(["Grado", "Master", "Bootcamp"], p=[0.73, 0.21, 0.06])
-      if estudio == "Grado":
-          edad = np.random.randint(18, 26)
-          sexo = np.random.choice(["Hombre", "Mujer"], p=[0.64, 0.36])
-      elif estudio == "Master":
-          edad = np.random.randint(24, 31)
-          sexo = np.random.choice(["Hombre", "Mujer"], p=[0.66, 0.34])
-      else:  # Bootcamp
-          edad = np.random.randint(19, 46)
-          sexo = np.random.choice(["Hombre", "Mujer"], p=[0.81, 0.19])
-      emprende = np.random.choice([0, 1], p=[0.4, 0.6])
-
-      for j in range(len(df_eventos)):
-          row = [id_usuario, j+1, num_eventos, estudio, edad, sexo, emprende]
-          for categoria in categorias:
-              row.append(eventos_categoria[categoria])
-          row.append(participacion_eventos[j])
-          data.append(row)
-
-  # Crear dataframe
+  '''
+  corpus = load_artificial_users(n_users, n_events, seed)
   columnas = ["id_user", "id_event", "num_eventos", "estudio", "edad", "sexo", "emprende"]
-  columnas += categorias
-  columnas += ["participation"]
-  df = pd.DataFrame(data, columns=columnas)
+  df = pd.DataFrame({
+    "id_user" : np.repeat(np.arange(1, n_users+1), n_events),
+    "id_event" : np.tile(np.arange(1, n_events+1), n_users),
+    "num_eventos" : np.repeat(corpus["num_eventos"], n_events),
+    "estudio" : np.repeat(np.array(artificial_estudios, dtype=object)[corpus["estudio"]], n_events),
+    "edad" : np.repeat(corpus["edad"], n_events),
+    "sexo" : np.repeat(np.array(artificial_sexos, dtype=object)[corpus["sexo"]], n_events),
+    "emprende" : np.repeat(corpus["emprende"], n_events)
+  })
+  df_categorias = pd.DataFrame(np.repeat(corpus["categorias"], n_events, axis=0), columns=cluster_tags)
+  df = pd.concat((df, df_categorias), axis=1)
+  df["participation"] = np.asarray(corpus["participacion"], dtype=np.int64).ravel()
   return df
@@ -0,0 +1,106 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+
+def _first_value(column):
+    for value in column:
+        if isinstance(value, list):
+            if value:
+                return value
+        elif value is not None and not (isinstance(value, float) and np.isnan(value)):
+            return value
+    return None
+
+def encode_table(df):
+    '''
+    Encode a collection of the app database for the models, without copying the columns that do not change:
+    - columns of ObjectId (like _id, degree, userType) become categorical columns of str,
+    - columns of lists of ObjectId (like suscriptions, eventTags) become lists of str,
+    - the column age becomes numeric and gender becomes categorical.
+    With the ids as str the tables can be compared and converted to json directly.
+
+    Input:
+    - df : pandas.DataFrame
+        Dataframe of a collection, as read from mongoDB.
+
+    Output:
+    - df : pandas.DataFrame
+        The encoded dataframe.
+    '''
+    encoded = {}
+    for column in df.columns:
+        first = _first_value(df[column])
+        if isinstance(first, ObjectId):
+            encoded[column] = pd.Categorical([None if x is None else str(x) for x in df[column]])
+        elif isinstance(first, list) and isinstance(first[0], ObjectId):
+            encoded[column] = [[str(x) for x in value] if isinstance(value, list) else value for value in df[column]]
+        elif column == "age":
+            encoded[column] = pd.to_numeric(df[column], errors="coerce")
+        elif column == "gender":
+            encoded[column] = pd.Categorical(df[column])
+        else:
+            encoded[column] = df[column]
+    return pd.DataFrame(encoded, index=df.index)
+
+class DataSnapshot:
+    '''
+    Snapshot of the collections of the app database, with one encoded pandas DataFrame per collection (see
+    encode_table), which the endpoints use directly. The tables are shared between requests, so the code
+    that uses them must not modify them in place.
+
+    The tables are accessible by name, as snapshot.users or snapshot["users"].
+
+    Parameters:
+    - tables : dict
+        Dictionary with the name of each collection as key and its encoded DataFrame as value.
+    - version : int
+        Number which changes every time the data of the snapshot changes.
+    '''
+
+    def __init__(self, tables, version=0):
+        self.tables = tables
+        self.version = version
+        self._fingerprint = None
+
+    @classmethod
+    def from_dataframes(cls, tables, version=0):
+        '''
+        Build the snapshot from the dataframes of the collections as read from mongoDB, encoding them.
+        '''
+        return cls({name : encode_table(df) for name, df in tables.items()}, version)
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["tables"][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def fingerprint(self):
+        '''
+        Content fingerprint of the snapshot (hexadecimal sha1 of the names, columns and values of the tables, in
+        order): two snapshots with the same data have the same fingerprint, also in different processes, unlike
+        version. It is computed the first time it is asked, the tables of a snapshot do not change.
+        '''
+        if self._fingerprint is None:
+            sha = hashlib.sha1()
+            for name in sorted(self.tables):
+                df = self.tables[name]
+                sha.update(f"{name}:{list(df.columns)}".encode("utf-8"))
+                if not len(df.columns):
+                    continue
+                # The lists (and dicts) of the documents are not hashable by pandas, they are hashed as text
+                hashable = df.apply(lambda column: column.map(lambda x: repr(x) if isinstance(x, (list, dict)) else x)
+                                    if column.dtype == object else column)
+                sha.update(pd.util.hash_pandas_object(hashable, index=False).values.tobytes())
+            self._fingerprint = sha.hexdigest()
+        return self._fingerprint
+
+    def memory_usage(self):
+        '''
+        Memory used by the tables, in bytes.
+        '''
+        return int(sum(df.memory_usage(index=True, deep=True).sum() for df in self.tables.values()))
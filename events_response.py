@@ -0,0 +1,108 @@
+import json
+from collections.abc import Mapping
+
+def index_events(df_events, df_tags, max_tags=4):
+    '''
+    Prepare the information of the events for the response of /events_recommendations, once per run: the
+    events are indexed by id, with the ids as str and the ids of the tags replaced by their names (only the
+    first max_tags). The timestamp updatedAt is dropped.
+
+    Input:
+    - df_events : pandas.DataFrame
+        Dataframe with the events (from the snapshot, it is not modified).
+    - df_tags : pandas.DataFrame
+        Dataframe with the tags, with columns _id and name.
+    - max_tags : int
+        Maximum number of tags names of each event.
+
+    Output:
+    - columns : list
+        Keys of the information of each event, in the order of the response.
+    - events : dict
+        Dictionary with the id of each event as key and its information as a dictionary {column : value}.
+    '''
+    tags_names = dict(zip(df_tags["_id"].astype(str), df_tags["name"]))
+    df_events = df_events.drop(["updatedAt"], axis=1, errors="ignore")
+    columns = list(df_events.columns)
+    events = {}
+    for event in df_events.to_dict("records"):
+        event["_id"] = str(event["_id"])
+        event["attendees"] = [str(x) for x in event["attendees"]]
+        names = [tags_names[str(x)] for x in event["eventTags"] if str(x) in tags_names]
+        event["eventTags"] = names[:max_tags]
+        events[event["_id"]] = event
+    return columns, events
+
+class EventsPredictions(Mapping):
+    '''
+    Response of /events_recommendations (see events_predictions), read only. The information of the events of a
+    user is only built when it is read, so serializing it with stream_json builds one user at a time instead of
+    the whole response before the first byte: only the ids of the recommended events of each user and the
+    information of each event once (index_events) are kept in memory.
+
+    Parameters:
+    - results : dict
+        Output of make_predictions, {user_id : {event_id : score}}.
+    - columns, events : output of index_events.
+    '''
+
+    def __init__(self, results, columns, events):
+        self.results = {str(user_id) : user_events for user_id, user_events in results.items()}
+        self.columns = columns
+        self.events = events
+
+    def __getitem__(self, user_id):
+        rows = [self.events[str(event_id)] for event_id in self.results[user_id]]
+        return {key : [row[key] for row in rows] for key in self.columns}
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+def events_predictions(results, columns, events):
+    '''
+    Build the response of /events_recommendations: for each user, the information of his/her recommended
+    events, as a dictionary with a list per column (the format wanted by FullStack).
+
+    Input:
+    - results : dict
+        Output of make_predictions, {user_id : {event_id : score}}.
+    - columns, events : output of index_events.
+
+    Output:
+    - preds : EventsPredictions
+        Mapping with the id of each user as key, and the information of his/her recommended events as value,
+        built user by user when it is read.
+    '''
+    return EventsPredictions(results, columns, events)
+
+def stream_json(preds, chunk_size=64*1024, ensure_ascii=True):
+    '''
+    Serialize a dictionary {user_id : results of the user} as json piece by piece, one user at a time, to send
+    it with a streamed (chunked) response: the first bytes go out at once and the whole json is never held in
+    memory. The output is the same of json.dumps(preds).
+
+    Input:
+    - preds : dict
+        Dictionary (or Mapping, like EventsPredictions) to serialize.
+    - chunk_size : int
+        The pieces are joined in chunks of about chunk_size characters, to not send one tiny chunk per user.
+    - ensure_ascii : bool
+        As in json.dumps.
+
+    Output:
+    - chunks : generator of str
+    '''
+    buffer, size = ["{"], 1
+    for i, (key, value) in enumerate(preds.items()):
+        key, value = json.dumps(str(key), ensure_ascii=ensure_ascii), json.dumps(value, ensure_ascii=ensure_ascii)
+        piece = f"{', ' if i else ''}{key}: {value}"
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    buffer.append("}")
+    yield "".join(buffer)
@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from data_preprocessing_utilities import build_participation, build_events_clusters, events_frame
+from recommending_events_model import fit_events_model, users_tags_scores, events_candidates, recommend_events
+from instrumentation import span
+from global_variables import cluster_tags
+
+class UsersBatches:
+    '''
+    Results of the first pass over the batches of users (see stream_users_batches), kept for the scoring: the
+    sparse participation matrix (users of the batch x events) of each batch and the cluster tags of all the users.
+    The participation matrices only take the size of the suscriptions, never users x events.
+
+    If spill_dir is given, they are saved in a temporary directory inside it in columnar format, one .npy file per
+    column (the cluster tags of the users, and the indptr and indices of the participation of each batch), which
+    are read back memory-mapped: only the batch being processed is in memory. The directory is deleted by close.
+
+    Parameters:
+    - n_users : int
+        Number of users.
+    - n_events : int
+        Number of events (columns of the participation matrices).
+    - spill_dir : str
+        Directory of the files, None to keep everything in memory.
+    '''
+
+    def __init__(self, n_users, n_events, spill_dir=None):
+        self.n_users = n_users
+        self.n_events = n_events
+        self.bounds = []
+        self._participation = []
+        self.dir = None
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.dir = tempfile.mkdtemp(prefix="events_batches_", dir=spill_dir)
+        # One row per cluster tag: each row is a column of users_tags
+        if self.dir is None:
+            self._tags = np.zeros((len(cluster_tags), n_users), dtype=np.int64)
+        else:
+            self._tags = np.lib.format.open_memmap(os.path.join(self.dir, "users_tags.npy"), mode="w+",
+                                                   dtype=np.int64, shape=(len(cluster_tags), n_users))
+
+    def add(self, start, participation, users_clusters):
+        '''
+        Save the participation (csr_matrix) and the cluster tags of the batch of users starting at start.
+        '''
+        end = start + participation.shape[0]
+        self._tags[:, start:end] = users_clusters.T
+        if self.dir is not None:
+            batch = len(self.bounds)
+            np.save(os.path.join(self.dir, f"participation_{batch}_indptr.npy"), participation.indptr)
+            np.save(os.path.join(self.dir, f"participation_{batch}_indices.npy"), participation.indices)
+            participation = None
+        self._participation.append(participation)
+        self.bounds.append((start, end))
+
+    def participation(self, batch):
+        '''
+        Participation matrix (csr_matrix) of the batch number batch.
+        '''
+        if self.dir is None:
+            return self._participation[batch]
+        indptr = np.load(os.path.join(self.dir, f"participation_{batch}_indptr.npy"), mmap_mode="r")
+        indices = np.load(os.path.join(self.dir, f"participation_{batch}_indices.npy"), mmap_mode="r")
+        start, end = self.bounds[batch]
+        return sparse.csr_matrix((np.ones(len(indices), dtype=np.int64), indices, indptr),
+                                 shape=(end - start, self.n_events))
+
+    def users_tags(self, user_ids):
+        '''
+        Users x cluster_tags matrix of all the users, indexed by id_user (as users_tags_matrix), without copying
+        the cluster tags.
+        '''
+        return pd.DataFrame(self._tags.T, columns=cluster_tags, index=pd.Index(user_ids, name="id_user"), copy=False)
+
+    def close(self):
+        self._participation = []
+        self._tags = None
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+def iter_user_batches(df_users, batch_size):
+    '''
+    Iterate over the users by batches of batch_size users: (position of the first user, suscriptions of the users).
+    '''
+    suscriptions = df_users["suscriptions"]
+    for start in range(0, len(df_users), batch_size):
+        yield start, list(suscriptions.iloc[start:start + batch_size])
+
+def stream_users_batches(df_users, df_events, events_clusters, batch_size, spill_dir=None):
+    '''
+    First pass of the streaming pipeline: the participation of each batch of users and their cluster tags (the
+    cluster tags of the events each user participated to), as create_training_df_recommendation_vectorized but
+    without repeating the tags of each user for every event.
+
+    Output:
+    - batches : UsersBatches
+        Participation and cluster tags of the batches (to be closed by the caller).
+    '''
+    event_index = {id_event : i for i, id_event in enumerate(df_events["_id"])}
+    batches = UsersBatches(len(df_users), len(df_events), spill_dir)
+    try:
+        for start, suscriptions in iter_user_batches(df_users, batch_size):
+            participation = build_participation(suscriptions, event_index, len(df_events))
+            batches.add(start, participation, np.asarray(participation @ events_clusters))
+    except BaseException:
+        batches.close()
+        raise
+    return batches
+
+def stream_recommendations(batches, user_ids, df_real_events, model, n_events=3, max_block_bytes=64*1024**2):
+    '''
+    Second pass of the streaming pipeline: score the candidate events for each batch of users with the model and
+    keep the best n_events of each user (see make_predictions). Each batch is scored by blocks of users, sized as
+    in make_predictions so that at most max_block_bytes are used for the scores of a block: only the scores of one
+    block are in memory, whatever the size of the batches.
+
+    Output:
+    - scores : dict
+      Same dictionary of make_predictions.
+    '''
+    user_ids = [str(user) for user in user_ids]
+    scores = {user : {} for user in user_ids}
+    if len(user_ids) == 0 or len(df_real_events) == 0:
+        return scores
+    candidates = events_candidates(df_real_events)
+    model_users = pd.Index(model["users"])
+    block_size = int(max(1, max_block_bytes // (8*max(1, len(candidates["columns"])))))
+    for batch, (start, end) in enumerate(batches.bounds):
+        # -1 for the users the model does not know (a pinned model, or trained before they signed up)
+        tags_scores = users_tags_scores(model, model_users.get_indexer(user_ids[start:end]))
+        participation = batches.participation(batch)
+        for block_start in range(0, end - start, block_size):
+            block_end = min(block_start + block_size, end - start)
+            block_scores = recommend_events(tags_scores[block_start:block_end], participation[block_start:block_end],
+                                            candidates, n_events)
+            scores.update(zip(user_ids[start + block_start:start + block_end], block_scores))
+    return scores
+
+def stream_events_recommendations(df_users, df_events, df_tags, batch_size=10000, spill_dir=None, search=None,
+                                  backend=None, **search_params):
+    '''
+    Events recommendations of all the users, as create_training_df_recommendation_vectorized followed by
+    train_SVD_model, streaming the users by batches instead of building the users x events dataframe: the memory
+    depends on batch_size x events, not on users x events.
+
+    The users are read twice. The first pass builds the participation and the cluster tags of each batch (and, with
+    spill_dir, saves them on disk, see UsersBatches); the model is trained on the cluster tags of all the users
+    (see fit_events_model); the second pass scores the candidate events of each batch with it.
+
+    Input:
+    - df_users, df_events, df_tags : pandas.DataFrame
+        Dataframes of the collections users, events and tags.
+    - batch_size : int
+        Number of users of each batch.
+    - spill_dir : str
+        Directory where the results of the first pass are saved until the scoring, None to keep them in memory.
+    - search, backend, search_params : see train_SVD_model.
+
+    Output:
+    - results : dict
+      Same results of train_SVD_model.
+    '''
+    with span("build_training_frames", rows=len(df_users), pipeline="events_recommendations"):
+        events_clusters = build_events_clusters(df_events, df_tags)
+        batches = stream_users_batches(df_users, df_events, events_clusters, batch_size, spill_dir)
+    try:
+        model = fit_events_model(batches.users_tags(df_users["_id"].values), search=search, backend=backend,
+                                 **search_params)
+        with span("scoring", pipeline="events_recommendations") as stage:
+            results = stream_recommendations(batches, df_users["_id"].values, events_frame(df_events, events_clusters),
+                                             model)
+            stage.rows = len(results)
+    finally:
+        batches.close()
+    return results
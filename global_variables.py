@@ -1,3 +1,5 @@
+import os
+
 mapping_tags = {
     "Desarrollo profesional" : ["Prácticas Laborales", "Empleabilidad", "Liderazgo", "Emprendimiento", "Desarrollo profesional"],
     "Negocios y Finanzas" : ["Marketing", "Finanzas", "Gestión Empresarial"],
@@ -50,4 +52,38 @@ cluster_tags = [
     "Arte y Cultura",
     "Aprendizaje y educación",
     "Gaming"
-]
\ No newline at end of file
+]
+
+# Categories of the artificial users (see create_artificial_users)
+artificial_estudios = ["Grado", "Master", "Bootcamp"]
+artificial_sexos = ["Hombre", "Mujer"]
+
+# Size of the artificial corpus used together with the real users to train the SVD model
+artificial_corpus = {
+    "n_users" : int(os.getenv("ARTIFICIAL_N_USERS", default=1000)),
+    "n_events" : int(os.getenv("ARTIFICIAL_N_EVENTS", default=50)),
+    "seed" : 42
+}
+
+# Registry of the trained models (see model_registry), and name of the SVD model of the events recommendations
+models_registry_path = os.getenv("MODELS_REGISTRY_PATH", default="models/registry")
+SVD_model_name = "SVD_recommendations"
+
+# Numbers of the genders in the features of the users matching
+gender_codes = {"Hombre" : 1, "Mujer" : 0, "No especifica" : 2}
+
+# Processes building the training dataframes and the features of the users by chunks (see parallel_frames),
+# 1 to build them in the process of the request, -1 for one per CPU
+frames_n_jobs = int(os.getenv("FRAMES_N_JOBS", default=1))
+
+# Trainer of the matrix factorization of the events recommendations: "surprise" (SVD of surprise, trained per
+# rating on the long format) or "numpy" (biased MF fitted with ALS on the dense users x cluster tags matrix)
+MF_backend = os.getenv("MF_BACKEND", default="surprise")
+
+# Users of each batch of the streaming pipeline of the events recommendations (see events_streaming), 0 to build
+# the whole users x events dataframe instead, and directory where the batches are saved until the scoring
+events_batch_size = int(os.getenv("EVENTS_BATCH_SIZE", default=10000))
+events_spill_dir = os.getenv("EVENTS_SPILL_DIR")
+
+# Pickle file of the LSH index of the users matching (see matching_users_index.get_users_index)
+users_index_path = os.getenv("USERS_INDEX_PATH", default="models/users_matching_index.pkl")
@@ -0,0 +1,31 @@
+import gc
+import os
+
+# The app (models, snapshot of the collections, results) is loaded once in the master before forking the workers,
+# which share it: adding workers does not load it again. GUNICORN_PRELOAD=0 to load it in every worker instead.
+preload_app = os.getenv("GUNICORN_PRELOAD", default="1") == "1"
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        import main
+        main.preload_artifacts()
+        # The objects loaded by the master are moved out of the garbage collector, so that its passes in the
+        # workers do not write on their pages (which would copy them in every worker)
+        gc.freeze()
+
+def post_fork(server, worker):
+    import main
+    if not server.cfg.preload_app:
+        main.preload_artifacts()
+    # The scheduler runs in the workers, the master never runs jobs
+    main.start_scheduler()
+
+def on_reload(server):
+    # kill -HUP <master pid>: the master loads the current artifacts (model version, snapshot, results) and
+    # gunicorn replaces the workers with new ones forked with them, without closing the socket
+    if server.cfg.preload_app:
+        import main
+        gc.unfreeze()
+        main.preload_artifacts(reload=True)
+        gc.collect()
+        gc.freeze()
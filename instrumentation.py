@@ -0,0 +1,167 @@
+import time
+import resource
+import threading
+import contextlib
+
+def peak_rss_bytes():
+    '''
+    Peak resident memory of the process since it started, in bytes (ru_maxrss is in kilobytes on Linux).
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+_page_size = resource.getpagesize()
+
+def current_rss_bytes():
+    '''
+    Current resident memory of the process, in bytes (second field of /proc/self/statm, in pages). 0 where
+    /proc is not available.
+    '''
+    try:
+        with open("/proc/self/statm", "rb") as file:
+            return int(file.read().split()[1])*_page_size
+    except (OSError, IndexError, ValueError):
+        return 0
+
+class StageMetrics:
+    '''
+    Metrics of the stages of the pipelines, aggregated in the process since it started: number of calls, wall time,
+    CPU time of the process and rows processed of each stage, and the change of the resident memory of the process
+    during the last run of each stage and the largest one. They are recorded by span and exported in the
+    Prometheus text format by prometheus.
+
+    The change of the resident memory is the one between the start and the end of the stage, so it is the memory
+    the stage keeps (or frees, negative), not the transient peak inside the stage. Unlike the peak memory of the
+    process (ru_maxrss), it is not the same for all the stages which run after the biggest one.
+
+    Each gunicorn worker has its own metrics, as usual with Prometheus (each worker is scraped as a target).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, name, labels, wall, cpu, rows, rss_delta):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            stage = self._stages.setdefault(key, {"calls" : 0, "wall" : 0.0, "cpu" : 0.0, "rows" : 0,
+                                                  "last_wall" : 0.0, "last_rss_delta" : 0, "max_rss_delta" : 0})
+            stage["calls"] += 1
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+            stage["rows"] += rows or 0
+            stage["last_wall"] = wall
+            stage["last_rss_delta"] = rss_delta
+            if stage["calls"] == 1 or rss_delta > stage["max_rss_delta"]:
+                stage["max_rss_delta"] = rss_delta
+
+    def snapshot(self):
+        '''
+        Return a copy of the metrics, {(name, labels) : {calls, wall, cpu, rows, last_wall, last_rss_delta,
+        max_rss_delta}}.
+        '''
+        with self._lock:
+            return {key : dict(stage) for key, stage in self._stages.items()}
+
+    def prometheus(self):
+        '''
+        Return the metrics in the Prometheus text exposition format.
+        '''
+        stages = self.snapshot()
+        series = [
+            ("pipeline_stage_calls_total", "counter", "Number of runs of the stage.", "calls"),
+            ("pipeline_stage_wall_seconds_total", "counter", "Wall time spent in the stage.", "wall"),
+            ("pipeline_stage_cpu_seconds_total", "counter", "CPU time of the process spent in the stage.", "cpu"),
+            ("pipeline_stage_rows_total", "counter", "Rows processed by the stage.", "rows"),
+            ("pipeline_stage_last_wall_seconds", "gauge", "Wall time of the last run of the stage.", "last_wall"),
+            ("pipeline_stage_rss_delta_bytes", "gauge",
+             "Change of the resident memory of the process during the last run of the stage.", "last_rss_delta"),
+            ("pipeline_stage_max_rss_delta_bytes", "gauge",
+             "Largest change of the resident memory of the process during a run of the stage.", "max_rss_delta"),
+        ]
+        lines = []
+        for metric, kind, help_text, field in series:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for (name, labels), stage in sorted(stages.items()):
+                label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in (("stage", name),) + labels)
+                lines.append(f"{metric}{{{label_text}}} {stage[field]}")
+        lines.append("# HELP process_peak_rss_bytes Peak resident memory of the process.")
+        lines.append("# TYPE process_peak_rss_bytes gauge")
+        lines.append(f"process_peak_rss_bytes {peak_rss_bytes()}")
+        lines.append("# HELP process_resident_memory_bytes Resident memory of the process.")
+        lines.append("# TYPE process_resident_memory_bytes gauge")
+        lines.append(f"process_resident_memory_bytes {current_rss_bytes()}")
+        return "\n".join(lines) + "\n"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Metrics of the process, and spans of the current request of each thread (for the Server-Timing header)
+metrics = StageMetrics()
+_trace = threading.local()
+
+class Span:
+    '''
+    A stage being measured by span. The rows processed by the stage can be set while it runs, span.rows = n.
+    '''
+
+    def __init__(self, name, labels, rows=None):
+        self.name = name
+        self.labels = labels
+        self.rows = rows
+        self.wall = None
+
+@contextlib.contextmanager
+def span(name, rows=None, **labels):
+    '''
+    Measure a stage of a pipeline: wall time, CPU time of the process, change of the resident memory of the
+    process and rows processed. The measures are added to metrics and, if a trace was started in the thread (start_trace), to the
+    spans of the trace.
+
+    Example:
+        with span("scoring", pipeline="events_recommendations") as stage:
+            results = make_predictions(...)
+            stage.rows = len(results)
+    '''
+    stage = Span(name, labels, rows)
+    start_wall, start_cpu, start_rss = time.perf_counter(), time.process_time(), current_rss_bytes()
+    try:
+        yield stage
+    finally:
+        stage.wall = time.perf_counter() - start_wall
+        metrics.record(name, labels, stage.wall, time.process_time() - start_cpu, stage.rows,
+                       current_rss_bytes() - start_rss)
+        spans = getattr(_trace, "spans", None)
+        if spans is not None:
+            spans.append(stage)
+
+def timed_iter(name, iterable, rows=None, **labels):
+    '''
+    Iterate over iterable measuring the whole iteration as a span (for instance a streamed response). The rows of
+    the span are rows if given, otherwise the number of items.
+    '''
+    with span(name, rows=rows if rows is not None else 0, **labels) as stage:
+        for item in iterable:
+            if rows is None:
+                stage.rows += 1
+            yield item
+
+def start_trace():
+    '''
+    Start recording the spans of the current thread (for instance at the beginning of a request).
+    '''
+    _trace.spans = []
+
+def end_trace():
+    '''
+    Stop recording the spans of the current thread and return them.
+    '''
+    spans = getattr(_trace, "spans", None) or []
+    _trace.spans = None
+    return spans
+
+def server_timing(spans):
+    '''
+    Format spans as the value of a Server-Timing header: name;dur=<milliseconds>, in the order they ended.
+    '''
+    return ", ".join(f"{stage.name};dur={stage.wall*1000:.1f}" for stage in spans)
@@ -0,0 +1,171 @@
+import os
+import json
+import uuid
+import time
+import fcntl
+import datetime
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+class JobManager:
+    '''
+    Run the training pipelines in background jobs, outside of the Flask requests, and keep track of their status.
+
+    The jobs run one at a time in a background thread. The status of each job ("queued", "running", "finished" or
+    "failed") is saved as a json file in jobs_dir, so it can be polled from any gunicorn worker. Submitting a job
+    with the same name of a job that is still queued or running, in this process or in any other one using the
+    same jobs_dir, does not start a new one, it returns the id of the job already in progress: while a job is
+    queued or running its process holds a lock on the file jobs_dir/<name>.lock, which has the id of the job.
+
+    Parameters:
+    - tasks : dict
+        Dictionary with the name of each job as key and the function to run as value. The function receives the
+        parameters passed to submit.
+    - jobs_dir : str
+        Directory where the status of the jobs is saved.
+    '''
+
+    def __init__(self, tasks, jobs_dir="jobs"):
+        self.tasks = tasks
+        self.jobs_dir = jobs_dir
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._scheduler = None
+        self._scheduler_lock_file = None
+
+    def _path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _save(self, job):
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        path = self._path(job["id"])
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(job, file)
+        os.replace(tmp_path, path)
+
+    def _claim(self, name):
+        '''
+        Take the lock of the job name (see JobManager), without waiting. Returns the lock file if this process got
+        it, otherwise the id of the job in progress.
+        '''
+        while True:
+            lock_file = open(os.path.join(self.jobs_dir, f"{name}.lock"), "a+", encoding="utf-8")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file, None
+            except OSError:
+                lock_file.seek(0)
+                job_id = lock_file.read().strip()
+                lock_file.close()
+            # Empty if the process which holds the lock has not written the id of its job yet
+            job = self.get(job_id) if job_id else None
+            if job is not None and job["status"] in ("queued", "running"):
+                return None, job_id
+            time.sleep(0.01)
+
+    def _release(self, lock_file):
+        lock_file.truncate(0)
+        lock_file.flush()
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def submit(self, name, **params):
+        '''
+        Queue a job to run the task name with the given parameters.
+
+        Output:
+        - job_id : str
+            Id of the job, to poll its status with get.
+        '''
+        if name not in self.tasks:
+            raise KeyError(f"Unknown job {name}")
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        with self._lock:
+            lock_file, job_id = self._claim(name)
+            if lock_file is None:
+                return job_id
+            job = {"id" : uuid.uuid4().hex, "name" : name, "params" : params, "status" : "queued",
+                   "created_at" : str(datetime.datetime.now()), "started_at" : None, "finished_at" : None,
+                   "error" : None}
+            try:
+                self._save(job)
+                lock_file.truncate(0)
+                lock_file.write(job["id"])
+                lock_file.flush()
+            except BaseException:
+                self._release(lock_file)
+                raise
+        self._executor.submit(self._run, job, lock_file)
+        return job["id"]
+
+    def _run(self, job, lock_file):
+        try:
+            job["status"] = "running"
+            job["started_at"] = str(datetime.datetime.now())
+            self._save(job)
+            try:
+                self.tasks[job["name"]](**job["params"])
+                job["status"] = "finished"
+            except Exception:
+                job["status"] = "failed"
+                job["error"] = traceback.format_exc()
+            job["finished_at"] = str(datetime.datetime.now())
+            self._save(job)
+        finally:
+            self._release(lock_file)
+
+    def get(self, job_id):
+        '''
+        Return the status of a job as a dictionary, or None if the job does not exist.
+        '''
+        # The ids are hex strings, anything else is not a job (and not a path to open)
+        if not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        try:
+            with open(self._path(job_id), encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _try_scheduler_lock(self):
+        # Non blocking: the lock is held by this process until it ends (the file is never closed)
+        lock_file = open(os.path.join(self.jobs_dir, "scheduler.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._scheduler_lock_file = lock_file
+        return True
+
+    def start_scheduler(self, interval_seconds, names, retry_seconds=60, **params):
+        '''
+        Submit the jobs names every interval_seconds in a daemon thread. With several gunicorn workers only one
+        of them submits the jobs: the one which holds the lock on the file jobs_dir/scheduler.lock. The thread of
+        the other ones tries to get the lock every retry_seconds, so when the process which holds it ends (for
+        instance the old workers replaced after a SIGHUP, which gunicorn stops after starting the new ones) one of
+        the others takes over.
+
+        Output:
+        - started : bool
+            True if this process holds the lock and submits the jobs from now on.
+        '''
+        if self._scheduler is not None:
+            return self._scheduler_lock_file is not None
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        locked = self._try_scheduler_lock()
+
+        def loop():
+            while self._scheduler_lock_file is None:
+                time.sleep(min(retry_seconds, interval_seconds))
+                self._try_scheduler_lock()
+            while True:
+                for name in names:
+                    self.submit(name, **params)
+                time.sleep(interval_seconds)
+
+        self._scheduler = threading.Thread(target=loop, name="retraining-scheduler", daemon=True)
+        self._scheduler.start()
+        return locked
@@ -1,38 +1,225 @@
+'''
+API creada para gestionar peticiones desde el Backend de la APP y sugerir eventos afines a los usuarios, así como sugerir usuarios afines entre sí.
+
+Dispone de 3 endpoints:
+
+- transfer_database: Conecta con la base de datos MongoDB (backend de la APP alojada en Atlas) y clona dichos registros en una base de datos Postgres (alojada en AWS),
+con la finalidad de reeentrenar a los modelos de Machien Learning encargados de las sugerencias a usuarios.
+
+- user_recommend: Recibe petición con los datos de usuario (relativos a su perfil, asi como sus skills y sus hobbies) y devuelve un listado de usuarios ordando por afinidad.
+
+- events_recommend: Recibe petición con los datos de usuario (relativos a participación del usuario a eventos) y devuelve un listado de eventos afines según sus intereses
+y bassándose en participación a eventos de usuarios afines.
+
+'''
 import os
 import pandas as pd
 import numpy as np
 import psycopg2
 from sqlalchemy import create_engine, text
-from flask import Flask, request, send_file, render_template, jsonify
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.metrics.pairwise import cosine_similarity
+from flask import Flask, Response, request, send_file, render_template, jsonify
 import json
+import time
 import datetime
 #import ast
 #import sys
 
 from data_preprocessing_utilities import *
 from recommending_events_model import *
+from matching_users_model import *
+from results_store import ResultsStore
+from response_cache import ResponseCache, response_etag
+from pipelines import run_events_recommendations, run_users_matching
+from events_response import stream_json
+from instrumentation import metrics, span, timed_iter, start_trace, end_trace, server_timing
+from jobs import JobManager
+from users_profiles import get_users_profiles
+from users_features import get_users_feature_encoder
+from matching_users_index import get_users_index, match_user
 from global_variables import *
 
 
 app = Flask(__name__)
+# Latest results of the bulk endpoints, to serve them user by user
+results_store = ResultsStore(os.getenv("RESULTS_DIR", default="results"))
+
+# Responses of the bulk endpoints by fingerprint of the data and version of the model, in memory and on disk in
+# RESPONSE_CACHE_DIR (results/responses by default), shared by the workers: a response computed by the job of a
+# worker is a hit in the others. RESPONSE_CACHE_DIR= (empty) to keep them only in memory
+response_cache = ResponseCache(max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", default=8)),
+                               ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", default=3600)),
+                               disk_dir=os.getenv("RESPONSE_CACHE_DIR",
+                                                  default=os.path.join(results_store.results_dir, "responses")) or None)
+
+# Seconds after which a request finding the local snapshot older (not refreshed by any process) submits the job
+# mongo_sync, which pulls the changes of the app database: the requests never read it themselves
+snapshot_max_age_seconds = float(os.getenv("SNAPSHOT_MAX_AGE_SECONDS", default=300))
+
+def sync_snapshot(kind, check_deletions=False):
+    '''
+    Pull the changes of the app database and return the DataSnapshot of the collections. With check_deletions the
+    documents deleted in the database are removed as well, reading all their ids: only the jobs do it.
+    '''
+    with span("mongo_sync", pipeline=kind) as stage:
+        snapshot = connection_db_mongodb(check_deletions)
+        stage.rows = len(snapshot.users)
+    return snapshot
 
-'''
-API creada para gestionar peticiones desde el Backend de la APP y sugerir eventos afines a los usuarios, así como sugerir usuarios afines entre sí.
+def bulk_etag(kind, snapshot, now=None):
+    '''
+    ETag (and key in response_cache) of the response of a bulk endpoint for the data of snapshot: the events
+    recommendations also depend on the version of the SVD model in use, and on the time (computed at now) until
+    which the future events recommended stay the same, so the key changes when an event becomes past.
+    '''
+    if kind != "events_recommendations":
+        return response_etag(kind, snapshot.fingerprint())
+    valid_until = candidates_valid_until(snapshot.events, now)
+    return response_etag(kind, snapshot.fingerprint(), current_SVD_version(), valid_until)
 
-Dispone de 3 endpoints:
+def refresh_snapshot():
+    '''
+    Pull the changes of the app database into the local snapshot, which the next requests read (job mongo_sync).
+    '''
+    sync_snapshot("mongo_sync", check_deletions=True)
 
-- transfer_database: Conecta con la base de datos MongoDB (backend de la APP alojada en Atlas) y clona dichos registros en una base de datos Postgres (alojada en AWS),
-con la finalidad de reeentrenar a los modelos de Machien Learning encargados de las sugerencias a usuarios.
+def refresh_events_recommendations(update_AWS_DB=None, snapshot=None):
+    '''
+    Run the events recommendations pipeline and replace the results served by /events_recommendations/<user_id>.
+    '''
+    snapshot = sync_snapshot("events_recommendations", check_deletions=True) if snapshot is None else snapshot
+    # The future events are the ones of the start of the run: an event which becomes past meanwhile changes the key
+    started_at = datetime.datetime.now()
+    preds = run_events_recommendations(update_AWS_DB, snapshot)
+    results_store.update("events_recommendations", preds)
+    # With the version of the model just trained, if the data changed
+    response_cache.put(bulk_etag("events_recommendations", snapshot, started_at), preds)
+    return preds
+
+def refresh_users_matching(update_AWS_DB=None, snapshot=None):
+    '''
+    Run the users matching pipeline, which also updates the index searched by /match_users/<user_id>.
+    '''
+    snapshot = sync_snapshot("users_matching", check_deletions=True) if snapshot is None else snapshot
+    preds = run_users_matching(update_AWS_DB, snapshot)
+    results_store.update("users_matching", preds)
+    response_cache.put(bulk_etag("users_matching", snapshot), preds)
+    return preds
 
-- user_recommend: Recibe petición con los datos de usuario (relativos a su perfil, asi como sus skills y sus hobbies) y devuelve un listado de usuarios ordando por afinidad.
+def cached_bulk_results(kind):
+    '''
+    Results of a bulk endpoint for the current data, their ETag and the id of the job which refreshes them. The
+    app database is not read: the data is the local snapshot of the last sync, by any process (see
+    local_snapshot), which the scheduled and submitted jobs refresh. If the data (and the model) did not change
+    since the results were computed, in this process or another one, the results are taken from response_cache,
+    and if the client already has them (If-None-Match with the ETag) the results are None, to answer 304 Not
+    Modified. If the snapshot was not refreshed in the last snapshot_max_age_seconds, a job is submitted to pull
+    the changes, and the results of the snapshot are returned meanwhile.
+
+    Otherwise the pipeline is never run inside the request: a background job is submitted (see JobManager, only
+    one per kind at a time among all the workers) and the last results of results_store are returned meanwhile,
+    without ETag since they are not the ones of the current data, or None if there are no results yet, to answer
+    202 Accepted with the job. With update_AWS_DB=yes a job is always submitted, since it saves a new run in the
+    database.
+
+    Output:
+    - preds : dict
+        Results, None for 304 or 202.
+    - etag : str
+        ETag of the results, None if they are the last ones instead of the ones of the current data.
+    - job_id : str
+        Id of the job submitted, None if the results are the ones of the current data.
+    '''
+    update_AWS_DB = request.args.get('update_AWS_DB')
+    if update_AWS_DB != "yes":
+        snapshot = local_snapshot()
+        synced_at = get_mongo_sync().synced_at()
+        if synced_at is None or time.time() - synced_at > snapshot_max_age_seconds:
+            job_manager.submit("mongo_sync")
+        etag = bulk_etag(kind, snapshot)
+        if etag in request.if_none_match:
+            return None, etag, None
+        preds = response_cache.get(etag)
+        if preds is not None:
+            return preds, etag, None
+    job_id = job_manager.submit(kind, update_AWS_DB=update_AWS_DB)
+    return results_store.results(kind), None, job_id
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def job_accepted(job_id):
+    '''
+    202 Accepted with the job which computes the results, to poll its status in /jobs/<job_id>.
+    '''
+    return jsonify({"job_id" : job_id, "status_url" : f"/jobs/{job_id}"}), 202
 
-- events_recommend: Recibe petición con los datos de usuario (relativos a participación del usuario a eventos) y devuelve un listado de eventos afines según sus intereses
-y bassándose en participación a eventos de usuarios afines.
+def bulk_response_headers(response, etag, job_id):
+    '''
+    ETag of the results of a bulk endpoint or, if they are the last results while a job refreshes them, the
+    headers X-Results-Stale and X-Job-Status-URL.
+    '''
+    if job_id is None:
+        response.set_etag(etag)
+    else:
+        response.headers["X-Results-Stale"] = "yes"
+        response.headers["X-Job-Status-URL"] = f"/jobs/{job_id}"
+    return response
+
+# Server-Timing header with the time of each stage of the request, if SERVER_TIMING_HEADER=1 or the request
+# has the parameter timings=yes
+server_timing_header = os.getenv("SERVER_TIMING_HEADER", default="0") == "1"
+
+@app.before_request
+def start_request_trace():
+    start_trace()
+
+@app.after_request
+def add_server_timing(response):
+    spans = end_trace()
+    if spans and (server_timing_header or request.args.get('timings') == "yes"):
+        response.headers["Server-Timing"] = server_timing(spans)
+    return response
+
+# Background jobs for retraining, and scheduler if RETRAIN_INTERVAL_SECONDS is set
+job_manager = JobManager({"events_recommendations" : refresh_events_recommendations,
+                          "users_matching" : refresh_users_matching,
+                          "mongo_sync" : refresh_snapshot},
+                         os.getenv("JOBS_DIR", default="jobs"))
+
+def start_scheduler():
+    '''
+    Start the scheduler of the retraining jobs if RETRAIN_INTERVAL_SECONDS is set (in one process only, see
+    JobManager.start_scheduler).
+    '''
+    if int(os.getenv("RETRAIN_INTERVAL_SECONDS", default="0")) > 0:
+        job_manager.start_scheduler(int(os.getenv("RETRAIN_INTERVAL_SECONDS")), ["users_matching", "events_recommendations"])
+
+def preload_artifacts(reload=False):
+    '''
+    Load everything the requests use before the first request: the factors of the current SVD model
+    (memory-mapped), the local snapshot of the collections with the profiles, the encoder of its catalogs and
+    the LSH index of the users, and the last results of the bulk endpoints. Without connecting to mongoDB, the snapshot is the one saved by
+    the last sync.
+
+    It is not run when the module is imported. With gunicorn (see gunicorn.conf.py) it runs once in the master
+    before forking the workers, which start with everything already in memory and share it instead of each one
+    loading its own copy (the arrays of the model are memory-mapped, the rest is shared copy-on-write), or in
+    each worker with GUNICORN_PRELOAD=0. On SIGHUP it runs again in the master with reload=True, and the new
+    workers replace the old ones with the new artifacts.
+    '''
+    with span("preload_artifacts") as stage:
+        get_SVD_model()
+        snapshot = local_snapshot(reload=reload)
+        if len(snapshot.users):
+            get_users_profiles(snapshot)
+            get_users_feature_encoder(snapshot)
+            get_users_index(snapshot)
+            snapshot.fingerprint()
+        results_store.preload()
+        stage.rows = len(snapshot.users)
 
-'''
 
 @app.route('/')
 def index():
@@ -52,50 +239,16 @@ def events_recommendations():
     database on AWS.
     '''
 
-    update_AWS_DB = request.args.get('update_AWS_DB')
-    
-    (users_columns, users, events_columns, events,tags_columns, tags,_, _,
-     _, _, _, _, _, _) = connection_db_mongodb()
-    df_users = pd.DataFrame(users, columns=users_columns)
-    df_events = pd.DataFrame(events, columns=events_columns)
-    df_tags = pd.DataFrame(tags, columns=tags_columns)
-
-    df_real_users, df_real_events = create_training_df_recommendation(df_users, df_events, df_tags)
-    results = train_SVD_model(df_real_users, df_real_events)
-
-    #I drop this column which is a timestamp. I don't need it and it causes problems
-    df_events = df_events.drop(["updatedAt"], axis=1)
-    df_events["attendees"] = df_events["attendees"].apply(lambda x : [str(z) for z in x]) 
-    # Convert all the ObjectId objects in str to avoid problems when converting to json
-    for i in range(len(df_events)):
-        df_events.loc[i,"_id"] = str(df_events.loc[i,"_id"])
-        tags_names = [df_tags[df_tags["_id"] == id_tag]["name"].values[0] for id_tag in df_events.loc[i,"eventTags"]]
-        if len(tags_names)<=4:
-            df_events.at[i,"eventTags"] = tags_names
-        else:
-            df_events.at[i,"eventTags"] = tags_names[0:4]
-    #prepare the output for the API, FullStack wants a json with all the information of the first 3 recommended events for each user
-    preds = {str(user) : {key : [] for key in df_events.columns} for user in df_real_users["id_user"].unique()}
-    for user_id, event in results.items():
-            for event_id in event.keys():
-                row = df_events[df_events["_id"]==event_id].values[0]
-                for i, key in enumerate(preds[user_id].keys()):
-                    preds[user_id][key].append(row[i])
-    # Organize the dictionary in a dataframe with columns id_user, id_event, score, to save it in the postgre DB
-    rows = []
-    for id_user, events in results.items():
-        for id_event, score in events.items():
-            rows.append({'id_user': id_user, 'id_event': id_event, 'score': score})
-    df = pd.DataFrame(rows)
-    dates = [datetime.datetime.now()]*len(df)
-    df_dates = pd.DataFrame(dates, columns=["date"])
-    df_final = pd.merge(df,df_dates, right_index=True, left_index=True)
-    #If this parameter is not set to yes, do not save in the postgresql database on AWS
-    if update_AWS_DB=="yes":
-        engine_postgres = create_engine(os.getenv("URL_POSTGRESQL_AWS"))
-        df_final.to_sql('events_recommendations', engine_postgres, if_exists='append', index=False)
-        engine_postgres.dispose()
-    return json.dumps(preds)
+    # If the data changed the results are computed in a background job, which also saves them to serve them user
+    # by user in /events_recommendations/<user_id>, and the last ones are returned meanwhile (see cached_bulk_results)
+    preds, etag, job_id = cached_bulk_results("events_recommendations")
+    if preds is None:
+        return not_modified(etag) if job_id is None else job_accepted(job_id)
+    # The json is streamed user by user (chunked transfer), without building the whole string in memory
+    response = Response(timed_iter("serialization", stream_json(preds), rows=len(preds),
+                                   pipeline="events_recommendations"),
+                        mimetype="application/json")
+    return bulk_response_headers(response, etag, job_id)
 
 @app.route('/match_all_users')
 def match_all_users():
@@ -110,105 +263,91 @@ def match_all_users():
     it save the results of the predictions with the date and time when the API has been called in a PostgreSQL
     database on AWS.
     '''
-    update_AWS_DB = request.args.get('update_AWS_DB')
-    (users_columns, users, _, _,_, _,degrees_columns, degrees,skills_columns,
-      skills, hobbies_columns, hobbies, userTypes_columns, userTypes) = connection_db_mongodb()
-    df_users = pd.DataFrame(users, columns=users_columns)
-    df_degrees = pd.DataFrame(degrees, columns=degrees_columns)
-    df_skills = pd.DataFrame(skills, columns=skills_columns)
-    df_hobbies = pd.DataFrame(hobbies, columns=hobbies_columns)
-    df_userTypes = pd.DataFrame(userTypes, columns=userTypes_columns)
-    
-    dataset = create_training_df_userMatching(df_users, df_hobbies, df_skills, df_degrees)
-    
-    # Definir una función que sustituya Femenino por O, Masculino por 1 y No especifica por 2 en la columna sexo
-    def gender(x):
-        if x == "Hombre":
-            return 1
-        elif x == "Mujer":
-            return 0
-        elif x == "No especifica":
-            return 2
-
-    dataset["sexo"] = dataset["sexo"].apply(lambda x: gender(x))
-    #FDG: he tenido que añadir esto para quitar la cuestión del ObjectId
-    dataset["id_user"] = dataset["id_user"].astype(str)
-    users = dataset["id_user"].tolist()
-
-    # Paso 1: Normalizar los valores en una escala de 0 a 1
-    scaler = MinMaxScaler()
-
-    # Crear el pipeline con el paso de normalización
-    pipeline = Pipeline([
-        ('scaler', scaler)
-    ])
-
-    users_afinidad = {}
-
-    for user in users:
-
-        #FDG: Lo he cambiado con esto porque me daba problemas cuando cargaba los datos desde mongo
-        #FDG: NOTA tenemos que averiguar como va, porque también
-        following = dataset[dataset["id_user"]==user]["following"].values[0]
-        #Hay que añadir esto porque los elementos en la lista serán también ObjectId y darán problemas
-        following = [str(x) for x in following]
-        # Aplicar el pipeline y obtener los datos normalizados
-        intereses_dataset_normalized = pipeline.fit_transform(dataset.drop(["id_user", "following"], axis=1))
-
-        # Obtener el vector de intereses normalizado del usuario de referencia
-        intereses_referencia = intereses_dataset_normalized[dataset["id_user"] == user]
-
-        # Calcular la similitud de coseno entre el usuario de referencia y todos los demás usuarios
-        similitudes = cosine_similarity(intereses_referencia, intereses_dataset_normalized)
-
-        # Obtener los usuarios y sus respectivas similitudes
-        usuarios = dataset["id_user"].values
-        similitudes_usuarios = similitudes.flatten()
-
-        # Crear un DataFrame con los usuarios y sus similitudes
-        similitudes_df = pd.DataFrame({"Usuario": usuarios, "Similitud": similitudes_usuarios})
-
-        # Filtrar los usuarios que ya están en el "following" del usuario actual
-        similitudes_df = similitudes_df[~similitudes_df["Usuario"].isin(following)]
-
-        # Obtener los usuarios más similares (máximo 5)
-        usuarios_afines = similitudes_df.sort_values(by="Similitud", ascending=False).iloc[1:5]["Usuario"].tolist()
-
-        users_afinidad[user] = usuarios_afines
-
-    df = pd.DataFrame(users_afinidad.items(), columns=['username', 'users_affinity'])
-    #Add the date to save in database
-    dates = [datetime.datetime.now()]*len(df)
-    df_dates = pd.DataFrame(dates, columns=["date"])
-    df_final = pd.merge(df,df_dates, right_index=True, left_index=True)
- 
-    if update_AWS_DB=="yes":
-        engine_postgres = create_engine(os.getenv("URL_POSTGRESQL"))
-        df_final.to_sql('users_matching', engine_postgres, if_exists='append', index=False)
-        engine_postgres.dispose()
-
-    #REORGANIZE JSON FOR FULLSTACK
-    df_users["_id"] = df_users["_id"].astype(str)
-    preds = {str(user) : {key : [] for key in ["_id", "username", "degree", "userType"]} for user in df_users["_id"].unique()}
-    for index, row in df.iterrows():
-        user_id = row["username"]
-        recommended_ids = row["users_affinity"]
-        for rec_id in recommended_ids:
-            username = df_users[df_users["_id"] ==rec_id]["username"].values[0]
-            degree_id = df_users[df_users["_id"] ==rec_id]["degree"].values[0]
-            degree = df_degrees[df_degrees["_id"]==degree_id]["name"].values[0]
-            userType_id = df_users[df_users["_id"] ==rec_id]["userType"].values[0]
-            userType = df_userTypes[df_userTypes["_id"]==userType_id]["name"].values[0]
-            preds[user_id]["_id"].append(rec_id)
-            preds[user_id]["username"].append(username)
-            preds[user_id]["degree"].append(degree)
-            preds[user_id]["userType"].append(userType)
-
-    results_json = json.dumps(users_afinidad, ensure_ascii=False, indent=4)
-    json_object = json.loads(results_json)
+    # Si los datos han cambiado, los resultados se recalculan en un job en segundo plano y mientras tanto se
+    # devuelven los últimos (ver cached_bulk_results)
+    preds, etag, job_id = cached_bulk_results("users_matching")
+    if preds is None:
+        return not_modified(etag) if job_id is None else job_accepted(job_id)
 
     # Devolver la respuesta en formato JSON
-    return preds #jsonify(json_object)
+    return bulk_response_headers(jsonify(preds), etag, job_id)
+
+@app.route('/events_recommendations/<user_id>')
+def user_events_recommendations(user_id):
+    '''
+    API endpoint which returns the 3 most recommended events for a single user, with the same format of each user
+    in the response of /events_recommendations.
+
+    The results are not recomputed: they are the ones of the last call to /events_recommendations, which refreshes
+    them. Returns 404 if there are no results for the user.
+    '''
+    preds = results_store.get("events_recommendations", user_id)
+    if preds is None:
+        return jsonify({"error" : f"No events recommendations for user {user_id}"}), 404
+    return json.dumps(preds)
+
+@app.route('/match_users/<user_id>')
+def user_match_users(user_id):
+    '''
+    API endpoint which returns the 4 most similar users for a single user, with the same format of each user
+    in the response of /match_all_users.
+
+    The results are not recomputed: they are the ones of the last run of /match_all_users (or of its background
+    job). A user which is not in those results yet, but is in the local snapshot of the collections, is searched
+    in the LSH index of the users (see matching_users_index), in milliseconds. The app database is never read
+    here: a user which is not in the snapshot either gets 404, until the next job pulls the new users.
+    '''
+    preds = results_store.get("users_matching", user_id)
+    if preds is not None:
+        return json.dumps(preds)
+    snapshot = local_snapshot()
+    matches = match_user(snapshot, user_id) if len(snapshot.users) else None
+    if matches is None:
+        return jsonify({"error" : f"No matching users for user {user_id}"}), 404
+    return get_users_profiles(snapshot).matches(matches)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    '''
+    API endpoint with the metrics of the stages of the pipelines (calls, wall time, CPU time, rows and change of
+    the resident memory of each stage) in the Prometheus text format, to be scraped by Prometheus.
+    '''
+    lines = ["# HELP response_cache_lookups_total Lookups in the cache of the bulk endpoints, by result.",
+             "# TYPE response_cache_lookups_total counter"]
+    lines += [f'response_cache_lookups_total{{result="{result}"}} {count}' for result, count in response_cache.hits.items()]
+    return Response(metrics.prometheus() + "\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    '''
+    API endpoint which starts a background job to retrain a model and refresh its results, without waiting for it.
+
+    Accepts POST requests with the parameters "name" ("events_recommendations" or "users_matching", or
+    "mongo_sync" to only pull the changes of the app database) and "update_AWS_DB" (as in the bulk endpoints).
+    If a job with the same name is already queued or running, no new job is started. Returns 202 with the id of
+    the job, to poll its status in /jobs/<job_id>.
+    '''
+    name = request.args.get('name')
+    if name not in job_manager.tasks:
+        return jsonify({"error" : f"Unknown job {name}"}), 400
+    if name == "mongo_sync":
+        return job_accepted(job_manager.submit(name))
+    return job_accepted(job_manager.submit(name, update_AWS_DB=request.args.get('update_AWS_DB')))
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    '''
+    API endpoint which returns the status of a background job ("queued", "running", "finished" or "failed"),
+    with the times when it was created, started and finished and the error if it failed.
+    '''
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error" : f"Unknown job {job_id}"}), 404
+    return jsonify(job)
 
 if __name__ == '__main__':
+    # With gunicorn the artifacts are loaded and the scheduler started by gunicorn.conf.py, importing the module
+    # (tests, benchmark.py) loads nothing
+    preload_artifacts()
+    start_scheduler()
     app.run(debug=True, port=os.getenv("PORT", default=5000))
\ No newline at end of file
@@ -0,0 +1,510 @@
+import os
+import time
+import pickle
+import threading
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from matching_users_model import match_users, normalize_users_features
+from users_features import get_users_feature_encoder
+from global_variables import users_index_path
+
+def default_n_bits(n_users, bucket_size=64):
+    '''
+    Number of hyperplanes of the tables so that each bucket has about bucket_size users (between 1 and 16): with
+    few users the buckets stay big enough to find the most similar ones.
+    '''
+    return int(np.clip(np.round(np.log2(max(n_users, 1) / bucket_size)), 1, 16))
+
+class UsersLSHIndex:
+    '''
+    Approximate nearest neighbours index (random projection LSH) for matching users by cosine similarity.
+
+    Each user vector is scaled with the min/max of the dataset used to build the index (as MinMaxScaler does in
+    normalize_users_features) and normalized to unit length. Every table hashes the vector with the signs of
+    n_bits random hyperplanes, so similar users end up in the same buckets. A query only computes the cosine
+    similarity with the users in the buckets of the queried user, and adding, updating or removing a user only
+    touches his/her own buckets, without rebuilding the index.
+
+    The vectors are sparse (the one-hot features of a user are a few of the columns): the non zero values of all
+    the users are kept in two buffers (column and value), and each user points to his/her own values, so the
+    memory depends on the non zero values and not on users x columns. A user updated gets new values at the end
+    of the buffers, the old ones are dropped when they are more than the values in use (see _compact).
+
+    Parameters:
+    - columns : list
+        Names of the features (columns of create_training_df_userMatching without id_user and following).
+    - data_min, data_range : numpy.ndarray
+        Min and range of each feature, used to scale the vectors of the users.
+    - n_tables : int
+        Number of hash tables, more tables give higher recall and slower queries.
+    - n_bits : int
+        Number of hyperplanes of each table, more bits give smaller buckets and faster queries (from_dataset and
+        from_features choose it from the number of users, see default_n_bits).
+    - seed : int
+        Seed for the random hyperplanes.
+    '''
+
+    def __init__(self, columns, data_min, data_range, n_tables=16, n_bits=8, seed=42):
+        self.columns = list(columns)
+        self.data_min = np.asarray(data_min, dtype=np.float32)
+        self.data_range = np.asarray(data_range, dtype=np.float32)
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        self.hyperplanes = rng.normal(size=(n_tables, n_bits, len(self.columns))).astype(np.float32)
+        self.powers = 2**np.arange(n_bits, dtype=np.int64)
+
+        self.ids = []
+        self.user_index = {}
+        self.following = []
+        # Buffers with room for more users than n_users, grown geometrically (see _reserve): the position and
+        # number of the values of each user in indices/data, his/her codes and whether he/she is in the index
+        self.n_users = 0
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.nnz = np.zeros(0, dtype=np.int64)
+        self.codes = np.zeros((0, n_tables), dtype=np.int64)
+        self.active = np.zeros(0, dtype=bool)
+        # Non zero values of the vectors (column and value), n_values of them in use, also grown geometrically
+        self.n_values = 0
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.data = np.zeros(0, dtype=np.float32)
+        self.buckets = [{} for _ in range(n_tables)]
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        '''
+        Build the index with all the users of the dataset.
+
+        Input:
+        - dataset : pandas.DataFrame
+            Dataframe obtained from create_training_df_userMatching, with the column "sexo" already mapped to
+            numbers and the column "id_user" converted to str.
+        - kwargs : parameters n_tables, n_bits, seed of the index.
+
+        Output:
+        - index : UsersLSHIndex
+        '''
+        features = dataset.drop(["id_user", "following"], axis=1).astype(float)
+        data_min = features.min().values
+        data_range = features.max().values - data_min
+        # Same as MinMaxScaler, constant features are not scaled
+        data_range[data_range==0] = 1
+        kwargs.setdefault("n_bits", default_n_bits(len(dataset)))
+        index = cls(features.columns, data_min, data_range, **kwargs)
+        vectors = index._scale(features.values)
+        index._add_vectors(dataset["id_user"].tolist(), vectors, index._hash(vectors), dataset["following"].values)
+        return index
+
+    @classmethod
+    def from_features(cls, features, **kwargs):
+        '''
+        Build the index with all the users of the features built by UsersFeatureEncoder (missing age or gender
+        count as the minimum, as in normalize_users_features_sparse), keeping the one-hot features sparse.
+
+        Input:
+        - features : UsersFeatures
+            Features of the users.
+        - kwargs : parameters n_tables, n_bits, seed of the index.
+
+        Output:
+        - index : UsersLSHIndex
+        '''
+        data_min, data_range = features.min_max()
+        kwargs.setdefault("n_bits", default_n_bits(len(features)))
+        index = cls(features.columns, data_min, data_range, **kwargs)
+        vectors = index._scale_features(features)
+        index._add_vectors(features.ids, vectors, index._hash(vectors), features.following)
+        return index
+
+    @staticmethod
+    def _normalize(vectors):
+        # Unit length rows of a csr_matrix (the rows of zeros stay 0)
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        norms[norms==0] = 1
+        vectors = (sparse.diags((1 / norms).astype(np.float32)) @ vectors).tocsr()
+        vectors.eliminate_zeros()
+        return vectors
+
+    def _scale(self, values):
+        # Dense features (from_dataset, add_user) -> scaled unit vectors as a csr_matrix
+        vectors = (np.asarray(values, dtype=np.float32) - self.data_min) / self.data_range
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms==0] = 1
+        vectors /= norms
+        rows, columns = np.nonzero(vectors)
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(vectors)))))
+        return sparse.csr_matrix((vectors[rows, columns], columns.astype(np.int32), indptr), shape=vectors.shape)
+
+    def _scale_features(self, features):
+        '''
+        Scaled unit vectors (csr_matrix) of UsersFeatures, without building the dense users x columns matrix: the
+        missing age or gender become the min (0 once scaled), and the one-hot columns are only divided by their
+        range, except the ones whose min is not 0 (all the users of the index had them), which are not 0 for the
+        users without them: these few columns are scaled as a dense block and put in place.
+        '''
+        n_dense = features.n_dense
+        dense = np.nan_to_num((features.dense - self.data_min[:n_dense]) / self.data_range[:n_dense])
+        onehot_min, onehot_range = self.data_min[n_dense:], self.data_range[n_dense:]
+        shifted = np.flatnonzero(onehot_min != 0)
+        scale = np.where(onehot_min == 0, 1 / onehot_range, 0).astype(np.float32)
+        onehot = features.onehot.astype(np.float32) @ sparse.diags(scale)
+        vectors = sparse.hstack((sparse.csr_matrix(dense.astype(np.float32)), onehot), format="csr")
+        if len(shifted):
+            block = (features.onehot[:, shifted].toarray() - onehot_min[shifted]) / onehot_range[shifted]
+            placement = sparse.csr_matrix((np.ones(len(shifted), dtype=np.float32),
+                                           (np.arange(len(shifted)), n_dense + shifted)),
+                                          shape=(len(shifted), len(self.columns)))
+            vectors = (vectors + sparse.csr_matrix(block.astype(np.float32)) @ placement).tocsr()
+        return self._normalize(vectors)
+
+    def _hash(self, vectors, block_size=8192):
+        # Projections on all the hyperplanes (users, tables x n_bits), by blocks of users to bound the memory,
+        # then the signs of each table -> one integer code per user and table
+        planes = self.hyperplanes.reshape(-1, len(self.columns)).T
+        codes = np.zeros((vectors.shape[0], self.n_tables), dtype=np.int64)
+        for start in range(0, vectors.shape[0], block_size):
+            block = vectors if vectors.shape[0] <= block_size else vectors[start:start + block_size]
+            projections = np.asarray(block @ planes)
+            bits = projections.reshape(-1, self.n_tables, self.n_bits) > 0
+            codes[start:start + block_size] = bits.astype(np.int64) @ self.powers
+        return codes
+
+    def _reserve(self, n_users):
+        # Double the buffers when they are full, so adding users one by one costs O(1) amortized
+        if n_users <= len(self.active):
+            return
+        capacity = max(n_users, 2*len(self.active), 16)
+        for name in ("starts", "nnz", "codes", "active"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n_users] = old[:self.n_users]
+            setattr(self, name, new)
+
+    def _append_values(self, indices, data):
+        # Add values at the end of indices/data (doubling them when they are full), returns their position
+        start, end = self.n_values, self.n_values + len(indices)
+        if end > len(self.data):
+            capacity = max(end, 2*len(self.data), 1024)
+            for name in ("indices", "data"):
+                old = getattr(self, name)
+                new = np.zeros(capacity, dtype=old.dtype)
+                new[:start] = old[:start]
+                setattr(self, name, new)
+        self.indices[start:end] = indices
+        self.data[start:end] = data
+        self.n_values = end
+        return start
+
+    def _rows(self, rows):
+        '''
+        Vectors of the users in positions rows, as a csr_matrix (len(rows) x columns).
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        nnz = self.nnz[rows]
+        indptr = np.concatenate(([0], np.cumsum(nnz)))
+        positions = np.repeat(self.starts[rows] - indptr[:-1], nnz) + np.arange(indptr[-1])
+        return sparse.csr_matrix((self.data[positions], self.indices[positions], indptr),
+                                 shape=(len(rows), len(self.columns)))
+
+    def _compact(self):
+        # Drop the values of the users updated or removed, when they are more than the values in use
+        in_use = int(self.nnz[:self.n_users][self.active[:self.n_users]].sum())
+        if self.n_values <= 2*in_use:
+            return
+        self.nnz[:self.n_users][~self.active[:self.n_users]] = 0
+        vectors = self._rows(np.arange(self.n_users))
+        self.n_values = 0
+        self.starts[:self.n_users] = self._append_values(vectors.indices, vectors.data) + vectors.indptr[:-1]
+
+    def _add_to_buckets(self, row):
+        for table in range(self.n_tables):
+            self.buckets[table].setdefault(self.codes[row, table], set()).add(row)
+
+    def _remove_from_buckets(self, row):
+        for table in range(self.n_tables):
+            bucket = self.buckets[table].get(self.codes[row, table])
+            if bucket is not None:
+                bucket.discard(row)
+
+    def _add_vectors(self, users, vectors, codes, followings):
+        start, end = self.n_users, self.n_users + len(users)
+        self._reserve(end)
+        self.starts[start:end] = self._append_values(vectors.indices, vectors.data) + vectors.indptr[:-1]
+        self.nnz[start:end] = np.diff(vectors.indptr)
+        self.codes[start:end] = codes
+        self.active[start:end] = True
+        self.n_users = end
+        for row, user, following in zip(range(start, end), users, followings):
+            self.ids.append(user)
+            self.user_index[user] = row
+            self.following.append({str(x) for x in following})
+            self._add_to_buckets(row)
+
+    def _update_vector(self, row, vector, code, following):
+        # vector: csr_matrix with one row
+        self._remove_from_buckets(row)
+        self.starts[row] = self._append_values(vector.indices, vector.data)
+        self.nnz[row] = vector.nnz
+        self.codes[row] = code
+        self.following[row] = {str(x) for x in following}
+        self.active[row] = True
+        self._add_to_buckets(row)
+
+    def features_vector(self, features):
+        '''
+        Order a dict/Series of features of a user as the columns of the index. Missing features are 0, and the
+        features that were not in the dataset used to build the index (for instance a new degree) are ignored.
+        '''
+        return np.array([[float(features.get(column, 0)) for column in self.columns]])
+
+    def add_user(self, user_id, features, following=()):
+        '''
+        Add a new user to the index, or update his/her vector and following if the user is already there.
+
+        Input:
+        - user_id : str
+            Id of the user.
+        - features : dict or pandas.Series
+            Features of the user with the same names of the columns of create_training_df_userMatching.
+        - following : list
+            Ids of the users he/she is already following.
+        '''
+        user_id = str(user_id)
+        vector = self._scale(self.features_vector(features))
+        row = self.user_index.get(user_id)
+        if row is None:
+            self._add_vectors([user_id], vector, self._hash(vector), [following])
+        else:
+            self._update_vector(row, vector, self._hash(vector)[0], following)
+            self._compact()
+
+    def remove_user(self, user_id):
+        '''
+        Remove a user from the index, so that he/she is not recommended anymore.
+        '''
+        row = self.user_index.get(str(user_id))
+        if row is not None and self.active[row]:
+            self._deactivate(row)
+            self._compact()
+
+    def _deactivate(self, row):
+        self._remove_from_buckets(row)
+        self.active[row] = False
+
+    def sync(self, features):
+        '''
+        Update the index to the features of all the users (built by UsersFeatureEncoder with the same columns of
+        the index): the new users are added, the users whose features or following changed are updated and the
+        users which are not in features anymore are removed. The other users do not touch the buckets.
+
+        Output:
+        - changes : dict
+            Number of users added, updated and removed.
+        '''
+        vectors = self._scale_features(features)
+        rows = np.array([self.user_index.get(user, -1) for user in features.ids], dtype=np.int64)
+        known = np.flatnonzero(rows >= 0)
+        # Rows with some value different from the one in the index (the vectors are compared sparse)
+        difference = self._rows(rows[known]) - vectors[known]
+        difference.eliminate_zeros()
+        changed = known[(np.diff(difference.indptr) > 0) | ~self.active[rows[known]]]
+        changed = set(changed.tolist())
+        for i in known.tolist():
+            if i not in changed and {str(x) for x in features.following[i]} != self.following[rows[i]]:
+                changed.add(i)
+        changed = sorted(changed)
+        codes = self._hash(vectors[changed])
+        for i, code in zip(changed, codes):
+            self._update_vector(rows[i], vectors[i], code, features.following[i])
+        new = np.flatnonzero(rows < 0)
+        self._add_vectors([features.ids[i] for i in new], vectors[new], self._hash(vectors[new]),
+                          [features.following[i] for i in new])
+        present = set(features.ids)
+        removed = [user for user in self.ids if user not in present and self.active[self.user_index[user]]]
+        for user in removed:
+            self._deactivate(self.user_index[user])
+        self._compact()
+        return {"added" : len(new), "updated" : len(changed), "removed" : len(removed)}
+
+    def _candidates(self, row):
+        candidates = set()
+        for table in range(self.n_tables):
+            candidates |= self.buckets[table].get(self.codes[row, table], set())
+        return candidates
+
+    def __contains__(self, user_id):
+        row = self.user_index.get(str(user_id))
+        return row is not None and bool(self.active[row])
+
+    def query(self, user_id, n_matches=4):
+        '''
+        Return the n_matches most similar users to user_id, that he/she is not already following.
+        If there are not enough candidates in the buckets of the user, the similarity is computed with all the
+        users, so the result is always complete.
+
+        Input:
+        - user_id : str
+            Id of the user.
+        - n_matches : int
+            Number of users to recommend.
+
+        Output:
+        - usuarios_afines : list
+            Ids of the recommended users, sorted by similarity.
+        '''
+        row = self.user_index[str(user_id)]
+        excluded = self.following[row]
+        candidates = [c for c in self._candidates(row)
+                      if c != row and self.active[c] and self.ids[c] not in excluded]
+        if len(candidates) < n_matches:
+            candidates = [c for c in np.flatnonzero(self.active[:self.n_users])
+                          if c != row and self.ids[c] not in excluded]
+        if not candidates:
+            return []
+        candidates = np.asarray(candidates)
+        similitudes = self._rows(candidates) @ self._rows([row]).toarray()[0]
+        k = min(n_matches, len(candidates))
+        top = np.argpartition(-similitudes, k - 1)[:k]
+        top = top[np.argsort(-similitudes[top], kind="stable")]
+        return [self.ids[c] for c in candidates[top]]
+
+    def save(self, path):
+        '''
+        Save the index in a pickle file (written in a tmp file then renamed). The buckets are not saved, they are
+        rebuilt from the codes when loading.
+        '''
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        state = {key : value for key, value in self.__dict__.items() if key != "buckets"}
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump(state, file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load an index saved with save.
+        '''
+        with open(path, "rb") as file:
+            state = pickle.load(file)
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        index.buckets = [{} for _ in range(index.n_tables)]
+        for row in np.flatnonzero(index.active[:index.n_users]):
+            index._add_to_buckets(row)
+        return index
+
+# Index of the users of the current snapshot, shared by the requests of the process
+_users_index = None
+_users_index_lock = threading.RLock()
+
+def get_users_index(snapshot, features=None, path=users_index_path):
+    '''
+    Return the UsersLSHIndex of the users of a DataSnapshot. It is kept in memory and, when the version of the
+    snapshot changes, updated with UsersLSHIndex.sync instead of being built again. The first time, the index
+    saved in path (see save_users_index) is loaded and synced, if it has the columns of the catalogs of the
+    snapshot.
+
+    Input:
+    - snapshot : DataSnapshot
+        Collections of the app database.
+    - features : UsersFeatures
+        Features of the users of snapshot, if they are already encoded.
+    - path : str
+        Pickle file of the index (USERS_INDEX_PATH).
+    '''
+    global _users_index
+    with _users_index_lock:
+        if _users_index is not None and _users_index[0] == snapshot.version:
+            return _users_index[1]
+        if features is None:
+            features = get_users_feature_encoder(snapshot).transform(snapshot.users)
+        index = _users_index[1] if _users_index is not None else None
+        if index is None and os.path.exists(path):
+            index = UsersLSHIndex.load(path)
+        if index is not None and index.columns == features.columns:
+            index.sync(features)
+        else:
+            # First index, or the catalogs of degrees, hobbies or skills changed (other columns)
+            index = UsersLSHIndex.from_features(features)
+        _users_index = (snapshot.version, index)
+        return index
+
+def save_users_index(snapshot, features=None, path=users_index_path):
+    '''
+    Update the index to snapshot (see get_users_index) and save it in path, for the processes started later.
+    '''
+    with _users_index_lock:
+        get_users_index(snapshot, features, path).save(path)
+
+def match_user(snapshot, user_id, n_matches=4):
+    '''
+    Ids of the n_matches most similar users to user_id with the index of snapshot (see UsersLSHIndex.query),
+    None if the user is not in snapshot.
+    '''
+    with _users_index_lock:
+        index = get_users_index(snapshot)
+        if user_id not in index:
+            return None
+        return index.query(user_id, n_matches)
+
+
+def benchmark_recall(dataset, n_matches=4, n_queries=None, **kwargs):
+    '''
+    Compare the recommendations of UsersLSHIndex with the exact ones of match_users (the cosine_similarity path).
+    A recommended user counts as correct if his/her similarity is at least the similarity of the last exact
+    match, so that users with the same similarity (ties) are not counted as errors.
+
+    Input:
+    - dataset : pandas.DataFrame
+        Dataframe obtained from create_training_df_userMatching, with the column "sexo" already mapped to
+        numbers and the column "id_user" converted to str.
+    - n_matches : int
+        Number of users to recommend.
+    - n_queries : int
+        Number of users to query, all the users if None.
+    - kwargs : parameters n_tables, n_bits, seed of the index.
+
+    Output:
+    - results : dict
+        Recall, mean and p99 query time in milliseconds, and time to build the index in seconds.
+    '''
+    start = time.perf_counter()
+    index = UsersLSHIndex.from_dataset(dataset, **kwargs)
+    build_time = time.perf_counter() - start
+
+    exact = match_users(dataset, n_matches=n_matches)
+    features = normalize_users_features(dataset)
+    users = dataset["id_user"].tolist()
+    if n_queries is not None:
+        users = users[:n_queries]
+
+    found, total, times = 0, 0, []
+    for user in users:
+        start = time.perf_counter()
+        approx = index.query(user, n_matches)
+        times.append(time.perf_counter() - start)
+        if not exact[user]:
+            continue
+        row = index.user_index[user]
+        threshold = features[index.user_index[exact[user][-1]]] @ features[row] - 1e-6
+        found += sum(features[index.user_index[x]] @ features[row] >= threshold for x in approx)
+        total += len(exact[user])
+    times = np.asarray(times)*1000
+    return {"recall" : found/total if total else 1.0, "query_ms_mean" : times.mean(),
+            "query_ms_p99" : np.percentile(times, 99), "build_s" : build_time}
+
+
+if __name__ == "__main__":
+    # Recall and latency on random users with one-hot features, as the ones of create_training_df_userMatching
+    rng = np.random.RandomState(42)
+    n_users = 20000
+    dataset = pd.DataFrame(rng.binomial(1, 0.1, size=(n_users, 60)), columns=[f"feature_{i}" for i in range(60)])
+    dataset.insert(0, "id_user", [str(i) for i in range(n_users)])
+    dataset.insert(1, "edad", rng.randint(18, 46, n_users))
+    dataset.insert(2, "sexo", rng.randint(0, 3, n_users))
+    dataset.insert(3, "following", [[str(x) for x in rng.randint(0, n_users, 3)] for _ in range(n_users)])
+    print(benchmark_recall(dataset, n_queries=1000))
@@ -0,0 +1,165 @@
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import MinMaxScaler, normalize
+
+from users_features import UsersFeatures
+
+def normalize_users_features(dataset):
+    '''
+    Scale the features of the users matching dataset between 0 and 1 and normalize each user vector to unit
+    length, so that the cosine similarity between users is just the dot product between their vectors.
+    The scaler is fitted only once on the whole dataset.
+
+    Input:
+    - dataset : pandas.DataFrame
+        Dataframe obtained from create_training_df_userMatching, with the column "sexo" already mapped to numbers.
+
+    Output:
+    - features : numpy.ndarray
+        Matrix users x features (float32) with the normalized vectors of the users.
+    '''
+    features = MinMaxScaler().fit_transform(dataset.drop(["id_user", "following"], axis=1).astype(float))
+    return normalize(features).astype(np.float32)
+
+def normalize_users_features_sparse(features):
+    '''
+    Same as normalize_users_features for the features built by UsersFeatureEncoder, keeping the one-hot block
+    sparse: the features are scaled between 0 and 1 and each user vector is normalized to unit length.
+
+    Input:
+    - features : UsersFeatures
+        Features of the users.
+
+    Output:
+    - dense : numpy.ndarray
+        Matrix users x dense features (float32) of the normalized vectors.
+    - onehot : scipy.sparse.csr_matrix
+        Matrix users x one-hot features (float32) of the normalized vectors.
+    '''
+    dense, onehot = features.scaled()
+    norms = np.sqrt((dense**2).sum(axis=1) + np.asarray(onehot.multiply(onehot).sum(axis=1)).ravel())
+    norms[norms==0] = 1
+    dense = (dense / norms[:, None]).astype(np.float32)
+    onehot = (sparse.diags(1/norms) @ onehot).astype(np.float32).tocsr()
+    return dense, onehot
+
+def following_mask(users, followings):
+    '''
+    Build the sparse users x users matrix with 1 where the user of the row already follows the user of the column.
+    The ids that are not in users (for instance deleted users) are ignored.
+
+    Input:
+    - users : list
+        List with the ids (str) of the users, in the same order of the rows of the features matrix.
+    - followings : iterable
+        For each user, the list with the ids of the users he/she is already following.
+
+    Output:
+    - mask : scipy.sparse.csr_matrix
+        Boolean users x users matrix with the users to exclude from the matching.
+    '''
+    user_index = {user : i for i, user in enumerate(users)}
+    rows, cols = [], []
+    for i, following in enumerate(followings):
+        for followed in following:
+            j = user_index.get(str(followed))
+            if j is not None:
+                rows.append(i)
+                cols.append(j)
+    return sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(users), len(users)))
+
+def match_users(dataset, n_matches=4, max_block_bytes=64*1024**2, return_scores=False):
+    '''
+    Find for each user the n_matches most similar users (cosine similarity) that he/she is not already following.
+
+    The features are normalized only once, and the similarities are computed in blocks of rows, so that at most
+    max_block_bytes are used for the similarity matrix of a block and the full users x users matrix is never
+    built. In each block the user itself and the users in "following" are masked out, and the top n_matches
+    are selected with argpartition. Among the users with the same similarity the first ones (in the order of the
+    dataset) are recommended, so the results do not depend on the blocks nor on argpartition.
+
+    With the UsersFeatures of UsersFeatureEncoder, the similarities of the one-hot block are computed with sparse
+    products, and only the block of similarities is dense.
+
+    Input:
+    - dataset : UsersFeatures or pandas.DataFrame
+        Features from UsersFeatureEncoder, or dataframe obtained from create_training_df_userMatching, with the
+        column "sexo" already mapped to numbers and the column "id_user" converted to str.
+    - n_matches : int
+        Number of users to recommend to each user.
+    - max_block_bytes : int
+        Maximum memory used for the block of similarities computed at once.
+    - return_scores : bool
+        If True, also return the similarities of the recommended users.
+
+    Output:
+    - users_afinidad : dict
+        Dictionary with the id of each user as key and the list of the ids of the recommended users, sorted by
+        similarity, as value.
+    - users_scores : dict
+        Only if return_scores is True. Dictionary with the id of each user as key and the list of the
+        similarities of his/her recommended users (in the same order) as value.
+    '''
+    if isinstance(dataset, UsersFeatures):
+        users, followings = dataset.ids, dataset.following
+    else:
+        users, followings = dataset["id_user"].tolist(), dataset["following"].values
+    n_users = len(users)
+    if n_users == 0:
+        return ({}, {}) if return_scores else {}
+    features = None
+    if isinstance(dataset, UsersFeatures):
+        dense, onehot = normalize_users_features_sparse(dataset)
+        n_cells = onehot.shape[0]*onehot.shape[1]
+        if onehot.nnz > 0.05*n_cells:
+            # With few degrees, hobbies and skills the one-hot block is not really sparse, and the dense matrix
+            # (small in this case) with BLAS is faster
+            features = np.hstack((dense, onehot.toarray()))
+    else:
+        features = normalize_users_features(dataset)
+    if features is None:
+        # Sparse x dense product: the one-hot vectors of the block are dense (features x block), so the cost is
+        # proportional to the non zeros of all the users times the size of the block
+        def similarity(start, end):
+            similitudes = np.ascontiguousarray((onehot @ onehot[start:end].T.toarray()).T)
+            similitudes += dense[start:end] @ dense.T
+            return similitudes
+    else:
+        similarity = lambda start, end: features[start:end] @ features.T
+    mask = following_mask(users, followings)
+    users_array = np.asarray(users, dtype=object)
+
+    k = min(n_matches, n_users)
+    block_size = int(max(1, max_block_bytes // (np.dtype(np.float32).itemsize*n_users)))
+    users_afinidad, users_scores = {}, {}
+    for start in range(0, n_users, block_size):
+        end = min(start + block_size, n_users)
+        rows = np.arange(end - start)
+        similitudes = similarity(start, end)
+        # Exclude the user itself and the users he/she is already following
+        similitudes[rows, rows + start] = -np.inf
+        mask_rows, mask_cols = mask[start:end].nonzero()
+        similitudes[mask_rows, mask_cols] = -np.inf
+
+        top = np.argpartition(similitudes, n_users - k, axis=1)[:, n_users - k:]
+        #If other users have the same similarity of the k-th best one, take the first ones (as a stable sort does)
+        kth = np.take_along_axis(similitudes, top, axis=1).min(axis=1, keepdims=True)
+        equal = similitudes == kth
+        ties = np.flatnonzero(equal.sum(axis=1) > (np.take_along_axis(similitudes, top, axis=1) == kth).sum(axis=1))
+        if len(ties):
+            needed = k - (similitudes[ties] > kth[ties]).sum(axis=1, keepdims=True)
+            selected = (similitudes[ties] > kth[ties]) | (equal[ties] & (np.cumsum(equal[ties], axis=1) <= needed))
+            top[ties] = np.nonzero(selected)[1].reshape(len(ties), k)
+        #sort by similarity, and by the order of the users among the users with the same similarity
+        top.sort(axis=1)
+        top_similitudes = np.take_along_axis(similitudes, top, axis=1)
+        order = np.argsort(-top_similitudes, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_similitudes = np.take_along_axis(top_similitudes, order, axis=1)
+        for i in rows:
+            valid = np.isfinite(top_similitudes[i])
+            users_afinidad[users[start + i]] = users_array[top[i][valid]].tolist()
+            users_scores[users[start + i]] = top_similitudes[i][valid].astype(float).tolist()
+    if return_scores:
+        return users_afinidad, users_scores
+    return users_afinidad
@@ -0,0 +1,122 @@
+import numpy as np
+from scipy import sparse
+
+def _solve_rows(targets, mask, designs, reg, max_block_bytes=64*1024**2):
+    '''
+    Ridge regression of every row of targets on the same designs: for each row r, the x_r which minimizes
+    sum_c mask[r, c]*(targets[r, c] - designs[c]·x_r)^2 + reg*|x_r|^2.
+
+    Input:
+    - targets : numpy.ndarray
+        Matrix rows x cols with the values to fit.
+    - mask : numpy.ndarray
+        Matrix rows x cols with 1 for the observed values and 0 for the missing ones, None if all are observed.
+    - designs : numpy.ndarray
+        Matrix cols x d with the features of each column.
+    - reg : float
+        Regularization.
+    - max_block_bytes : int
+        Maximum memory used for the normal equations of a block of rows (with a mask every row has its own).
+
+    Output:
+    - x : numpy.ndarray
+        Matrix rows x d with the solution of each row.
+    '''
+    d = designs.shape[1]
+    ridge = reg*np.eye(d)
+    if mask is None:
+        # All the rows share the same normal equations, a single solve for all of them
+        return np.linalg.solve(designs.T @ designs + ridge, designs.T @ targets.T).T
+    x = np.empty((len(targets), d))
+    if len(designs) < d:
+        # Less columns than features (few cluster tags and many factors): dual form, a system of the size of the
+        # columns per row, x_r = designs.T @ alpha_r with (M_r G M_r + reg I) alpha_r = M_r targets_r, where
+        # G = designs @ designs.T and M_r the diagonal of the mask of the row
+        gram = designs @ designs.T
+        eye = reg*np.eye(len(designs))
+        block_size = int(max(1, max_block_bytes // (8*len(designs)**2)))
+        for start in range(0, len(targets), block_size):
+            end = min(start + block_size, len(targets))
+            block_mask = mask[start:end]
+            kernel = block_mask[:, :, None]*gram[None, :, :]*block_mask[:, None, :] + eye
+            alpha = np.linalg.solve(kernel, (targets[start:end]*block_mask)[:, :, None])[:, :, 0]
+            x[start:end] = alpha @ designs
+        return x
+    rhs = (targets*mask) @ designs
+    if len(targets) <= len(designs):
+        # Few rows with many columns (the cluster tags in the users step): one product per row
+        normal = np.stack([(designs*row_mask[:, None]).T @ designs for row_mask in mask]) + ridge
+        return np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+    # Many rows with few columns (the users): the normal equations of a row are the sum of the outer products of
+    # the features of its observed columns, mask @ outer products for a block of rows at once
+    outer = np.einsum("cd,ce->cde", designs, designs).reshape(len(designs), d*d)
+    block_size = int(max(1, max_block_bytes // (8*d*d)))
+    for start in range(0, len(targets), block_size):
+        end = min(start + block_size, len(targets))
+        normal = (mask[start:end] @ outer).reshape(end - start, d, d) + ridge
+        x[start:end] = np.linalg.solve(normal, rhs[start:end, :, None])[:, :, 0]
+    return x
+
+def fit_biased_ALS(ratings, n_factors, mask=None, n_epochs=10, reg=20, init_std=0.1, random_state=42):
+    '''
+    Biased matrix factorization, the model of surprise's SVD (rating = global mean + bu + bi + pu·qi), fitted
+    with alternating least squares directly on the users x items matrix: each epoch solves the factors and
+    biases of all the users with the ones of the items fixed, and then the ones of the items. Every step is a
+    ridge regression solved with numpy, so there is no loop over the ratings.
+
+    Input:
+    - ratings : numpy.ndarray or scipy.sparse matrix
+        Matrix users x items. If it is sparse, only its stored values are observed.
+    - n_factors : int
+        Number of factors.
+    - mask : numpy.ndarray
+        Matrix users x items with True for the observed ratings, None if all the ratings are observed (or they
+        are the stored values of a sparse ratings).
+    - n_epochs : int
+        Number of alternations.
+    - reg : float
+        Regularization of factors and biases, on the sum of the squared errors of each user (and item), not per
+        rating as in surprise: the 9 cluster tags need a much higher value than the 0.02 of SVD.
+    - init_std : float
+        Standard deviation of the initial factors of the items.
+    - random_state : int
+        Seed of the initial factors.
+
+    Output:
+    - model : dict
+        Factors of the users (pu) and of the items (qi), biases (bu, bi) and global mean.
+    '''
+    if sparse.issparse(ratings):
+        ratings = sparse.csr_matrix(ratings)
+        mask = (sparse.csr_matrix((np.ones(ratings.nnz), ratings.indices, ratings.indptr), shape=ratings.shape)
+                .toarray())
+        ratings = ratings.toarray()
+    ratings = np.asarray(ratings, dtype=np.float64)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=np.float64)
+    n_users, n_items = ratings.shape
+    global_mean = float(ratings.mean() if mask is None else (ratings*mask).sum() / max(1, mask.sum()))
+
+    rng = np.random.RandomState(random_state)
+    qi = rng.normal(0, init_std, (n_items, n_factors))
+    bi = np.zeros(n_items)
+    centered = ratings - global_mean
+    for _ in range(n_epochs):
+        # Users: [pu, bu] from the features [qi, 1] of the items
+        x = _solve_rows(centered - bi[None, :], mask, np.column_stack((qi, np.ones(n_items))), reg)
+        pu, bu = x[:, :-1], x[:, -1]
+        # Items: [qi, bi] from the features [pu, 1] of the users
+        y = _solve_rows((centered - bu[:, None]).T, None if mask is None else mask.T,
+                        np.column_stack((pu, np.ones(n_users))), reg)
+        qi, bi = y[:, :-1], y[:, -1]
+    return {"pu" : np.ascontiguousarray(pu), "qi" : np.ascontiguousarray(qi), "bu" : bu, "bi" : bi,
+            "global_mean" : np.float64(global_mean)}
+
+def predict_ratings(model, rating_scale=None):
+    '''
+    Ratings of all the users for all the items (global mean + biases + pu·qi), clipped to rating_scale if given.
+    '''
+    scores = model["global_mean"] + model["bu"][:, None] + model["bi"][None, :] + model["pu"] @ model["qi"].T
+    if rating_scale is not None:
+        scores = np.clip(scores, rating_scale[0], rating_scale[1])
+    return scores
@@ -0,0 +1,247 @@
+import os
+import json
+import shutil
+import datetime
+import numpy as np
+
+class ModelRegistry:
+    '''
+    Versioned store of trained models. Each version of a model is a directory root/<name>/v<version> with one .npy
+    file per array of the model (loaded memory-mapped, so loading a model costs milliseconds whatever its size)
+    and a metadata.json with the scalar attributes of the model, its metrics, parameters and the fingerprint of
+    the data used to train it. The file root/<name>/CURRENT has the version in use: registering a model makes it
+    the current one, and a rollback only rewrites this file. A rollback also pins the version in CURRENT, so that
+    the trainings do not replace it (see pinned) until it is unpinned (unpin) or a model is registered by hand.
+
+    Parameters:
+    - root : str
+        Directory of the registry.
+    - keep_versions : int
+        Number of versions of each model kept on disk (the current one is never deleted). None to keep all.
+    '''
+
+    def __init__(self, root="models/registry", keep_versions=10):
+        self.root = root
+        self.keep_versions = keep_versions
+
+    def _model_dir(self, name):
+        return os.path.join(self.root, name)
+
+    def _version_dir(self, name, version):
+        return os.path.join(self.root, name, f"v{int(version)}")
+
+    def versions(self, name):
+        '''
+        Return the versions of the model name saved in the registry, sorted.
+        '''
+        try:
+            entries = os.listdir(self._model_dir(name))
+        except FileNotFoundError:
+            return []
+        return sorted(int(entry[1:]) for entry in entries if entry.startswith("v") and entry[1:].isdigit())
+
+    def _current(self, name):
+        # {"version" : int, "pinned" : bool}, CURRENT may also have only the version (written before the pins)
+        try:
+            with open(os.path.join(self._model_dir(name), "CURRENT"), encoding="utf-8") as file:
+                text = file.read().strip()
+        except FileNotFoundError:
+            return None
+        if text.startswith("{"):
+            return json.loads(text)
+        return {"version" : int(text), "pinned" : False}
+
+    def current_version(self, name):
+        '''
+        Return the version in use of the model name, or None if there is none.
+        '''
+        current = self._current(name)
+        return None if current is None else int(current["version"])
+
+    def pinned(self, name):
+        '''
+        Return True if the version in use of the model name is pinned (after a rollback): the trainings must keep
+        it instead of registering a new version.
+        '''
+        current = self._current(name)
+        return current is not None and bool(current.get("pinned"))
+
+    def set_current(self, name, version, pinned=False):
+        '''
+        Make version the version in use of the model name, pinned or not.
+        '''
+        if not os.path.isdir(self._version_dir(name, version)):
+            raise KeyError(f"Version {version} of the model {name} does not exist")
+        path = os.path.join(self._model_dir(name), "CURRENT")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"version" : int(version), "pinned" : bool(pinned)}, file)
+        os.replace(tmp_path, path)
+
+    def unpin(self, name):
+        '''
+        Let the trainings replace the version in use of the model name again. Returns the version in use.
+        '''
+        version = self.current_version(name)
+        if version is not None:
+            self.set_current(name, version)
+        return version
+
+    def register(self, name, model, metadata=None):
+        '''
+        Save a new version of the model name and make it the current one.
+
+        Input:
+        - name : str
+            Name of the model.
+        - model : dict
+            Arrays of the model. The numpy arrays with at least one dimension are saved as .npy files, the other
+            values (scalars, str) in the metadata.
+        - metadata : dict
+            Information about the model saved with it (metrics, parameters, fingerprint...), json serializable.
+
+        Output:
+        - version : int
+            Version of the saved model.
+        '''
+        model_dir = self._model_dir(name)
+        os.makedirs(model_dir, exist_ok=True)
+        tmp_dir = os.path.join(model_dir, f"tmp.{os.getpid()}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        attributes = {}
+        for key, value in model.items():
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                np.save(os.path.join(tmp_dir, f"{key}.npy"), value)
+            else:
+                attributes[key] = value.item() if isinstance(value, (np.ndarray, np.generic)) else value
+        info = dict(metadata or {}, name=name, attributes=attributes, created_at=str(datetime.datetime.now()))
+        # The directory is renamed to the first free version, so two processes never write the same version
+        while True:
+            version = max(self.versions(name), default=0) + 1
+            info["version"] = version
+            with open(os.path.join(tmp_dir, "metadata.json"), "w", encoding="utf-8") as file:
+                json.dump(info, file, indent=4)
+            try:
+                os.rename(tmp_dir, self._version_dir(name, version))
+                break
+            except OSError:
+                if not os.path.isdir(self._version_dir(name, version)):
+                    raise
+        self.set_current(name, version)
+        self.prune(name)
+        return version
+
+    def metadata(self, name, version=None):
+        '''
+        Return the metadata of a version of the model name (by default the current one).
+        '''
+        version = self.current_version(name) if version is None else version
+        if version is None:
+            return None
+        with open(os.path.join(self._version_dir(name, version), "metadata.json"), encoding="utf-8") as file:
+            return json.load(file)
+
+    def load(self, name, version=None, mmap=True):
+        '''
+        Load a version of the model name (by default the current one).
+
+        Input:
+        - name : str
+            Name of the model.
+        - version : int
+            Version to load, None for the current one.
+        - mmap : bool
+            If True the arrays are memory-mapped read-only instead of read in memory.
+
+        Output:
+        - model : dict
+            Arrays and attributes of the model, as passed to register, with the key "version". None if the model
+            has no version.
+        '''
+        info = self.metadata(name, version)
+        if info is None:
+            return None
+        version_dir = self._version_dir(name, info["version"])
+        model = {}
+        for file_name in sorted(os.listdir(version_dir)):
+            if file_name.endswith(".npy"):
+                model[file_name[:-4]] = np.load(os.path.join(version_dir, file_name), mmap_mode="r" if mmap else None)
+        model.update(info["attributes"])
+        model["version"] = info["version"]
+        return model
+
+    def rollback(self, name, version=None):
+        '''
+        Go back to a previous version of the model name: version if given, otherwise the version before the
+        current one. The version is pinned (see pinned), otherwise the next training would replace it again with
+        a model of the current data. Returns the version now in use.
+        '''
+        if version is None:
+            current = self.current_version(name)
+            previous = [v for v in self.versions(name) if current is None or v < current]
+            if not previous:
+                raise KeyError(f"There is no version of the model {name} before {current}")
+            version = previous[-1]
+        self.set_current(name, version, pinned=True)
+        return int(version)
+
+    def prune(self, name):
+        '''
+        Delete the oldest versions of the model name, keeping the last keep_versions and the current one.
+        '''
+        if self.keep_versions is None:
+            return
+        current = self.current_version(name)
+        versions = self.versions(name)
+        for version in versions[:max(0, len(versions) - self.keep_versions)]:
+            if version != current:
+                shutil.rmtree(self._version_dir(name, version), ignore_errors=True)
+
+def load_history(path="history_models.json"):
+    '''
+    Read the history of the trained models, a json list. The old files, with the json objects written one after
+    the other without separator ({"date" : {...}}{"date" : {...}}), are read as well.
+    '''
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as file:
+        text = file.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    history, position, decoder = [], 0, json.JSONDecoder()
+    while position < len(text):
+        entry, position = decoder.raw_decode(text, position)
+        history += [dict(date=date, **summary) for date, summary in entry.items()]
+        while position < len(text) and text[position].isspace():
+            position += 1
+    return history
+
+def append_history(summary, path="history_models.json"):
+    '''
+    Add the summary of a trained model to the history of the models (json list, written in a tmp file then
+    renamed).
+    '''
+    history = load_history(path) + [summary]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(history, file, indent=4)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    # python model_registry.py list <name> | rollback <name> [version] | unpin <name>
+    import sys
+    registry = ModelRegistry(os.getenv("MODELS_REGISTRY_PATH", default="models/registry"))
+    command, name = sys.argv[1], sys.argv[2]
+    if command == "list":
+        current = registry.current_version(name)
+        for version in registry.versions(name):
+            info = registry.metadata(name, version)
+            print(("* " if version == current else "  ") + f"v{version} {info['created_at']} "
+                  + json.dumps(info.get("metrics", {})) + (" (pinned)" if version == current and registry.pinned(name) else ""))
+    elif command == "rollback":
+        print(f"Current version of {name}: v{registry.rollback(name, int(sys.argv[3]) if len(sys.argv) > 3 else None)} (pinned)")
+    elif command == "unpin":
+        print(f"Current version of {name}: v{registry.unpin(name)}, the next training replaces it")
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+from joblib import Parallel, delayed
+
+from surprise import SVD, accuracy
+from surprise.model_selection import KFold, GridSearchCV
+
+from matrix_factorization import fit_biased_ALS, predict_ratings
+
+def _fit_and_score(n_factors, trainset, testset, random_state):
+    '''
+    Fit a SVD model with n_factors on trainset and return its rmse and mae on testset.
+    '''
+    model = SVD(n_factors=n_factors, random_state=random_state)
+    model.fit(trainset)
+    predictions = model.test(testset)
+    return accuracy.rmse(predictions, verbose=False), accuracy.mae(predictions, verbose=False)
+
+def _fit_and_score_ALS(ratings, test, n_factors, reg, rating_scale, random_state):
+    '''
+    Fit fit_biased_ALS with n_factors and reg on the ratings out of test (positions in ratings.ravel()) and
+    return its rmse and mae on the ratings of test.
+    '''
+    mask = np.ones(ratings.size)
+    mask[test] = 0
+    model = fit_biased_ALS(ratings, n_factors, mask=mask.reshape(ratings.shape), reg=reg, random_state=random_state)
+    errors = predict_ratings(model, rating_scale).ravel()[test] - ratings.ravel()[test]
+    return np.sqrt(np.mean(errors**2)), np.mean(np.abs(errors))
+
+def successive_halving_SVD(data, n_factors_grid=range(1, 50), cv=5, eta=3, budget_seconds=120, n_jobs=-1,
+                           random_state=42):
+    '''
+    Search the best n_factors of the SVD model with successive halving: in the first round all the candidates
+    are evaluated on 1 fold, then only the best 1/eta of them are evaluated on more folds, and so on until the
+    survivors are evaluated on all the cv folds. The fits of each round run in parallel in a pool of processes.
+    If budget_seconds is over, no new round is started and the best candidate among the ones evaluated on more
+    folds is returned.
+
+    Input:
+    - data : surprise.Dataset
+      This is the Dataset object used in the surprise library to train the models.
+    - n_factors_grid : iterable
+      Values of n_factors to try.
+    - cv : int
+      Number of folds of the cross validation.
+    - eta : int
+      At each round only 1/eta of the candidates survive.
+    - budget_seconds : float
+      Wall clock time after which no new round is started. None for no limit.
+    - n_jobs : int
+      Number of processes for the fits (-1 for all the cores).
+    - random_state : int
+      Seed for the folds and for the SVD models.
+
+    Output:
+    - search_results : dict
+      Dictionary with best_params, best_score (rmse and mae on the folds where the best model was evaluated),
+      number of folds of the best model, number of fits, time and whether the search completed within budget.
+    '''
+    start = time.perf_counter()
+    folds = list(KFold(n_splits=cv, random_state=random_state, shuffle=True).split(data))
+    candidates = sorted({int(n) for n in n_factors_grid if n > 0})
+    scores = {n : [] for n in candidates}
+    n_folds, n_fits, completed = 1, 0, True
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while True:
+            tasks = [(n, fold) for n in candidates for fold in range(len(scores[n]), n_folds)]
+            results = parallel(delayed(_fit_and_score)(n, *folds[fold], random_state) for n, fold in tasks)
+            for (n, _), result in zip(tasks, results):
+                scores[n].append(result)
+            n_fits += len(tasks)
+            if n_folds == cv or len(candidates) == 1:
+                break
+            if budget_seconds is not None and time.perf_counter() - start > budget_seconds:
+                completed = False
+                break
+            candidates = sorted(candidates, key=lambda n: np.mean([s[0] for s in scores[n]]))
+            candidates = candidates[:max(1, len(candidates)//eta)]
+            n_folds = min(cv, n_folds*eta)
+
+    best = min(candidates, key=lambda n: np.mean([s[0] for s in scores[n]]))
+    return {
+        "search" : "SVD successive halving",
+        "best_params" : {"n_factors" : best},
+        "best_score" : {"rmse" : float(np.mean([s[0] for s in scores[best]])),
+                        "mae" : float(np.mean([s[1] for s in scores[best]]))},
+        "n_folds" : len(scores[best]),
+        "n_fits" : n_fits,
+        "seconds" : time.perf_counter() - start,
+        "completed" : completed
+    }
+
+def grid_search_SVD(data, n_factors_grid=range(1, 50), cv=5, n_jobs=-1):
+    '''
+    Exhaustive GridSearchCV over n_factors (the previous tuning stage), with the same output of
+    successive_halving_SVD so that they can be used interchangeably in train_SVD_model.
+    '''
+    start = time.perf_counter()
+    n_factors_grid = [n for n in n_factors_grid if n > 0]
+    gs_svd = GridSearchCV(SVD, {'n_factors': n_factors_grid}, measures=['rmse', 'mae'], cv=cv, n_jobs=n_jobs)
+    gs_svd.fit(data)
+    return {
+        "search" : "SVD model GridSearch",
+        "best_params" : gs_svd.best_params['rmse'],
+        "best_score" : {"rmse" : gs_svd.best_score['rmse'], "mae" : gs_svd.best_score['mae']},
+        "n_folds" : cv,
+        "n_fits" : cv*len(n_factors_grid),
+        "seconds" : time.perf_counter() - start,
+        "completed" : True
+    }
+
+def grid_search_ALS(ratings, n_factors_grid=range(1, 50), reg_grid=(5, 20, 50), cv=5, budget_seconds=120, n_jobs=None,
+                    random_state=42):
+    '''
+    Search of n_factors and reg of the biased matrix factorization fitted with ALS (fit_biased_ALS) on the dense
+    users x cluster tags matrix, with the same output of successive_halving_SVD. The ratings are split in cv
+    folds, and every candidate is evaluated on all of them: each fit takes milliseconds, so the grid is
+    exhaustive. The values of n_factors above the number of cluster tags are not tried, the rank of the matrix
+    can not be higher. If budget_seconds is over, the candidates not yet evaluated are skipped.
+
+    Input:
+    - ratings : numpy.ndarray
+      Matrix users x cluster tags.
+    - n_factors_grid : iterable
+      Values of n_factors to try.
+    - reg_grid : iterable
+      Values of reg to try.
+    - cv : int
+      Number of folds of the cross validation.
+    - budget_seconds : float
+      Wall clock time after which no new candidate is evaluated. None for no limit.
+    - n_jobs : int
+      Number of processes for the fits of the folds of each candidate (-1 for all the cores). By default None,
+      in this process: each fit takes milliseconds, so a pool only pays off with large matrices.
+    - random_state : int
+      Seed for the folds and for the initial factors.
+
+    Output:
+    - search_results : dict
+      Dictionary with best_params, best_score (mean rmse and mae on the folds), number of folds, number of
+      fits, time and whether the search completed within budget.
+    '''
+    start = time.perf_counter()
+    ratings = np.asarray(ratings, dtype=np.float64)
+    # The ratings are predicted in the rating scale of the Reader of the SVD model, (0, max)
+    rating_scale = (0, ratings.max())
+    folds = np.array_split(np.random.RandomState(random_state).permutation(ratings.size), cv)
+    n_factors_grid = sorted({int(n) for n in n_factors_grid if 0 < n <= ratings.shape[1]}) or [1]
+    scores, completed = {}, True
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for n_factors in n_factors_grid:
+            for reg in reg_grid:
+                if scores and budget_seconds is not None and time.perf_counter() - start > budget_seconds:
+                    completed = False
+                    break
+                scores[(n_factors, reg)] = parallel(delayed(_fit_and_score_ALS)(ratings, test, n_factors, reg,
+                                                                                rating_scale, random_state)
+                                                    for test in folds)
+
+    best = min(scores, key=lambda params: np.mean([s[0] for s in scores[params]]))
+    return {
+        "search" : "ALS GridSearch",
+        "best_params" : {"n_factors" : best[0], "reg" : best[1]},
+        "best_score" : {"rmse" : float(np.mean([s[0] for s in scores[best]])),
+                        "mae" : float(np.mean([s[1] for s in scores[best]]))},
+        "n_folds" : cv,
+        "n_fits" : cv*len(scores),
+        "seconds" : time.perf_counter() - start,
+        "completed" : completed
+    }
+
+def tune_SVD_model(data, fingerprint, search=successive_halving_SVD, cache_path="models/tuning_cache.json",
+                   **search_params):
+    '''
+    Tuning stage of train_SVD_model: run search on data, unless a search was already done on data with the same
+    fingerprint, in which case its results are reused. The results of the searches are saved in cache_path.
+
+    Input:
+    - data : surprise.Dataset
+      This is the Dataset object used in the surprise library to train the models (the users x cluster tags
+      matrix for grid_search_ALS).
+    - fingerprint : str
+      Fingerprint of the data used to build the Dataset (see dataframe_fingerprint).
+    - search : function
+      Function which does the search, successive_halving_SVD, grid_search_SVD or grid_search_ALS.
+    - search_params : parameters passed to search.
+
+    Output:
+    - search_results : dict
+      Output of search, with the key "cached" True if it comes from a previous run.
+    '''
+    key = f"{search.__name__}:{fingerprint}:{json.dumps(search_params, sort_keys=True, default=str)}"
+    cache = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, encoding="utf-8") as file:
+                cache = json.load(file)
+        except json.JSONDecodeError:
+            # A corrupt cache is only a cache: the search runs again and the file is written again
+            cache = {}
+    if key in cache:
+        return dict(cache[key], cached=True)
+
+    search_results = search(data, **search_params)
+    # Only the searches that completed are reused, a search stopped by the budget can be improved
+    if search_results["completed"]:
+        cache[key] = search_results
+        # Keep only the most recent searches
+        cache = dict(list(cache.items())[-20:])
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        # Unique per process and thread: the jobs of several gunicorn workers may write it at the same time
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(cache, file)
+        os.replace(tmp_path, cache_path)
+    return dict(search_results, cached=False)
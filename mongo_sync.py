@@ -0,0 +1,360 @@
+import os
+import time
+import fcntl
+import pickle
+import threading
+import contextlib
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+def required(fields):
+    '''
+    Filter of mongoDB for the documents which have all the fields (not missing nor null).
+    '''
+    return {field : {"$ne" : None} for field in fields if field != "_id"}
+
+_users_fields = ['_id', 'suscriptions', 'gender', 'degree', 'age', 'following', 'skills', 'hobbies', 'userType',
+                 'username']
+_events_fields = ['_id', 'event_name', 'description', 'place', 'time', 'eventTags', 'attendees']
+
+# Collections of the app database used by the models, with the fields read (projection) and the documents read
+# (filter): only the users and events with all the fields used by the models (the ones that the users created by
+# FS developers for testing may not have), so they are not dropped in pandas afterwards. For the collections
+# with a watermark field only the documents changed since the last sync are pulled, the small catalogs are read
+# entirely every time.
+mongo_collections = {
+    "users" : {"projection" : {field : 1 for field in _users_fields}, "filter" : required(_users_fields),
+               "watermark" : "updatedAt"},
+    "usertypes" : {"projection" : {'_id': 1, 'name': 1}, "filter" : {}, "watermark" : None},
+    "events" : {"projection" : {field : 1 for field in _events_fields}, "filter" : required(_events_fields),
+                "watermark" : "updatedAt"},
+    "tags" : {"projection" : {'_id': 1, 'name': 1}, "filter" : {}, "watermark" : None},
+    "degrees" : {"projection" : {'_id': 1, 'name': 1}, "filter" : {}, "watermark" : None},
+    "skills" : {"projection" : {'_id': 1, 'name': 1}, "filter" : {}, "watermark" : None},
+    "hobbies" : {"projection" : {'_id': 1, 'name': 1}, "filter" : {}, "watermark" : None}
+}
+
+class MongoSync:
+    '''
+    Local snapshot of the collections of the app database, kept up to date incrementally.
+
+    For each collection with a watermark field (updatedAt), refresh only pulls the documents with
+    updatedAt >= the highest updatedAt already in the snapshot (or without updatedAt), and applies them to the
+    snapshot by _id. So a refresh costs in proportion to the changes, not to the size of the database. The
+    documents deleted in mongoDB, or which no longer match the filter of the collection, have no updatedAt to
+    find them by: they are only found when refresh is called with check_deletions, which reads the _id of every
+    document of the collection (the background jobs do it, see main.sync_snapshot). The collections are read at the same time, each one in a thread, so a refresh takes about as
+    long as the slowest collection. The snapshot is saved in snapshot_path, so it survives restarts of the API
+    (the collections saved with another projection or filter are read again). The attribute version changes
+    every time a refresh changes the snapshot.
+
+    The snapshot is not saved again after every refresh: the changes of each refresh (the documents added,
+    modified or deleted) are appended to a log, snapshot_path + ".log", and read again after snapshot_path when
+    the snapshot is loaded. When the log gets bigger than snapshot_path, the whole snapshot is saved in
+    snapshot_path and the log is emptied (compaction). So saving costs in proportion to the changes as well.
+
+    Parameters:
+    - snapshot_path : str
+        Pickle file where the snapshot is saved. None to keep it only in memory.
+    - collections : dict
+        Collections to sync, with the projection, the filter and the watermark field of each one (see
+        mongo_collections).
+    '''
+
+    def __init__(self, snapshot_path="data/mongo_snapshot.pkl", collections=mongo_collections):
+        self.snapshot_path = snapshot_path
+        self.collections = collections
+        self._lock = threading.Lock()
+        # Threads which read the collections, created once (see _pool)
+        self._executor = None
+        self._executor_pid = None
+        # The dictionaries of documents are never modified once in documents, they are replaced (copy on write),
+        # so the snapshot can be read while a refresh or a reload applies new changes
+        self.documents = {name : {} for name in collections}
+        self.watermarks = {name : None for name in collections}
+        # Increased every time a refresh (or a reload) changes the snapshot
+        self.version = 0
+        self.log_path = None if snapshot_path is None else f"{snapshot_path}.log"
+        # Time of the last refresh without snapshot_path (otherwise the modification time of the log, see synced_at)
+        self._synced_at = None
+        # Without a complete snapshot in snapshot_path the next save writes it instead of appending to the log
+        self._compact = True
+        # What this process read of snapshot_path (inode and modification time) and of the log (bytes), so that
+        # reload_if_changed only reads what other processes saved afterwards
+        self._snapshot_stamp = None
+        self._log_offset = 0
+        self._loaded = set()
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            with self._locked_log(fcntl.LOCK_SH) as log:
+                self._load(log)
+
+    @contextlib.contextmanager
+    def _locked_log(self, operation):
+        '''
+        The log open and locked with operation (fcntl.LOCK_SH to read the snapshot, fcntl.LOCK_EX to write it), so
+        that no process reads the snapshot while another one appends to the log or compacts it. None without
+        snapshot_path.
+        '''
+        if self.snapshot_path is None:
+            yield None
+            return
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        with open(self.log_path, "a+b") as log:
+            fcntl.flock(log, operation)
+            yield log
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _load(self, log):
+        '''
+        Read snapshot_path and then the changes of the log (locked by the caller).
+        '''
+        with open(self.snapshot_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            state = pickle.load(file)
+        self._snapshot_stamp = stat.st_ino, stat.st_mtime_ns
+        # Only the collections saved with the same projection and filter are reused
+        self._loaded = set()
+        for name, spec in state.get("collections", {}).items():
+            if self.collections.get(name) == spec:
+                self.documents[name] = state["documents"][name]
+                self.watermarks[name] = state["watermarks"][name]
+                self._loaded.add(name)
+        self._log_offset = 0
+        # The dictionaries just read are not shared yet, the changes are applied to them in place
+        complete = self._replay_log(log, copied=set(self._loaded))
+        self._compact = not complete or self._loaded != set(self.collections)
+
+    def _replay_log(self, log, copied=None):
+        '''
+        Apply the changes saved in the log after _log_offset to the collections loaded from snapshot_path. Returns
+        False if the log ends with a change half written (the process stopped while appending it), which is
+        ignored.
+        '''
+        copied = set() if copied is None else copied
+        size = os.fstat(log.fileno()).st_size
+        log.seek(self._log_offset)
+        while self._log_offset < size:
+            try:
+                changes = pickle.load(log)
+            except (EOFError, pickle.UnpicklingError):
+                return False
+            self._log_offset = log.tell()
+            for name, change in changes.items():
+                if name in self._loaded:
+                    self._apply(name, change, copied)
+        return True
+
+    def _apply(self, name, change, copied):
+        if "documents" in change:
+            self.documents[name] = change["documents"]
+        else:
+            # Copied once per replay, the first time one of its changes is applied
+            if name not in copied:
+                self.documents[name] = dict(self.documents[name])
+                copied.add(name)
+            documents = self.documents[name]
+            for doc in change["upserts"]:
+                documents[doc["_id"]] = doc
+            for deleted in change["deleted"]:
+                documents.pop(deleted, None)
+        self.watermarks[name] = change["watermark"]
+
+    def _catch_up(self, log):
+        '''
+        Read what other processes saved since this one read the snapshot (the log locked by the caller): the whole
+        snapshot again if it was compacted meanwhile, otherwise only the new changes of the log. Returns True if
+        the snapshot changed.
+        '''
+        stamp = self._stamp()
+        if stamp is None:
+            return False
+        if stamp != self._snapshot_stamp:
+            self._load(log)
+            return True
+        offset = self._log_offset
+        if os.fstat(log.fileno()).st_size > offset and not self._replay_log(log):
+            # Nothing can be appended after a change half written, the next save compacts the log
+            self._compact = True
+        return self._log_offset != offset
+
+    def reload_if_changed(self):
+        '''
+        Apply the changes saved by other processes since this one read the snapshot (for instance the refresh of a
+        background job in another gunicorn worker), without connecting to mongoDB. When nothing changed it only
+        costs a stat of the files. It never waits: while a refresh of this process or a save of another one is
+        running, the snapshot stays as it is until the next call.
+
+        Output:
+        - changed : bool
+            True if the snapshot changed (and its version with it).
+        '''
+        if self.snapshot_path is None:
+            return False
+        try:
+            log_size = os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            log_size = 0
+        if self._stamp() == self._snapshot_stamp and log_size <= self._log_offset:
+            return False
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            with open(self.log_path, "a+b") as log:
+                try:
+                    fcntl.flock(log, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                changed = self._catch_up(log)
+            if changed:
+                self.version += 1
+            return changed
+        finally:
+            self._lock.release()
+
+    def synced_at(self):
+        '''
+        Time (timestamp) of the last refresh of the snapshot, by any process using snapshot_path. None if it was
+        never refreshed.
+        '''
+        if self.log_path is not None and os.path.exists(self.log_path):
+            return os.path.getmtime(self.log_path)
+        return self._synced_at
+
+    def _pool(self):
+        # One per process: the threads of a pool created before a fork (gunicorn master) do not exist in the child
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=len(self.collections), thread_name_prefix="mongo-sync")
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _projection(self, spec):
+        projection = spec["projection"]
+        if projection is not None and spec["watermark"] is not None:
+            projection = dict(projection, **{spec["watermark"] : 1})
+        return projection
+
+    def _sync_collection(self, db, name, check_deletions):
+        spec = self.collections[name]
+        collection = db[name]
+        field = spec["watermark"]
+        if field is None:
+            documents = {doc["_id"] : doc for doc in collection.find(spec["filter"], spec["projection"])}
+            if documents == self.documents[name]:
+                return 0, None
+            self.documents[name] = documents
+            return len(documents), {"documents" : documents, "watermark" : None}
+
+        documents = self.documents[name]
+        watermark = self.watermarks[name]
+        if watermark is None:
+            query = spec["filter"]
+        else:
+            # >= to not miss documents updated in the same instant of the watermark, applying them again is harmless
+            query = {"$and" : [{"$or" : [{field : {"$gte" : watermark}}, {field : {"$exists" : False}}]},
+                               spec["filter"]]}
+        changed = [doc for doc in collection.find(query, self._projection(spec)) if documents.get(doc["_id"]) != doc]
+        for doc in changed:
+            if doc.get(field) is not None and (watermark is None or doc[field] > watermark):
+                watermark = doc[field]
+        self.watermarks[name] = watermark
+
+        deleted = []
+        if check_deletions and watermark is not None and len(changed) < len(documents):
+            # The documents changed so that they do not match the filter anymore are removed as well
+            ids = {doc["_id"] for doc in collection.find(spec["filter"], {"_id" : 1})}
+            deleted = list(documents.keys() - ids - {doc["_id"] for doc in changed})
+        if not changed and not deleted:
+            return 0, None
+        change = {"upserts" : changed, "deleted" : deleted, "watermark" : watermark}
+        self._apply(name, change, set())
+        return len(changed) + len(deleted), change
+
+    def refresh(self, db, check_deletions=False):
+        '''
+        Pull the changes of all the collections from the database db and apply them to the snapshot.
+
+        The refreshes of all the processes using snapshot_path are serialized (the log is locked during the
+        refresh), and each one first applies the changes saved by the previous ones (see reload_if_changed), so
+        it only pulls what is newer.
+
+        Input:
+        - db : pymongo.database.Database
+            The app database (a mongomock database works as well).
+        - check_deletions : bool
+            If True, also remove from the snapshot the documents deleted in the database, reading the _id of all
+            the documents of the collections with a watermark (in proportion to the size of the database).
+
+        Output:
+        - n_changes : dict
+            Number of documents added, modified or deleted in each collection.
+        '''
+        with self._lock, self._locked_log(fcntl.LOCK_EX) as log:
+            if log is not None and self._catch_up(log):
+                self.version += 1
+            # Each collection only touches its own documents and watermark, they are synced concurrently in the
+            # threads of the pool of the instance, started by the first refresh and reused by the next ones
+            pool = self._pool()
+            futures = {name : pool.submit(self._sync_collection, db, name, check_deletions) for name in self.collections}
+            results = {name : future.result() for name, future in futures.items()}
+            n_changes = {name : n for name, (n, _) in results.items()}
+            if any(n_changes.values()):
+                self.version += 1
+                if log is not None:
+                    self._write(log, {name : change for name, (_, change) in results.items() if change is not None})
+            # The modification time of the log is the time of the last refresh, also without changes
+            if log is not None:
+                os.utime(log.fileno())
+            self._synced_at = time.time()
+        return n_changes
+
+    def save(self, changes=None):
+        '''
+        Save the changes of a refresh appending them to the log, or the whole snapshot in snapshot_path (in a tmp
+        file then renamed, so it is never half written) emptying the log if changes is None or the log is bigger
+        than snapshot_path. The log is locked while writing, since all the gunicorn workers share it.
+
+        Input:
+        - changes : dict
+            Changes of each collection, as returned by _sync_collection. None to save the whole snapshot.
+        '''
+        with self._locked_log(fcntl.LOCK_EX) as log:
+            if log is not None:
+                self._write(log, changes)
+
+    def _write(self, log, changes):
+        compact = (changes is None or self._compact or not os.path.exists(self.snapshot_path)
+                   or os.fstat(log.fileno()).st_size > os.path.getsize(self.snapshot_path))
+        if not compact:
+            log.seek(0, os.SEEK_END)
+            pickle.dump(changes, log)
+            log.flush()
+            self._log_offset = log.tell()
+            return
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump({"documents" : self.documents, "watermarks" : self.watermarks,
+                         "collections" : self.collections}, file)
+        os.replace(tmp_path, self.snapshot_path)
+        log.truncate(0)
+        self._snapshot_stamp = self._stamp()
+        self._log_offset = 0
+        self._loaded = set(self.collections)
+        self._compact = False
+
+    def dataframe(self, name):
+        '''
+        Return the snapshot of a collection as a pandas DataFrame, with the same columns of a find() with the
+        projection of the collection (the watermark field is dropped if it is not in the projection).
+        '''
+        spec = self.collections[name]
+        df = pd.DataFrame(list(self.documents[name].values()))
+        projection = spec["projection"]
+        if projection is not None and spec["watermark"] not in projection and spec["watermark"] in df.columns:
+            df = df.drop([spec["watermark"]], axis=1)
+        return df
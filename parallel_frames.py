@@ -0,0 +1,217 @@
+import os
+import weakref
+import multiprocessing
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+from global_variables import cluster_tags
+
+# Below this number of users the frames are built in the process: starting the pool costs more than it saves
+min_parallel_users = int(os.getenv("FRAMES_MIN_PARALLEL_USERS", default=5000))
+
+# The pools are started from the threads of a gunicorn worker (background jobs, scheduler): a fork would copy the
+# locks held by the other threads at that moment, so the processes are started from a clean server process instead
+_mp_context = multiprocessing.get_context("forkserver")
+
+class SharedArray:
+    '''
+    Numpy array in a block of shared memory (multiprocessing.shared_memory), which other processes attach by
+    name without copying it. The process which creates it releases it (release), the processes which attach it
+    only close it.
+
+    Parameters:
+    - shm : multiprocessing.shared_memory.SharedMemory
+        Block of shared memory.
+    - shape : tuple
+        Shape of the array.
+    - dtype : str
+        Dtype of the array.
+    '''
+
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, shape, dtype):
+        '''
+        Allocate a new array (not initialized) in shared memory.
+        '''
+        size = max(1, int(np.prod(shape))*np.dtype(dtype).itemsize)
+        return cls(shared_memory.SharedMemory(create=True, size=size), shape, dtype)
+
+    @classmethod
+    def from_array(cls, array):
+        '''
+        Copy array in shared memory.
+        '''
+        shared = cls.create(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        '''
+        Attach the array of another process from its spec (see spec).
+        '''
+        name, shape, dtype = spec
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype)
+
+    @property
+    def spec(self):
+        '''
+        (name, shape, dtype) of the array, to attach it from another process.
+        '''
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+    def release(self):
+        '''
+        Close and free the block of shared memory.
+        '''
+        self.close()
+        self.shm.unlink()
+
+    def detach(self):
+        '''
+        Free the name of the block and return its array: the memory stays mapped while the array (or any view of
+        it, like the columns of a dataframe) is alive, and it is unmapped when the array is garbage collected.
+        '''
+        array, shm = self.array, self.shm
+        shm.unlink()
+        weakref.finalize(array, shm.close)
+        self.array = None
+        return array
+
+def user_chunks(n_users, n_jobs, chunk_size=None):
+    '''
+    Split the users 0..n_users-1 in contiguous chunks [start, end): chunk_size users each, by default 4 chunks per
+    process so that the processes stay busy if some chunks are slower.
+    '''
+    chunk_size = chunk_size or max(1, -(-n_users//(4*n_jobs)))
+    return [(start, min(start + chunk_size, n_users)) for start in range(0, n_users, chunk_size)]
+
+def resolve_n_jobs(n_jobs):
+    '''
+    Number of processes for n_jobs, with -1 (or None) meaning one per CPU.
+    '''
+    if n_jobs is None or n_jobs < 0:
+        return os.cpu_count() or 1
+    return max(1, n_jobs)
+
+# Catalogs attached by each process of the pool (see _init_recommendation_worker), read-only
+_worker_catalogs = {}
+
+def _init_recommendation_worker(event_ids_spec, events_clusters_spec, output_spec):
+    event_ids = SharedArray.attach(event_ids_spec)
+    _worker_catalogs["arrays"] = (event_ids, SharedArray.attach(events_clusters_spec), SharedArray.attach(output_spec))
+    _worker_catalogs["event_index"] = {id_event : i for i, id_event in enumerate(event_ids.array.tolist())}
+
+def _recommendation_chunk(start, suscriptions):
+    from data_preprocessing_utilities import build_participation
+    _, events_clusters, output = _worker_catalogs["arrays"]
+    events_clusters, output = events_clusters.array, output.array
+    n_events = len(events_clusters)
+    participation = build_participation(suscriptions, _worker_catalogs["event_index"], n_events)
+    users_clusters = np.asarray(participation @ events_clusters)
+    # The rows of the chunk in the long dataframe are [start*n_events, end*n_events): written in place
+    rows = slice(start*n_events, (start + len(suscriptions))*n_events)
+    output[0, rows] = participation.toarray().ravel()
+    output[1:, rows] = np.repeat(users_clusters, n_events, axis=0).T
+    return len(suscriptions)
+
+def build_users_frame_parallel(df_users, df_events, events_clusters, n_jobs=-1, chunk_size=None):
+    '''
+    Build the users dataframe of create_training_df_recommendation_vectorized (one row per user and event) in a
+    pool of processes, each one with a chunk of the users.
+
+    The read-only catalogs (ids of the events and events x cluster_tags matrix) are copied once in shared memory
+    and attached by the processes, instead of being sent with every chunk. The processes write their rows directly
+    in a block of shared memory preallocated with the size of the whole output, which becomes the integer columns
+    of the dataframe: the partial results are not sent back nor concatenated.
+
+    Input:
+    - df_users : pandas.DataFrame
+        Dataframe of the users, with the columns _id and suscriptions.
+    - df_events : pandas.DataFrame
+        Dataframe of the events, with the column _id.
+    - events_clusters : numpy.ndarray
+        Events x cluster_tags matrix (see build_events_clusters).
+    - n_jobs : int
+        Number of processes, -1 for one per CPU.
+    - chunk_size : int
+        Number of users of each chunk, by default 4 chunks per process.
+
+    Output:
+    - df_users_new : pandas.DataFrame
+        Same dataframe of create_training_df_recommendation_vectorized.
+    '''
+    n_users, n_events = len(df_users), len(df_events)
+    n_jobs = resolve_n_jobs(n_jobs)
+    event_ids = SharedArray.from_array(df_events["_id"].astype(str).to_numpy().astype("U"))
+    shared_clusters = SharedArray.from_array(np.ascontiguousarray(events_clusters, dtype=np.int64))
+    # One row per integer column (participation, then the cluster tags): each row is a column of the dataframe
+    output = SharedArray.create((1 + len(cluster_tags), n_users*n_events), np.int64)
+    try:
+        suscriptions = list(df_users["suscriptions"])
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=_mp_context, initializer=_init_recommendation_worker,
+                                 initargs=(event_ids.spec, shared_clusters.spec, output.spec)) as pool:
+            futures = [pool.submit(_recommendation_chunk, start, suscriptions[start:end])
+                       for start, end in user_chunks(n_users, n_jobs, chunk_size)]
+            for future in futures:
+                future.result()
+        values = output.detach()
+    except BaseException:
+        output.release()
+        raise
+    finally:
+        event_ids.release()
+        shared_clusters.release()
+
+    df_users_new = pd.DataFrame(values.T, columns=["participation"] + cluster_tags, copy=False)
+    df_users_new.insert(0, "id_user", np.repeat(df_users["_id"].values, n_events))
+    df_users_new.insert(1, "id_event", np.tile(df_events["_id"].values, n_users))
+    return df_users_new
+
+# Encoder used by each process of the pool (see _init_features_worker)
+_worker_encoder = {}
+
+def _init_features_worker(encoder):
+    _worker_encoder["encoder"] = encoder
+
+def _features_chunk(degrees, hobbies, skills):
+    return _worker_encoder["encoder"].encode_onehot(degrees, hobbies, skills)
+
+def encode_onehot_parallel(encoder, df_users, n_jobs=-1, chunk_size=None):
+    '''
+    One-hot block of UsersFeatureEncoder.transform computed in a pool of processes, each one with a chunk of the
+    users. The vocabularies are sent once to each process (initializer), not with every chunk, and the chunks of
+    the sparse matrix are joined concatenating their arrays of indices once.
+
+    Output:
+    - onehot : scipy.sparse.csr_matrix
+        Same matrix of UsersFeatureEncoder.encode_onehot.
+    '''
+    n_jobs = resolve_n_jobs(n_jobs)
+    columns = (list(df_users["degree"]), list(df_users["hobbies"]), list(df_users["skills"]))
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=_mp_context, initializer=_init_features_worker,
+                             initargs=(encoder,)) as pool:
+        chunks = list(pool.map(_features_chunk, *([column[start:end] for start, end
+                                                    in user_chunks(len(df_users), n_jobs, chunk_size)]
+                                                   for column in columns)))
+    if not chunks:
+        return encoder.encode_onehot([], [], [])
+    # The indptr of each chunk starts at 0: they are shifted by the number of values of the previous chunks
+    offsets = np.cumsum([0] + [chunk.nnz for chunk in chunks])
+    indptr = np.concatenate([[0]] + [chunk.indptr[1:] + offset for chunk, offset in zip(chunks, offsets)])
+    indices = np.concatenate([chunk.indices for chunk in chunks])
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr),
+                             shape=(len(df_users), len(encoder.columns)))
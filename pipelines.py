@@ -0,0 +1,106 @@
+from data_preprocessing_utilities import *
+from recommending_events_model import *
+from matching_users_model import *
+from matching_users_index import save_users_index
+from events_streaming import stream_events_recommendations
+from events_response import index_events, events_predictions
+from users_profiles import get_users_profiles
+from users_features import get_users_feature_encoder
+from results_db import get_results_db, results_rows
+from instrumentation import span
+from global_variables import *
+
+def run_events_recommendations(update_AWS_DB=None, snapshot=None):
+    '''
+    Pipeline of the events recommendations: connects to mongoDB, builds the training dataframes, trains the SVD
+    model and prepares the 3 most recommended events for each user in the format wanted by FullStack.
+    It does not depend on a Flask request, so it can run both in the endpoint and in a background job.
+
+    Input:
+    - update_AWS_DB : str
+        If "yes", save the results with the date and time in the PostgreSQL database on AWS.
+    - snapshot : DataSnapshot
+        Collections to use, by default they are read from mongoDB (connection_db_mongodb).
+
+    Output:
+    - preds : dict
+        Dictionary with the id of each user as key, and the information of his/her recommended events as value.
+    '''
+    # The tables of the snapshot are shared between requests, they must not be modified in place
+    # Each stage is measured (see instrumentation.py), the measures are served in /metrics
+    if snapshot is None:
+        with span("mongo_sync", pipeline="events_recommendations") as stage:
+            snapshot = connection_db_mongodb(check_deletions=True)
+            stage.rows = len(snapshot.users) + len(snapshot.events)
+    df_users, df_events, df_tags = snapshot.users, snapshot.events, snapshot.tags
+
+    if events_batch_size > 0:
+        # The users go by batches through the participation, the training and the scoring, without building the
+        # users x events dataframe (see events_streaming)
+        results = stream_events_recommendations(df_users, df_events, df_tags, events_batch_size, events_spill_dir)
+    else:
+        with span("build_training_frames", pipeline="events_recommendations") as stage:
+            df_real_users, df_real_events = create_training_df_recommendation_vectorized(df_users, df_events, df_tags,
+                                                                                            n_jobs=frames_n_jobs)
+            stage.rows = len(df_real_users)
+        results = train_SVD_model(df_real_users, df_real_events)
+
+    #prepare the output for the API, FullStack wants a json with all the information of the first 3 recommended events for each user
+    # The events are indexed by id once (ids as str, tags names instead of ids), then each user is a lookup per event
+    with span("response_assembly", pipeline="events_recommendations") as stage:
+        columns, events = index_events(df_events, df_tags)
+        preds = events_predictions(results, columns, events)
+        stage.rows = len(preds)
+    #If this parameter is not set to yes, do not save in the postgresql database on AWS
+    if update_AWS_DB=="yes":
+        # One row per (run, user, rank, event, score), bulk loaded in the background with the pooled engine
+        get_results_db().write_run_async('events_recommendations', results_rows(results))
+    return preds
+
+def run_users_matching(update_AWS_DB=None, snapshot=None):
+    '''
+    Pipeline of the users matching: connects to mongoDB, builds the users matching dataset, finds the 4 most similar
+    users of each user and prepares the information of the recommended users in the format wanted by FullStack.
+    It does not depend on a Flask request, so it can run both in the endpoint and in a background job.
+
+    Input:
+    - update_AWS_DB : str
+        If "yes", save the results with the date in the PostgreSQL database.
+    - snapshot : DataSnapshot
+        Collections to use, by default they are read from mongoDB (connection_db_mongodb).
+
+    Output:
+    - preds : dict
+        Dictionary with the id of each user as key, and the information of his/her recommended users as value.
+    '''
+    # The tables of the snapshot are shared between requests, they must not be modified in place
+    if snapshot is None:
+        with span("mongo_sync", pipeline="users_matching") as stage:
+            snapshot = connection_db_mongodb(check_deletions=True)
+            stage.rows = len(snapshot.users)
+    df_users, df_degrees, df_skills = snapshot.users, snapshot.degrees, snapshot.skills
+    df_hobbies, df_userTypes = snapshot.hobbies, snapshot.usertypes
+    
+    # Age and gender in a dense block, degree, hobbies and skills one-hot in a sparse matrix, with the
+    # vocabularies of the catalogs built once per snapshot
+    with span("build_features", rows=len(df_users), pipeline="users_matching"):
+        features = get_users_feature_encoder(snapshot).transform(df_users, n_jobs=frames_n_jobs)
+
+    # Normalizar una sola vez y calcular las similitudes por bloques de usuarios, excluyendo los "following"
+    with span("matching", rows=len(features), pipeline="users_matching"):
+        users_afinidad, users_scores = match_users(features, n_matches=4, return_scores=True)
+    # Actualizar el indice LSH (solo los usuarios nuevos, cambiados o borrados) con el que /match_users/<user_id>
+    # busca los usuarios afines de un solo usuario, y guardarlo para los procesos que arranquen después
+    with span("lsh_index", rows=len(features), pipeline="users_matching"):
+        save_users_index(snapshot, features)
+
+    if update_AWS_DB=="yes":
+        # One row per (run, user, rank, matched user, similarity)
+        get_results_db().write_run_async('users_matching', results_rows(users_afinidad, users_scores))
+
+    #REORGANIZE JSON FOR FULLSTACK: username, degree and userType of the recommended users, from the profiles
+    # indexed by id once per snapshot
+    with span("response_assembly", pipeline="users_matching") as stage:
+        preds = get_users_profiles(snapshot).all_matches(users_afinidad, df_users["_id"].astype(str).unique())
+        stage.rows = len(preds)
+    return preds
@@ -1,9 +1,10 @@
+import os
 import random
 import pandas as pd
 import numpy as np
+from scipy import sparse
 import datetime
 import json
-import pickle
 
 from collections import defaultdict #data colector
 #Surprise: https://surprise.readthedocs.io/en/stable/
@@ -20,10 +21,14 @@ from surprise import SVD
 
 from global_variables import *
 from data_preprocessing_utilities import *
+from model_tuning import tune_SVD_model, successive_halving_SVD, grid_search_SVD, grid_search_ALS
+from matrix_factorization import fit_biased_ALS
+from model_registry import ModelRegistry, append_history
+from instrumentation import span
 
-def train_SVD_model(df_real_users, df_real_events):
+def train_SVD_model(df_real_users, df_real_events, search=None, backend=None, **search_params):
     '''
-    Gridsearch for the SVD model for recommending events to users and makes prediction with the best model. 
+    Search of n_factors for the SVD model for recommending events to users and makes prediction with the best model. 
     It returns a dictionary with the results of recommendations for all the users in the mongoDB database.
 
     Input:
@@ -31,127 +36,423 @@ def train_SVD_model(df_real_users, df_real_events):
         Dataframe with the user-item matrix obtained from the mongoDB database of the app.
     - df_real_events : pandas.DataFrame
         Dataframe with the events collection from the mongoDB database of the app.
+    - search : function
+        Tuning of n_factors, successive_halving_SVD or grid_search_SVD from model_tuning for the surprise backend,
+        grid_search_ALS for the numpy backend. By default successive_halving_SVD and grid_search_ALS.
+    - backend : str
+        "surprise" to train the SVD of surprise on the long format of the data, "numpy" to fit the same biased
+        matrix factorization with ALS on the dense users x cluster tags matrix (milliseconds per fit). By default
+        MF_backend (env var MF_BACKEND, "surprise").
+    - search_params : parameters passed to search (for instance budget_seconds, n_jobs).
 
     Output:
     - results : dict
-      A dictionary with the results from the recommendation model with the best parameter from GridSearch.
+      A dictionary with the results from the recommendation model with the best parameter from the search.
+    '''
+    model = fit_events_model(users_tags_matrix(df_real_users), search=search, backend=backend, **search_params)
+
+    #PREDICTIONS only on the real users and real events
+    
+    with span("scoring", pipeline="events_recommendations") as stage:
+        results = make_predictions(df_real_users, df_real_events, model)
+        stage.rows = len(results)
+    return results
+
+def users_tags_matrix(df_real_users):
+    '''
+    Cluster tags of each real user, one row per user indexed by id_user, from the users dataframe of
+    create_training_df_recommendation (all the rows of a user have the same tags).
+    '''
+    V = df_real_users.set_index("id_user")[cluster_tags]
+    return V[~V.index.duplicated()]
+
+def fit_events_model(users_tags, search=None, backend=None, **search_params):
+    '''
+    Tune n_factors and train the SVD model on the cluster tags of the real users together with the ones of the
+    artificial users, and save it in the registry. If the model in use was trained on the same data, it is
+    returned without training it again, and the same if it is pinned after a rollback (see rollback_SVD_model):
+    it stays in use until it is unpinned (unpin_SVD_model).
+
+    Input:
+    - users_tags : pandas.DataFrame
+        Users x cluster_tags matrix of the real users, indexed by id_user (see users_tags_matrix).
+    - search, backend, search_params : see train_SVD_model.
+
+    Output:
+    - model : dict
+      Factors of the model in use (see get_SVD_model).
     '''
     np.random.seed(42) # replicating results
+
+    #A model rolled back by hand is kept until it is unpinned, whatever the data
+    if _model_registry.pinned(SVD_model_name):
+        model = get_SVD_model()
+        if model is not None:
+            return model
     
     #load artificial data
     #df_users_artificial = pd.read_csv("df_artificial_users.csv", encoding="utf-8")
-    df_users_artificial = create_artificial_users()
+    #generated only the first time for each size, then memory-mapped from data/ (size set in global_variables)
+    with span("artificial_corpus", pipeline="events_recommendations") as stage:
+        df_users_artificial = create_artificial_users(**artificial_corpus)
+        stage.rows = len(df_users_artificial)
     #df_events_artificial = pd.read_csv("df_artificial_events.csv")
     
     #joint artificial and real data
     #df_events_total = pd.concat((df_events_artificial,df_real_events.drop(["time"], axis=1))).reset_index(drop=True)
-    df_users_total = pd.concat((df_users_artificial.drop(["num_eventos", "estudio", "edad", "sexo", "emprende"],axis=1),
-                                df_real_users)).reset_index(drop=True)
-    df_users = df_users_total.set_index("id_user")
-    #Only select the columns with the tags
-    V = df_users.iloc[:,1:-1].drop_duplicates()
+    #Only the columns with the tags, one row per user (all the rows of an artificial user have the same tags)
+    V = pd.concat((df_users_artificial.set_index("id_user")[cluster_tags], users_tags))
+    V = V[~V.index.duplicated()]
     user_event_matrix = V.reset_index()
-    # Reshape the DataFrame to long format
-    df = pd.melt(user_event_matrix, id_vars='id_user', var_name='event', value_name='participation')
-    df.columns = ['user', 'event', 'participation']
+    backend = backend or MF_backend
+    if backend == "numpy":
+        # The matrix factorization is fitted directly on the dense users x cluster tags matrix
+        search = search or grid_search_ALS
+        fingerprint = dataframe_fingerprint(user_event_matrix)
+    else:
+        search = search or successive_halving_SVD
+        # Reshape the DataFrame to long format
+        df = pd.melt(user_event_matrix, id_vars='id_user', var_name='event', value_name='participation')
+        df.columns = ['user', 'event', 'participation']
+        fingerprint = dataframe_fingerprint(df)
 
-    #Get the max value of participation of the entire dataframe of users to set the rating_scale in the Reader function
-    max_value = df["participation"].max()
-    
-    reader = Reader(rating_scale=(0, max_value))
-    data = Dataset.load_from_df(df=df, reader=reader)
-
-    ##GridSearch using SVD model
-
-    param_grid = {'n_factors': range(0,50)}
-    gs_svd = GridSearchCV(SVD, param_grid, measures=['rmse', 'mae'], cv=5)
-    gs_svd.fit(data)
-    # Save historic of best score and best parameters
-    summary = {
-        f"{datetime.datetime.now().date()}":{
-            "model" : f"SVD model GridSearch",
-            "best_rmse" : gs_svd.best_score['rmse'],
-            "best_mae" : gs_svd.best_score['mae'],
-            "best_params" : gs_svd.best_params['rmse']
-        }
+    #The model is trained again only if the data changed since the model loaded in memory was trained
+    model = get_SVD_model()
+    if model is None or model["fingerprint"] != fingerprint:
+        if backend == "numpy":
+            data = V.to_numpy(dtype=np.float64)
+        else:
+            #Get the max value of participation of the entire dataframe of users to set the rating_scale in the Reader function
+            max_value = df["participation"].max()
+
+            reader = Reader(rating_scale=(0, max_value))
+            data = Dataset.load_from_df(df=df, reader=reader)
+
+        ##Tuning of n_factors of the model (successive halving by default), reused if the data did not change
+        with span("tuning", rows=V.size, pipeline="events_recommendations"):
+            search_results = tune_SVD_model(data, fingerprint, search=search, **search_params)
+        # Train the best model once on all the data, and save its factors as a new version in the registry
+        with span("fit_model", rows=V.size, pipeline="events_recommendations"):
+            if backend == "numpy":
+                model = fit_ALS_factors(data, V.index, V.columns, fingerprint=fingerprint, **search_results['best_params'])
+            else:
+                model = fit_SVD_factors(data, search_results['best_params']["n_factors"], fingerprint)
+        metrics = {"rmse" : search_results["best_score"]['rmse'], "mae" : search_results["best_score"]['mae']}
+        version = save_SVD_model(model, {"search" : search_results["search"], "metrics" : metrics,
+                                         "params" : search_results["best_params"], "fingerprint" : fingerprint})
+        model = get_SVD_model()
+        # Save historic of best score and best parameters
+        append_history({
+            "date" : f"{datetime.datetime.now().date()}",
+            "version" : version,
+            "model" : search_results["search"],
+            "best_rmse" : metrics['rmse'],
+            "best_mae" : metrics['mae'],
+            "best_params" : search_results["best_params"]
+        })
+    return model
+
+def fit_SVD_factors(data, n_factors, fingerprint):
+    '''
+    Train the SVD model with n_factors on all the data, and return the parameters needed to make predictions.
+
+    Input:
+    - data : surprise.Dataset
+      This is the Dataset object used in the surprise library to train the models.
+    - n_factors: int
+      Parameter of the SVD model, obtained after the search
+    - fingerprint : str
+      Fingerprint of the data used to build the Dataset (see dataframe_fingerprint).
+
+    Output:
+    - model : dict
+      Factors of the users (pu) and of the cluster tags (qi), biases (bu, bi), global mean and rating scale of
+      the model, with the ids of the users and the names of the cluster tags of each row of the factors.
+    '''
+    trainset = data.build_full_trainset()
+    svd = SVD(n_factors, random_state=42)
+    svd.fit(trainset)
+    return {
+        "pu" : svd.pu, "qi" : svd.qi, "bu" : svd.bu, "bi" : svd.bi,
+        "global_mean" : np.float64(trainset.global_mean),
+        "rating_scale" : np.array(trainset.rating_scale, dtype=np.float64),
+        "users" : np.array([str(trainset.to_raw_uid(u)) for u in range(trainset.n_users)]),
+        "items" : np.array([str(trainset.to_raw_iid(i)) for i in range(trainset.n_items)]),
+        "n_factors" : int(n_factors),
+        "fingerprint" : fingerprint
     }
 
-    json_summary = json.dumps(summary)
-    with open(f"history_models.json", "a") as file:
-        file.write(json_summary)
-    # Save most recent model in pickle
-    with open('models/model_SVD_recommendations.pkl', 'wb') as file:
-        pickle.dump(gs_svd, file)
+def fit_ALS_factors(ratings, users, items, n_factors, fingerprint, reg=20):
+    '''
+    Fit the biased matrix factorization with ALS (see matrix_factorization.fit_biased_ALS) with n_factors on the
+    dense users x cluster tags matrix, and return the parameters needed to make predictions, as fit_SVD_factors.
 
-    #PREDICTIONS only on the real users and real events
-    
-    results = make_predictions(df_real_users, df_real_events, data, gs_svd.best_params['rmse']["n_factors"])
-    return results
+    Input:
+    - ratings : numpy.ndarray
+      Matrix users x cluster tags.
+    - users : iterable
+      Ids of the users of the rows of ratings.
+    - items : iterable
+      Names of the cluster tags of the columns of ratings.
+    - n_factors: int
+      Number of factors, obtained after the search
+    - fingerprint : str
+      Fingerprint of the data (see dataframe_fingerprint).
+    - reg : float
+      Regularization, obtained after the search
+
+    Output:
+    - model : dict
+      Same keys of fit_SVD_factors.
+    '''
+    model = fit_biased_ALS(ratings, n_factors, reg=reg, random_state=42)
+    return dict(model,
+        rating_scale=np.array((0, ratings.max()), dtype=np.float64),
+        users=np.array([str(user) for user in users]),
+        items=np.array([str(item) for item in items]),
+        n_factors=int(n_factors),
+        fingerprint=fingerprint,
+        backend="numpy"
+    )
+
+_model_registry = ModelRegistry(models_registry_path, keep_versions=int(os.getenv("MODELS_KEEP_VERSIONS", default=10)))
+_svd_model = None
+
+def save_SVD_model(model, metadata=None):
+    '''
+    Save the factors of the SVD model as a new version in the models registry, which becomes the current one.
+
+    Input:
+    - model : dict
+      Factors of the SVD model (see fit_SVD_factors).
+    - metadata : dict
+      Metrics, parameters and fingerprint of the model, saved with it.
+
+    Output:
+    - version : int
+      Version of the model in the registry.
+    '''
+    return _model_registry.register(SVD_model_name, model, metadata)
+
+def get_SVD_model(version=None):
+    '''
+    Return the factors of the current SVD model of the registry (or of version), memory-mapped. The current
+    model is loaded only when its version changes, for instance after a training or a rollback in another
+    process. None if no model has been trained yet.
+    '''
+    global _svd_model
+    if version is not None:
+        return _model_registry.load(SVD_model_name, version)
+    current = _model_registry.current_version(SVD_model_name)
+    if current is None:
+        return None
+    if _svd_model is None or _svd_model["version"] != current:
+        _svd_model = _model_registry.load(SVD_model_name, current)
+    return _svd_model
+
+def current_SVD_version():
+    '''
+    Return the version in use of the SVD model in the registry, None if no model has been trained yet.
+    '''
+    return _model_registry.current_version(SVD_model_name)
+
+def rollback_SVD_model(version=None):
+    '''
+    Go back to a previous version of the SVD model (by default the one before the current one), and return it.
+    The version is pinned: the trainings keep it (see fit_events_model) until unpin_SVD_model is called.
+    '''
+    _model_registry.rollback(SVD_model_name, version)
+    return get_SVD_model()
+
+def unpin_SVD_model():
+    '''
+    Let the next training replace the SVD model rolled back with rollback_SVD_model.
+    '''
+    return _model_registry.unpin(SVD_model_name)
+
+def predict_cluster_tags(model):
+    '''
+    Predict the score of each user for each cluster tag as the SVD model does: global mean + biases + pu·qi,
+    clipped to the rating scale, for all the users at once with a matrix product.
+
+    Input:
+    - model : dict
+      Factors of the SVD model (see fit_SVD_factors).
+
+    Output:
+    - scores : numpy.ndarray
+      Matrix users x cluster tags with the scores, the rows and columns are model["users"] and model["items"].
+    '''
+    scores = model["global_mean"] + model["bu"][:, None] + model["bi"][None, :] + model["pu"] @ model["qi"].T
+    return np.clip(scores, model["rating_scale"][0], model["rating_scale"][1])
+
+def users_tags_scores(model, rows):
+    '''
+    Scores of some users of the model for the cluster tags (in the order of cluster_tags), as predict_cluster_tags
+    but computing only the rows of those users.
 
-def make_predictions(df_real_users, df_real_events, data, n_factors):
+    Input:
+    - model : dict
+      Factors of the SVD model (see fit_SVD_factors).
+    - rows : numpy.ndarray
+      Rows of the users in the factors of the model (positions in model["users"]), -1 for the users the model
+      does not know (as returned by get_indexer): they are scored as SVD does for unknown users, with the global
+      mean and the biases of the cluster tags only.
+    '''
+    items = pd.Index(model["items"]).get_indexer(cluster_tags)
+    rows = np.asarray(rows)
+    known = rows >= 0
+    # Without the mask the row -1 would silently take the factors of the last user of the model
+    bu, pu = np.zeros(len(rows)), np.zeros((len(rows), model["qi"].shape[1]))
+    bu[known], pu[known] = model["bu"][rows[known]], model["pu"][rows[known]]
+    scores = model["global_mean"] + bu[:, None] + model["bi"][items][None, :] + pu @ model["qi"][items].T
+    return np.clip(scores, model["rating_scale"][0], model["rating_scale"][1])
+
+def events_candidates(df_real_events):
+    '''
+    Events which can be recommended: the future events with tags.
+
+    Input:
+    - df_real_events : pandas.DataFrame
+        Dataframe of the events with their cluster tags (see create_training_df_recommendation).
+
+    Output:
+    - candidates : dict
+      Positions of the candidate events in df_real_events (columns), their ids, the weights of their cluster tags
+      and their total number of tags.
+    '''
+    #How many tags from each cluster_tags each event has
+    weights = df_real_events[cluster_tags].values.astype(np.float64)
+    tot_tags = weights.sum(axis=1)
+    valid_events = (pd.to_datetime(df_real_events["time"]).values > np.datetime64(datetime.datetime.now())) & (tot_tags != 0)
+    columns = np.flatnonzero(valid_events)
+    return {"columns" : columns, "ids" : df_real_events["id_event"].values[columns],
+            "weights" : np.ascontiguousarray(weights[columns]), "tot_tags" : tot_tags[columns]}
+
+def candidates_valid_until(df_events, now=None):
+    '''
+    Time until which the candidate events (see events_candidates) stay the same: the time of the next future event,
+    when it stops being a candidate. The events recommendations computed at now are valid until then.
+
+    Input:
+    - df_events : pandas.DataFrame
+        Dataframe of the events, with the column time.
+    - now : datetime.datetime
+        Time of the computation, by default now.
+
+    Output:
+    - valid_until : str
+      Time of the next future event, None if there are no future events.
+    '''
+    now = datetime.datetime.now() if now is None else now
+    # Before the first sync the snapshot has no events (nor columns)
+    if "time" not in df_events.columns:
+        return None
+    times = pd.to_datetime(df_events["time"]).values
+    future = times[times > np.datetime64(now)]
+    return str(future.min()) if len(future) else None
+
+def recommend_events(tags_scores, participation, candidates, n_events=3):
+    '''
+    Best n_events candidate events of a block of users, excluding the events each user already participates to.
+
+    The score of a user for an event is the average of the scores of the user for the cluster tags of the event,
+    weighted by how many tags of each cluster tag the event has: the matrix product of the scores of the block
+    times the weights of the candidates, divided by their number of tags. The best n_events of each user are
+    selected with argpartition.
+
+    Input:
+    - tags_scores : numpy.ndarray
+      Matrix users of the block x cluster tags with the scores (see users_tags_scores).
+    - participation : numpy.ndarray or scipy.sparse matrix
+      Matrix users of the block x all the events (not only the candidates), nonzero where the user participates.
+    - candidates : dict
+      Candidate events (see events_candidates).
+    - n_events : int
+      Number of events to recommend to each user.
+
+    Output:
+    - scores : list
+      For each user of the block, a dictionary {id_event : score} with his/her best n_events, sorted by score.
+    '''
+    n_candidates = len(candidates["columns"])
+    if n_candidates == 0:
+        return [{} for _ in range(len(tags_scores))]
+    block = tags_scores @ candidates["weights"].T
+    block /= candidates["tot_tags"]
+    subscribed = participation[:, candidates["columns"]]
+    if sparse.issparse(subscribed):
+        # As bool, 1 byte per user and candidate instead of the 8 of the participation
+        subscribed = subscribed.astype(bool).toarray()
+    block[subscribed.astype(bool, copy=False)] = -np.inf
+
+    k = min(n_events, n_candidates)
+    top = np.argpartition(block, n_candidates - k, axis=1)[:, n_candidates - k:]
+    #If other events have the same score of the k-th best one, take the first ones (as a stable sort does)
+    kth = np.take_along_axis(block, top, axis=1).min(axis=1, keepdims=True)
+    equal = block == kth
+    ties = np.flatnonzero(equal.sum(axis=1) > (np.take_along_axis(block, top, axis=1) == kth).sum(axis=1))
+    if len(ties):
+        needed = k - (block[ties] > kth[ties]).sum(axis=1, keepdims=True)
+        selected = (block[ties] > kth[ties]) | (equal[ties] & (np.cumsum(equal[ties], axis=1) <= needed))
+        top[ties] = np.nonzero(selected)[1].reshape(len(ties), k)
+    #sort by score, and by event among the events with the same score
+    top.sort(axis=1)
+    top_scores = np.take_along_axis(block, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    events = candidates["ids"]
+    return [{str(events[e]) : float(score) for e, score in zip(top[i], top_scores[i]) if score != -np.inf}
+            for i in range(len(block))]
+
+def make_predictions(df_real_users, df_real_events, model, n_events=3, max_block_bytes=64*1024**2):
     '''
     Function to make predictions using SVD model.
 
+    To recommend events to each user, only the future events with tags (events_candidates) to which the user
+    didn't put his/her participation are considered, and they are scored for a block of users at once
+    (recommend_events). The blocks of users are sized so that at most max_block_bytes are used for the scores of
+    a block.
+
     Input: 
     - df_real_users : pandas.DataFrame
         Dataframe with the user-item matrix obtained from the mongoDB database of the app.
     - df_real_events : pandas.DataFrame
         Dataframe with the events collection from the mongoDB database of the app.
-    - data : surprise.Dataset
-      This is the Dataset object used in the surprise library to train the models.
-    - n_factors: int
-      Parameter of the SVD model, obtained after GridSearch
+    - model : dict
+      Factors of the trained SVD model (see fit_SVD_factors).
+    - n_events : int
+      Number of events to recommend to each user.
+    - max_block_bytes : int
+      Maximum memory used for the scores of a block of users.
 
     Output:
     - scores : dict
-      A dictionary with the predictions from the recommendation model with k = n_factors.
+      A dictionary with the id of each user as key, and a dictionary {id_event : score} with his/her best
+      n_events as value, sorted by score.
     '''
-    #print("df_real_users", df_real_users[df_real_users["id_user"]=="648379cc4099083d461dff3d"])
-    trainset = data.build_full_trainset()
-    #This is how to build a testset for the predictions on the same dataset
-    testset = data.build_full_trainset()
-    testset = testset.build_testset()
-    model = SVD(n_factors)
-    model.fit(trainset)
-    predictions = model.test(testset)
-    #get the top n tags scores in descending order (n=9 by default as the number of tags used for training)
-    top_n_clusterTags = get_top_n(predictions)
-    # To recommend events to each user, we consider only future events, and events to which the user
-    # didn't put his/her participation
-    df_future_events = df_real_events[pd.to_datetime(df_real_events["time"])>datetime.datetime.now()]
-    df_users_futureEvents = df_real_users[df_real_users["id_event"].isin(df_future_events["id_event"].values)]
-    df_users_predictions = df_users_futureEvents[df_users_futureEvents["participation"]==0]
-    #We want to build a dictionary where the keys are user_id  and the values are dictionaries with keys the events_id and value
-    #the total score assigned to each event
-    scores = {str(user) : [] for user in df_real_users["id_user"].unique()}
-
-    #for each user and event in the final df
-    for _, row_user in df_users_predictions.iterrows():
-        user = row_user["id_user"]
-        event = row_user["id_event"]
-        #take only the event in the df_events_mongoDB dataframe
-        df_ev_filtered = df_real_events[df_real_events["id_event"]==event]
-        #for each original tag get the corresponding cluster_tag
-        tot_tags = 0
-        tot_score = 0
-        for tag in df_ev_filtered.columns[2:]:
-            #How many tags from this cluster_tags this event has?
-            tag_weight = df_ev_filtered[tag].values[0]
-            tot_tags += tag_weight
-            print("user", user)
-            print("tag", tag)
-            
-            #print(top_n_clusterTags[user])
-            #print( top_n_clusterTags[user][tag])
-            tag_score = top_n_clusterTags[user][tag]
-            tot_score += tag_weight*tag_score
-        if tot_tags!=0:
-            scores[str(user)].append((str(event), tot_score/tot_tags))
-    #sort the values
-    for user, score in scores.items():
-        score.sort(key = lambda x: x[1], reverse = True)
-        #top_n[uid] = user_ratings[:n]
-        scores[user] = dict(score[:3])
+    users = df_real_users["id_user"].unique()
+    events = df_real_events["id_event"].values
+    scores = {str(user) : {} for user in users}
+    if len(users) == 0 or len(events) == 0:
+        return scores
+
+    #scores of the real users for the cluster tags (in the order of cluster_tags), from the factors of the model
+    tags_scores = users_tags_scores(model, pd.Index(model["users"]).get_indexer([str(user) for user in users]))
+    candidates = events_candidates(df_real_events)
+    rows = pd.Index(users).get_indexer(df_real_users["id_user"])
+    cols = pd.Index(events).get_indexer(df_real_users["id_event"])
+    participating = df_real_users["participation"].values != 0
+    participation = sparse.csr_matrix((np.ones(participating.sum(), dtype=bool), (rows[participating], cols[participating])),
+                                      shape=(len(users), len(events)))
+
+    block_size = int(max(1, max_block_bytes // (8*max(1, len(candidates["columns"])))))
+    for start in range(0, len(users), block_size):
+        end = min(start + block_size, len(users))
+        block_scores = recommend_events(tags_scores[start:end], participation[start:end], candidates, n_events)
+        for user, user_scores in zip(users[start:end], block_scores):
+            scores[str(user)] = user_scores
     return scores
 
 
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from events_response import stream_json
+
+def response_etag(kind, data_fingerprint, model_version=None, valid_until=None):
+    '''
+    Key of a response of a bulk endpoint, used both as key of the ResponseCache and as ETag of the response: the
+    response only depends on the data of the collections (fingerprint of the DataSnapshot), on the version of
+    the model used (None for the users matching, which has no trained model) and on the time until which the
+    response is valid (the events recommendations only recommend future events, see candidates_valid_until).
+    '''
+    return hashlib.sha1(f"{kind}:{data_fingerprint}:{model_version}:{valid_until}".encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    '''
+    Cache of the responses of the bulk endpoints (the dictionary returned to the client), by key (see
+    response_etag), so that the same data is never computed twice.
+
+    The responses are kept in memory, the max_entries used most recently (LRU), for at most ttl_seconds. If
+    disk_dir is given they are also saved there as json files (written in a tmp file then renamed), which are
+    shared by all the processes using the same directory (for instance the gunicorn workers) and survive restarts:
+    a response not in memory is looked for on disk before computing it again.
+
+    Parameters:
+    - max_entries : int
+        Number of responses kept in memory.
+    - ttl_seconds : float
+        Seconds after which a response is no longer used. None to keep them until they are evicted.
+    - disk_dir : str
+        Directory of the responses on disk, None to keep them only in memory.
+    - max_disk_entries : int
+        Number of responses kept on disk (the oldest ones are deleted).
+    '''
+
+    def __init__(self, max_entries=8, ttl_seconds=3600, disk_dir=None, max_disk_entries=32):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {"memory" : 0, "disk" : 0, "miss" : 0}
+
+    def _expired(self, created_at):
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key):
+        '''
+        Return the response saved with key, or None if there is none (or it expired).
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    self.hits["memory"] += 1
+                    return entry[1]
+                del self._entries[key]
+        value = self._get_disk(key)
+        with self._lock:
+            self.hits["disk" if value is not None else "miss"] += 1
+        return value
+
+    def _get_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            created_at = os.stat(path).st_mtime
+            if self._expired(created_at):
+                return None
+            with open(path, encoding="utf-8") as file:
+                value = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        self._put_memory(key, value, created_at)
+        return value
+
+    def _put_memory(self, key, value, created_at):
+        with self._lock:
+            self._entries[key] = (created_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key, value):
+        '''
+        Save the response value (json serializable, it must not be modified afterwards) with key.
+        '''
+        self._put_memory(key, value, time.time())
+        if self.disk_dir is None:
+            return
+        os.makedirs(self.disk_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.writelines(stream_json(value, ensure_ascii=False))
+        os.replace(tmp_path, path)
+        self._prune_disk()
+
+    def _prune_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".json"):
+                try:
+                    files.append((os.stat(os.path.join(self.disk_dir, name)).st_mtime, name))
+                except FileNotFoundError:
+                    continue
+        files.sort(reverse=True)
+        for i, (mtime, name) in enumerate(files):
+            if i >= self.max_disk_entries or self._expired(mtime):
+                try:
+                    os.remove(os.path.join(self.disk_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        '''
+        Remove all the responses, in memory and on disk.
+        '''
+        with self._lock:
+            self._entries.clear()
+        if self.disk_dir is not None and os.path.isdir(self.disk_dir):
+            for name in os.listdir(self.disk_dir):
+                if name.endswith(".json"):
+                    os.remove(os.path.join(self.disk_dir, name))
@@ -0,0 +1,87 @@
+import os
+import json
+import threading
+
+from events_response import stream_json
+
+class ResultsStore:
+    '''
+    Store of the latest results computed by the bulk endpoints (/events_recommendations and /match_all_users),
+    so that the results of a single user can be served with a dictionary lookup instead of recomputing everything.
+
+    The results of each kind are kept in memory as a dictionary {user_id : results of the user}, and saved as a
+    json file in results_dir. The file is written in a temporary file and then renamed, so a reader never sees a
+    half written file. Before each lookup the modification time of the file is checked, so that the results
+    refreshed by another process (for instance another gunicorn worker) are loaded as well.
+
+    Parameters:
+    - results_dir : str
+        Directory where the json files with the results are saved.
+    '''
+
+    def __init__(self, results_dir="results"):
+        self.results_dir = results_dir
+        self._results = {}
+        self._mtimes = {}
+        self._lock = threading.Lock()
+
+    def _path(self, kind):
+        return os.path.join(self.results_dir, f"{kind}.json")
+
+    def _reload_if_changed(self, kind):
+        path = self._path(kind)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if self._mtimes.get(kind) == mtime:
+            return
+        with self._lock:
+            if self._mtimes.get(kind) == mtime:
+                return
+            with open(path, encoding="utf-8") as file:
+                self._results[kind] = json.load(file)
+            self._mtimes[kind] = mtime
+
+    def update(self, kind, results):
+        '''
+        Replace all the results of a kind with the new ones, in memory and on disk.
+
+        Input:
+        - kind : str
+            Name of the results, "events_recommendations" or "users_matching".
+        - results : dict
+            Dictionary with the id of each user as key and his/her results as value (json serializable).
+        '''
+        os.makedirs(self.results_dir, exist_ok=True)
+        path = self._path(kind)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            # One user at a time, the results may be built user by user (see EventsPredictions)
+            file.writelines(stream_json(results, ensure_ascii=False))
+        with self._lock:
+            os.replace(tmp_path, path)
+            self._results[kind] = results
+            self._mtimes[kind] = os.stat(path).st_mtime_ns
+
+    def preload(self, kinds=("events_recommendations", "users_matching")):
+        '''
+        Load the results of kinds saved on disk (if they changed since they were loaded), before the first lookup.
+        '''
+        for kind in kinds:
+            self._reload_if_changed(kind)
+
+    def get(self, kind, user_id):
+        '''
+        Return the results of a kind for a single user, or None if there are no results for that user.
+        '''
+        self._reload_if_changed(kind)
+        return self._results.get(kind, {}).get(str(user_id))
+
+
+    def results(self, kind):
+        '''
+        Return all the results of a kind, or None if they were never computed.
+        '''
+        self._reload_if_changed(kind)
+        return self._results.get(kind)
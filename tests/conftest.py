@@ -0,0 +1,21 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+# The modules of the API are at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def collections():
+    df_tags = pd.DataFrame({"_id" : ["t1", "t2", "t3", "t4", "t5"],
+                            "name" : ["Marketing", "Gaming", "Música", "Liderazgo", "Sin cluster"]})
+    df_events = pd.DataFrame({"_id" : ["e1", "e2", "e3", "e4"],
+                              "time" : ["2030-01-01", "2020-05-01", "2030-03-01", "2031-01-01"],
+                              # a repeated tag, a tag without cluster and an unknown tag
+                              "eventTags" : [["t1", "t2"], ["t3", "t3", "t5"], ["t4", "t9"], ["t2"]]})
+    df_users = pd.DataFrame({"_id" : ["u1", "u2", "u3"],
+                             # an unknown event, and a user without suscriptions
+                             "suscriptions" : [["e1", "e3"], ["e2", "e9"], []]})
+    return df_users, df_events, df_tags
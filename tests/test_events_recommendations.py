@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from data_preprocessing_utilities import create_training_df_recommendation_vectorized
+import events_streaming
+import recommending_events_model
+from recommending_events_model import users_tags_scores, make_predictions, train_SVD_model
+from global_variables import cluster_tags
+
+
+def factors(users, seed=0):
+    rng = np.random.default_rng(seed)
+    return {"users" : np.array(users), "items" : np.array(cluster_tags), "global_mean" : 1.5,
+            "rating_scale" : np.array([0, 4]), "bu" : rng.normal(size=len(users)),
+            "bi" : rng.normal(size=len(cluster_tags)), "pu" : rng.normal(size=(len(users), 3)),
+            "qi" : rng.normal(size=(len(cluster_tags), 3))}
+
+
+def test_unknown_users_get_the_global_scores():
+    model = factors(["u1", "u2"])
+    scores = users_tags_scores(model, np.array([1, -1, 0]))
+    # Not the factors of the last user of the model
+    assert scores[1] == pytest.approx(np.clip(model["global_mean"] + model["bi"], 0, 4))
+    assert scores[0] == pytest.approx(users_tags_scores(model, np.array([1]))[0])
+    assert scores[2] == pytest.approx(users_tags_scores(model, np.array([0]))[0])
+
+
+def test_predictions_of_users_unknown_to_the_model(collections):
+    df_users, df_events = create_training_df_recommendation_vectorized(*collections)
+    # u3 signed up after the training: the same scores of a user of the model without biases nor factors
+    model = factors(["u1", "u2"])
+    known = dict(model, users=np.array(["u1", "u2", "u3"]), bu=np.append(model["bu"], 0.0),
+                 pu=np.vstack((model["pu"], np.zeros(3))))
+    predictions = make_predictions(df_users, df_events, model)
+    assert predictions == make_predictions(df_users, df_events, known)
+    assert predictions["u3"]
+
+
+@pytest.mark.parametrize("batch_size, spill", [(2, False), (1, True)])
+def test_streaming_matches_frames(collections, tmp_path, monkeypatch, batch_size, spill):
+    # Same model for both paths, without u3 (as a model trained before u3 signed up, or pinned)
+    model = factors(["u1", "u2"])
+    fit = lambda *args, **kwargs: model
+    monkeypatch.setattr(recommending_events_model, "fit_events_model", fit)
+    monkeypatch.setattr(events_streaming, "fit_events_model", fit)
+    spill_dir = str(tmp_path / "spill") if spill else None
+    streamed = events_streaming.stream_events_recommendations(*collections, batch_size=batch_size,
+                                                              spill_dir=spill_dir)
+    assert streamed == train_SVD_model(*create_training_df_recommendation_vectorized(*collections))
+    if spill:
+        # The files of the batches are deleted at the end
+        assert list((tmp_path / "spill").iterdir()) == []
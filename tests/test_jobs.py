@@ -0,0 +1,45 @@
+import threading
+
+from jobs import JobManager
+
+
+def wait(manager, job_id):
+    manager._executor.submit(lambda: None).result()
+    return manager.get(job_id)
+
+
+def test_one_job_per_name_across_managers(tmp_path):
+    # Two managers on the same jobs_dir, as two gunicorn workers
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def task(**params):
+        calls.append(params)
+        started.set()
+        release.wait(5)
+
+    first = JobManager({"refresh" : task}, str(tmp_path))
+    second = JobManager({"refresh" : task}, str(tmp_path))
+    job_id = first.submit("refresh", update_AWS_DB=None)
+    started.wait(5)
+    assert second.submit("refresh", update_AWS_DB=None) == job_id
+    assert first.submit("refresh", update_AWS_DB=None) == job_id
+    release.set()
+    assert wait(first, job_id)["status"] == "finished"
+    assert len(calls) == 1
+
+    # Once finished, the next submit starts a new job
+    other_id = second.submit("refresh", update_AWS_DB="yes")
+    assert other_id != job_id
+    assert wait(second, other_id)["status"] == "finished"
+    assert calls[-1] == {"update_AWS_DB" : "yes"}
+
+
+def test_failed_job_releases_the_name(tmp_path):
+    def task():
+        raise ValueError("no data")
+
+    manager = JobManager({"refresh" : task}, str(tmp_path))
+    job = wait(manager, manager.submit("refresh"))
+    assert job["status"] == "failed" and "no data" in job["error"]
+    assert manager.submit("refresh") != job["id"]
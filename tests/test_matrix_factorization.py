@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+from surprise import SVD, Dataset, Reader
+
+from matrix_factorization import _solve_rows, fit_biased_ALS, predict_ratings
+from model_tuning import grid_search_ALS
+
+
+@pytest.fixture
+def ratings():
+    # Users x cluster tags with the shape of the real ones: a few tags much more popular than the others
+    rng = np.random.default_rng(0)
+    return np.clip(np.rint(rng.gamma(1.0, 1.5, (200, 1))*rng.random((1, 9))*3 + rng.normal(0, 0.5, (200, 9))), 0, 8)
+
+
+def test_ALS_generalizes_as_SVD(ratings):
+    test = np.random.default_rng(1).random(ratings.shape) < 0.2
+    users, items = np.nonzero(~test)
+    df = pd.DataFrame({"user" : users, "item" : items, "rating" : ratings[users, items]})
+    trainset = Dataset.load_from_df(df, Reader(rating_scale=(0, ratings.max()))).build_full_trainset()
+    svd = SVD(n_factors=2, random_state=42)
+    svd.fit(trainset)
+    svd_predictions = np.array([[svd.predict(u, i).est for i in range(ratings.shape[1])] for u in range(len(ratings))])
+    als_predictions = predict_ratings(fit_biased_ALS(ratings, 2, mask=~test, reg=5), (0, ratings.max()))
+    rmse = lambda predictions: np.sqrt(np.mean((predictions - ratings)[test]**2))
+    # Same model fitted with ALS instead of SGD: on the ratings not seen in the fit, at least as good as SVD
+    assert rmse(als_predictions) <= rmse(svd_predictions) + 0.05
+
+
+def test_dual_matches_primal():
+    rng = np.random.default_rng(2)
+    targets, designs = rng.normal(size=(7, 4)), rng.normal(size=(4, 6))
+    mask = (rng.random((7, 4)) < 0.7).astype(np.float64)
+    # 4 columns and 6 features: _solve_rows uses the dual form
+    dual = _solve_rows(targets, mask, designs, reg=3.0)
+    primal = np.stack([np.linalg.solve((designs*row_mask[:, None]).T @ designs + 3.0*np.eye(6),
+                                       (targets[r]*row_mask) @ designs) for r, row_mask in enumerate(mask)])
+    np.testing.assert_allclose(dual, primal, atol=1e-10)
+
+
+def test_grid_search_ALS_in_parallel(ratings):
+    params = dict(n_factors_grid=[1, 2, 3], reg_grid=(5, 20), cv=3, budget_seconds=None)
+    serial = grid_search_ALS(ratings, **params)
+    parallel = grid_search_ALS(ratings, n_jobs=2, **params)
+    assert parallel["best_params"] == serial["best_params"] and parallel["best_score"] == serial["best_score"]
+    assert parallel["n_fits"] == 18
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+import recommending_events_model
+from model_registry import ModelRegistry
+from global_variables import cluster_tags, SVD_model_name
+
+
+def users_tags(seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.integers(0, 4, size=(20, len(cluster_tags))), columns=cluster_tags,
+                        index=pd.Index([f"user{i}" for i in range(20)], name="id_user"))
+
+
+def fit(seed):
+    return recommending_events_model.fit_events_model(users_tags(seed), backend="numpy", n_factors_grid=[2],
+                                                      reg_grid=(20,), cv=2)
+
+
+def test_rollback_is_kept_by_the_next_training(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    registry = ModelRegistry(str(tmp_path / "registry"))
+    monkeypatch.setattr(recommending_events_model, "_model_registry", registry)
+    monkeypatch.setattr(recommending_events_model, "_svd_model", None)
+    monkeypatch.setitem(recommending_events_model.artificial_corpus, "n_users", 30)
+    assert fit(1)["version"] == 1
+    assert fit(2)["version"] == 2
+    assert recommending_events_model.rollback_SVD_model()["version"] == 1
+    assert registry.pinned(SVD_model_name)
+    # The pipeline runs again on new data: the model rolled back stays in use
+    assert fit(3)["version"] == 1
+    assert registry.current_version(SVD_model_name) == 1 and registry.versions(SVD_model_name) == [1, 2]
+    assert recommending_events_model.unpin_SVD_model() == 1
+    assert fit(3)["version"] == 3
+    assert not registry.pinned(SVD_model_name)
+
+
+def test_current_without_pin(tmp_path):
+    # CURRENT written before the pins, with only the version
+    registry = ModelRegistry(str(tmp_path))
+    registry.register("model", {"weights" : np.arange(3.0)})
+    (tmp_path / "model" / "CURRENT").write_text("1", encoding="utf-8")
+    assert registry.current_version("model") == 1 and not registry.pinned("model")
@@ -0,0 +1,29 @@
+from model_tuning import tune_SVD_model
+
+calls = []
+
+
+def search(data, **params):
+    calls.append(data)
+    return {"best_params" : {"n_factors" : 3}, "best_score" : {"rmse" : 1.0, "mae" : 0.5}, "search" : "stub",
+            "completed" : True}
+
+
+def test_search_is_reused(tmp_path):
+    cache_path = str(tmp_path / "models" / "tuning_cache.json")
+    calls.clear()
+    assert tune_SVD_model("data", "fingerprint", search=search, cache_path=cache_path)["cached"] is False
+    assert tune_SVD_model("data", "fingerprint", search=search, cache_path=cache_path)["cached"] is True
+    assert tune_SVD_model("data", "other", search=search, cache_path=cache_path)["cached"] is False
+    assert len(calls) == 2
+    # No tmp file is left next to the cache
+    assert [path.name for path in (tmp_path / "models").iterdir()] == ["tuning_cache.json"]
+
+
+def test_corrupt_cache_is_ignored(tmp_path):
+    cache_path = tmp_path / "tuning_cache.json"
+    # For instance cut by a process stopped while writing it
+    cache_path.write_text('{"successive_halving_SVD:abc": {"best_par', encoding="utf-8")
+    results = tune_SVD_model("data", "fingerprint", search=search, cache_path=str(cache_path))
+    assert results["cached"] is False and results["best_params"] == {"n_factors" : 3}
+    assert tune_SVD_model("data", "fingerprint", search=search, cache_path=str(cache_path))["cached"] is True
@@ -0,0 +1,159 @@
+import datetime
+
+import mongomock
+import pytest
+
+from mongo_sync import MongoSync, required
+
+collections = {
+    "users" : {"projection" : {"_id" : 1, "username" : 1}, "filter" : required(["_id", "username"]),
+               "watermark" : "updatedAt"},
+    "tags" : {"projection" : {"_id" : 1, "name" : 1}, "filter" : {}, "watermark" : None}
+}
+
+
+def at(minute):
+    return datetime.datetime(2030, 1, 1, 12, minute)
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().app_dt
+    db.users.insert_many([{"_id" : f"u{i}", "username" : f"user{i}", "updatedAt" : at(i)} for i in range(5)])
+    # Without the fields of the filter, never in the snapshot
+    db.users.insert_one({"_id" : "test", "updatedAt" : at(0)})
+    db.tags.insert_many([{"_id" : "t1", "name" : "Marketing"}, {"_id" : "t2", "name" : "Gaming"}])
+    return db
+
+
+def snapshot(sync):
+    return {name : sync.dataframe(name).set_index("_id").sort_index() for name in sync.collections}
+
+
+def assert_same_snapshot(sync, other):
+    assert sync.watermarks == other.watermarks
+    for name, df in snapshot(sync).items():
+        assert df.equals(snapshot(other)[name])
+
+
+def test_refresh_pulls_only_changes(db, tmp_path):
+    sync = MongoSync(str(tmp_path / "snapshot.pkl"), collections)
+    assert sync.refresh(db) == {"users" : 5, "tags" : 2}
+    assert sync.refresh(db) == {"users" : 0, "tags" : 0}
+    assert sync.version == 1
+
+    db.users.update_one({"_id" : "u1"}, {"$set" : {"username" : "renamed", "updatedAt" : at(10)}})
+    db.users.delete_one({"_id" : "u2"})
+    db.users.insert_one({"_id" : "u5", "username" : "user5", "updatedAt" : at(11)})
+    assert sync.refresh(db, check_deletions=True) == {"users" : 3, "tags" : 0}
+    users = snapshot(sync)["users"]
+    assert list(users.index) == ["u0", "u1", "u3", "u4", "u5"]
+    assert users.loc["u1", "username"] == "renamed"
+    assert "updatedAt" not in users.columns
+    assert sync.watermarks["users"] == at(11)
+
+
+def test_deletions_are_only_checked_on_demand(db, tmp_path):
+    sync = MongoSync(str(tmp_path / "snapshot.pkl"), collections)
+    sync.refresh(db)
+    db.users.delete_one({"_id" : "u2"})
+    # Without check_deletions only the documents changed since the watermark are read
+    assert sync.refresh(db) == {"users" : 0, "tags" : 0}
+    assert "u2" in sync.documents["users"]
+    assert sync.refresh(db, check_deletions=True) == {"users" : 1, "tags" : 0}
+    assert "u2" not in sync.documents["users"]
+
+
+def test_changes_are_appended_to_the_log(db, tmp_path):
+    path = tmp_path / "snapshot.pkl"
+    sync = MongoSync(str(path), collections)
+    sync.refresh(db)
+    # The first save writes the whole snapshot, the next ones only append the changes
+    assert path.exists() and (tmp_path / "snapshot.pkl.log").stat().st_size == 0
+    snapshot_size = path.stat().st_size
+
+    db.users.update_one({"_id" : "u1"}, {"$set" : {"username" : "renamed", "updatedAt" : at(10)}})
+    db.users.delete_one({"_id" : "u3"})
+    sync.refresh(db, check_deletions=True)
+    db.tags.insert_one({"_id" : "t3", "name" : "Música"})
+    sync.refresh(db)
+    assert path.stat().st_size == snapshot_size
+    assert 0 < (tmp_path / "snapshot.pkl.log").stat().st_size
+    assert_same_snapshot(MongoSync(str(path), collections), sync)
+
+
+def test_log_is_compacted(db, tmp_path):
+    path = tmp_path / "snapshot.pkl"
+    sync = MongoSync(str(path), collections)
+    sync.refresh(db)
+    for i in range(20):
+        db.users.update_one({"_id" : "u1"}, {"$set" : {"username" : f"renamed{i}", "updatedAt" : at(10 + i)}})
+        sync.refresh(db)
+        # Never much bigger than the snapshot: once it is bigger, the next save compacts it
+        assert (tmp_path / "snapshot.pkl.log").stat().st_size <= 2 * path.stat().st_size
+    assert_same_snapshot(MongoSync(str(path), collections), sync)
+
+
+def test_half_written_change_is_ignored(db, tmp_path):
+    path = tmp_path / "snapshot.pkl"
+    sync = MongoSync(str(path), collections)
+    sync.refresh(db)
+    db.users.update_one({"_id" : "u1"}, {"$set" : {"username" : "renamed", "updatedAt" : at(10)}})
+    sync.refresh(db)
+    with open(tmp_path / "snapshot.pkl.log", "ab") as log:
+        log.write(b"\x80\x04\x95")
+
+    loaded = MongoSync(str(path), collections)
+    assert_same_snapshot(loaded, sync)
+    # The next change compacts the log, since nothing can be appended after the half written one
+    db.tags.insert_one({"_id" : "t3", "name" : "Música"})
+    loaded.refresh(db)
+    assert (tmp_path / "snapshot.pkl.log").stat().st_size == 0
+    assert_same_snapshot(MongoSync(str(path), collections), loaded)
+
+
+def test_collections_saved_with_another_spec_are_read_again(db, tmp_path):
+    path = str(tmp_path / "snapshot.pkl")
+    MongoSync(path, collections).refresh(db)
+    other = dict(collections, tags=dict(collections["tags"], projection={"_id" : 1}))
+    sync = MongoSync(path, other)
+    assert len(sync.documents["users"]) == 5 and sync.documents["tags"] == {}
+    assert sync.refresh(db) == {"users" : 0, "tags" : 2}
+
+
+def test_threads_are_reused_between_refreshes(db, tmp_path):
+    sync = MongoSync(str(tmp_path / "snapshot.pkl"), collections)
+    sync.refresh(db)
+    pool = sync._pool()
+    sync.refresh(db, check_deletions=True)
+    assert sync._pool() is pool
+
+
+def test_other_processes_read_the_changes_from_the_files(db, tmp_path):
+    # Two instances on the same files, as two gunicorn workers
+    path = str(tmp_path / "snapshot.pkl")
+    worker = MongoSync(path, collections)
+    worker.refresh(db)
+    other = MongoSync(path, collections)
+    assert_same_snapshot(other, worker)
+    assert not other.reload_if_changed()
+
+    db.users.update_one({"_id" : "u1"}, {"$set" : {"username" : "renamed", "updatedAt" : at(10)}})
+    worker.refresh(db)
+    version = other.version
+    assert other.reload_if_changed() and other.version == version + 1
+    assert_same_snapshot(other, worker)
+
+    # A compaction is read whole
+    db.tags.insert_one({"_id" : "t3", "name" : "Música"})
+    worker.refresh(db)
+    worker.save()
+    assert other.reload_if_changed()
+    assert_same_snapshot(other, worker)
+
+    # A refresh starts from the changes saved by the others: only what is newer is pulled
+    db.users.insert_one({"_id" : "u5", "username" : "user5", "updatedAt" : at(11)})
+    worker.refresh(db)
+    assert other.refresh(db) == {"users" : 0, "tags" : 0}
+    assert_same_snapshot(other, worker)
+    assert other.synced_at() is not None
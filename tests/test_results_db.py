@@ -0,0 +1,98 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select, func, inspect
+
+from results_db import ResultsDB, results_rows, recommendation_results, _copy_insert
+
+
+@pytest.fixture
+def results_db(tmp_path):
+    results_db = ResultsDB(f"sqlite:///{tmp_path / 'results.db'}", keep_runs=2)
+    yield results_db
+    results_db.close()
+
+
+def test_write_run_and_latest(results_db):
+    first = results_db.write_run("users_matching", results_rows({"u1" : ["u2", "u3"], "u2" : ["u1"]},
+                                                                {"u1" : [0.9, 0.5], "u2" : [0.7]}))
+    second = results_db.write_run("users_matching", results_rows({"u1" : ["u3"]}, {"u1" : [0.8]}))
+    results_db.write_run("events_recommendations", results_rows({"u1" : {"e1" : 4.5, "e2" : 3.0}}))
+    assert second > first
+    # Only the latest run of the kind: u2 is not in it
+    assert results_db.latest("users_matching", "u1") == [{"rank" : 1, "target_id" : "u3", "score" : 0.8}]
+    assert results_db.latest("users_matching", "u2") == []
+    assert results_db.latest("events_recommendations", "u1") == [{"rank" : 1, "target_id" : "e1", "score" : 4.5},
+                                                                  {"rank" : 2, "target_id" : "e2", "score" : 3.0}]
+    assert results_db.write_run_async("users_matching", results_rows({"u2" : ["u1"]}, {"u2" : [0.6]})).result() > second
+    assert results_db.latest("users_matching", "u2") == [{"rank" : 1, "target_id" : "u1", "score" : 0.6}]
+
+
+def test_compact(results_db):
+    runs = [results_db.write_run("users_matching", results_rows({"u1" : [f"u{i}"]}, {"u1" : [0.5]}),
+                                 created_at=datetime.datetime(2024, 1, i)) for i in range(2, 6)]
+    results_db.write_run("events_recommendations", results_rows({"u1" : {"e1" : 4.0}}))
+    # write_run already keeps only the last keep_runs of each kind
+    assert results_db.compact("users_matching") == 0
+    assert results_db.compact("users_matching", keep_runs=1) == 1
+    with results_db.engine.connect() as conn:
+        kept = conn.execute(select(recommendation_results.c.run_id).where(recommendation_results.c.user_id == "u1")
+                            .distinct().order_by(recommendation_results.c.run_id)).scalars().all()
+        assert conn.execute(select(func.count()).select_from(recommendation_results)).scalar() == 2
+    # The last run of users_matching, and the run of the other kind
+    assert kept[0] == runs[-1] and len(kept) == 2
+    assert results_db.latest("users_matching", "u1")[0]["target_id"] == "u5"
+
+
+class StubCursor:
+    def __init__(self, copies):
+        self.copies = copies
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy_expert(self, sql, buffer):
+        self.copies.append((sql, buffer.read()))
+
+
+def test_copy_insert_payload():
+    copies = []
+    conn = SimpleNamespace(connection=SimpleNamespace(cursor=lambda: StubCursor(copies)))
+    table = SimpleNamespace(schema="public", name="recommendation_results")
+    _copy_insert(table, conn, ["user_id", "rank", "target_id", "score", "run_id"],
+                 iter([("u1", 1, "e1", 4.5, 7), ("u1", 2, 'e,"2"', None, 7)]))
+    assert copies == [('COPY "public"."recommendation_results" ("user_id", "rank", "target_id", "score", "run_id") '
+                       'FROM STDIN WITH (FORMAT csv)',
+                       # The missing score is an empty field, NULL for COPY csv
+                       'u1,1,e1,4.5,7\r\nu1,2,"e,""2""",,7\r\n')]
+
+
+def test_recommended_to_uses_the_target_index(results_db):
+    results_db.write_run("users_matching", results_rows({"u1" : ["u3"], "u2" : ["u1", "u3"]}, {"u1" : [0.9], "u2" : [0.8, 0.4]}))
+    results_db.write_run("users_matching", results_rows({"u1" : ["u2", "u3"], "u2" : ["u3"]}, {"u1" : [0.9, 0.3], "u2" : [0.7]}))
+    assert results_db.recommended_to("users_matching", "u3") == [{"user_id" : "u1", "rank" : 2, "score" : 0.3},
+                                                                 {"user_id" : "u2", "rank" : 1, "score" : 0.7}]
+    assert results_db.recommended_to("users_matching", "u1") == []
+    with results_db.engine.connect() as conn:
+        plan = " ".join(str(row) for row in conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT user_id FROM recommendation_results WHERE target_id = 'u3' AND run_id = 2"))
+    assert "ix_recommendation_results_target_run" in plan
+
+
+def test_index_added_to_an_existing_schema(tmp_path):
+    url = f"sqlite:///{tmp_path / 'results.db'}"
+    old = ResultsDB(url)
+    # Tables created before the index on target_id
+    index = next(index for index in recommendation_results.indexes if index.name == "ix_recommendation_results_target_run")
+    old.create_schema()
+    index.drop(old.engine)
+    old.close()
+    results_db = ResultsDB(url)
+    results_db.create_schema()
+    assert "ix_recommendation_results_target_run" in {index["name"] for index in
+                                                     inspect(results_db.engine).get_indexes("recommendation_results")}
+    results_db.close()
@@ -0,0 +1,33 @@
+import pandas as pd
+
+from data_preprocessing_utilities import create_training_df_recommendation, create_training_df_recommendation_vectorized
+
+
+def test_vectorized_matches_loop(collections):
+    users_loop, events_loop = create_training_df_recommendation(*collections)
+    users_vec, events_vec = create_training_df_recommendation_vectorized(*collections)
+    # The loop builds float columns, the vectorized version integer ones: only the values are compared
+    pd.testing.assert_frame_equal(users_vec, users_loop, check_dtype=False)
+    pd.testing.assert_frame_equal(events_vec, events_loop, check_dtype=False)
+
+
+def test_parallel_matches_loop(collections, monkeypatch):
+    import parallel_frames
+    monkeypatch.setattr(parallel_frames, "min_parallel_users", 0)
+    users_loop, _ = create_training_df_recommendation(*collections)
+    users_par, _ = create_training_df_recommendation_vectorized(*collections, n_jobs=2, chunk_size=1)
+    pd.testing.assert_frame_equal(users_par, users_loop, check_dtype=False)
+
+
+def test_event_without_tags(collections):
+    # The loop only sets the participation inside the loop over the tags of the event, so for an event without
+    # tags it keeps the value of the previous event: the vectorized version takes it from the suscriptions
+    df_users, df_events, df_tags = collections
+    df_events = df_events.assign(eventTags=[["t1", "t2"], ["t3"], ["t4"], []])
+    df_users = df_users.assign(suscriptions=[["e3"], ["e4"], []])
+    users_vec, events_vec = create_training_df_recommendation_vectorized(df_users, df_events, df_tags)
+    participation = users_vec.set_index(["id_user", "id_event"])["participation"]
+    assert participation[("u1", "e4")] == 0
+    assert participation[("u2", "e4")] == 1
+    assert (events_vec.set_index("id_event").loc["e4"].iloc[1:] == 0).all()
+    assert (users_vec[users_vec["id_user"] == "u2"].iloc[:, 3:] == 0).all().all()
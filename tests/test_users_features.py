@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import parallel_frames
+from data_preprocessing_utilities import create_training_df_userMatching
+from users_features import UsersFeatureEncoder
+from matching_users_model import match_users
+from global_variables import gender_codes
+
+
+@pytest.fixture
+def catalogs():
+    # Catalogs large enough for the one-hot block to be sparse (see match_users)
+    df_degrees = pd.DataFrame({"_id" : [f"d{i}" for i in range(10)], "name" : [f"Grado {i}" for i in range(10)]})
+    # Two hobbies with the same name share the column
+    df_hobbies = pd.DataFrame({"_id" : [f"h{i}" for i in range(60)], "name" : [f"Hobby {i}" for i in range(59)] + ["Hobby 0"]})
+    df_skills = pd.DataFrame({"_id" : [f"s{i}" for i in range(60)], "name" : [f"Skill {i}" for i in range(60)]})
+    rng = np.random.default_rng(0)
+    n_users = 25
+    df_users = pd.DataFrame({
+        "_id" : [f"u{i}" for i in range(n_users)],
+        "age" : rng.integers(18, 65, n_users),
+        "gender" : rng.choice(list(gender_codes), n_users),
+        "degree" : rng.choice(df_degrees["_id"], n_users),
+        "hobbies" : [list(rng.choice(["h0", "h1", "h2", "h59"], rng.integers(0, 3), replace=False)) for _ in range(n_users)],
+        # Every user has s0: a constant column, which MinMaxScaler sets to 0
+        "skills" : [["s0"] + list(rng.choice(df_skills["_id"][1:], rng.integers(0, 3), replace=False)) for _ in range(n_users)],
+        "following" : [[f"u{j}" for j in rng.choice(n_users, 2, replace=False)] for _ in range(n_users)]})
+    return df_users, df_hobbies, df_skills, df_degrees
+
+
+def loop_dataset(catalogs):
+    dataset = create_training_df_userMatching(*catalogs)
+    dataset["sexo"] = dataset["sexo"].map(gender_codes)
+    dataset["id_user"] = dataset["id_user"].astype(str)
+    return dataset
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_features_match_the_dataframe(catalogs, monkeypatch, n_jobs):
+    monkeypatch.setattr(parallel_frames, "min_parallel_users", 0)
+    df_users, df_hobbies, df_skills, df_degrees = catalogs
+    features = UsersFeatureEncoder.from_catalogs(df_degrees, df_hobbies, df_skills).transform(df_users, n_jobs=n_jobs,
+                                                                                              chunk_size=4)
+    dataset = loop_dataset(catalogs)
+    assert features.ids == dataset["id_user"].tolist()
+    assert features.columns == dataset.drop(["id_user", "following"], axis=1).columns.tolist()
+    np.testing.assert_array_equal(np.hstack((features.dense, features.onehot.toarray())),
+                                  dataset[features.columns].to_numpy(dtype=float))
+
+
+def test_scores_match_the_dataframe(catalogs):
+    df_users, df_hobbies, df_skills, df_degrees = catalogs
+    features = UsersFeatureEncoder.from_catalogs(df_degrees, df_hobbies, df_skills).transform(df_users)
+    matches, scores = match_users(features, return_scores=True)
+    dataset_matches, dataset_scores = match_users(loop_dataset(catalogs), return_scores=True)
+    # With the ties broken by the order of the users, the same matches
+    assert matches == dataset_matches
+    for user in matches:
+        np.testing.assert_allclose(scores[user], dataset_scores[user], rtol=0, atol=1e-7)
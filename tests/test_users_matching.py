@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import MinMaxScaler
+from sklearn.metrics.pairwise import cosine_similarity
+
+from matching_users_model import match_users
+
+
+@pytest.fixture
+def dataset():
+    rng = np.random.default_rng(0)
+    n_users = 30
+    dataset = pd.DataFrame({"id_user" : [f"u{i}" for i in range(n_users)],
+                            "edad" : rng.integers(18, 60, n_users), "sexo" : rng.integers(0, 2, n_users),
+                            "following" : [[f"u{j}" for j in rng.choice(n_users, 3, replace=False)]
+                                           for _ in range(n_users)]})
+    for name in ["Ingeniería", "Derecho", "Gaming", "Música", "Python", "Liderazgo"]:
+        dataset[name] = rng.integers(0, 2, n_users)
+    # Repeated users: exact ties between the users similar to them
+    repeated = dataset.iloc[[0, 0, 0, 1, 1, 2]].assign(id_user=[f"u{i}" for i in range(n_users, n_users + 6)])
+    repeated["following"] = [[] for _ in range(len(repeated))]
+    return pd.concat((dataset, repeated), ignore_index=True)
+
+
+def match_users_loop(dataset, n_matches=4):
+    # Per-user loop of /match_all_users before match_users, excluding the user itself explicitly (instead of
+    # dropping the first row) and with a stable sort, so that the ties keep the order of the dataset
+    features = MinMaxScaler().fit_transform(dataset.drop(["id_user", "following"], axis=1).astype(float))
+    users = dataset["id_user"].values
+    users_afinidad = {}
+    for i, user in enumerate(users):
+        following = [str(x) for x in dataset["following"].iloc[i]]
+        similitudes_df = pd.DataFrame({"Usuario" : users, "Similitud" : cosine_similarity(features[[i]], features).ravel()})
+        similitudes_df = similitudes_df[~similitudes_df["Usuario"].isin(following + [user])]
+        users_afinidad[user] = similitudes_df.sort_values(by="Similitud", ascending=False, kind="stable")\
+            .iloc[:n_matches]["Usuario"].tolist()
+    return users_afinidad
+
+
+# One block, and blocks of 7 of the 36 users
+@pytest.mark.parametrize("max_block_bytes", [64*1024**2, 4*36*7])
+def test_match_users_matches_loop(dataset, max_block_bytes):
+    assert match_users(dataset, n_matches=4, max_block_bytes=max_block_bytes) == match_users_loop(dataset)
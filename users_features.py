@@ -0,0 +1,170 @@
+import threading
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import parallel_frames
+from global_variables import gender_codes
+
+class UsersFeatures:
+    '''
+    Features of the users for the users matching, as built by UsersFeatureEncoder: a dense numeric block with age
+    and gender, and a sparse one-hot block with degree, hobbies and skills. The memory of the one-hot block is
+    proportional to the number of degrees, hobbies and skills of the users, not to the size of the catalogs.
+
+    Parameters:
+    - ids : list
+        Ids (str) of the users, in the order of the rows.
+    - following : list
+        For each user, the list with the ids of the users he/she is already following.
+    - columns : list
+        Names of the features: the dense columns ("edad", "sexo") and then the one-hot columns.
+    - dense : numpy.ndarray
+        Matrix users x 2 (float64) with age and gender (NaN if missing).
+    - onehot : scipy.sparse.csr_matrix
+        Matrix users x (degrees + hobbies + skills) with 1 where the user has the degree, hobby or skill.
+    '''
+
+    def __init__(self, ids, following, columns, dense, onehot):
+        self.ids = ids
+        self.following = following
+        self.columns = columns
+        self.dense = dense
+        self.onehot = onehot
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def n_dense(self):
+        return self.dense.shape[1]
+
+    def min_max(self):
+        '''
+        Min and range of each feature (in the order of columns), with the range of the constant features set to
+        1, as MinMaxScaler does.
+        '''
+        n_users = len(self)
+        dense_min = np.nan_to_num(np.nanmin(self.dense, axis=0)) if n_users else np.zeros(self.n_dense)
+        dense_max = np.nan_to_num(np.nanmax(self.dense, axis=0)) if n_users else np.zeros(self.n_dense)
+        # One-hot columns: the min is 1 only if all the users have it, the max is 1 if any user has it
+        counts = np.bincount(self.onehot.indices, minlength=self.onehot.shape[1])
+        onehot_min = (counts == n_users).astype(float)
+        onehot_max = (counts > 0).astype(float)
+        data_min = np.concatenate((dense_min, onehot_min))
+        data_range = np.concatenate((dense_max, onehot_max)) - data_min
+        data_range[data_range==0] = 1
+        return data_min, data_range
+
+    def scaled(self):
+        '''
+        Scale the features between 0 and 1 (same result of MinMaxScaler on the dense matrix, with the missing
+        values as 0), keeping the one-hot block sparse.
+
+        Output:
+        - dense : numpy.ndarray
+            Scaled dense block.
+        - onehot : scipy.sparse.csr_matrix
+            Scaled one-hot block (float32): the columns that all the users have become 0, as in MinMaxScaler.
+        '''
+        data_min, data_range = self.min_max()
+        dense = np.nan_to_num((self.dense - data_min[:self.n_dense]) / data_range[:self.n_dense])
+        keep = (data_min[self.n_dense:] == 0).astype(np.float32)
+        onehot = (self.onehot.astype(np.float32) @ sparse.diags(keep)).tocsr()
+        onehot.eliminate_zeros()
+        return dense, onehot
+
+class UsersFeatureEncoder:
+    '''
+    Encoder of the users for the users matching, replacing the one-hot columns of create_training_df_userMatching
+    with a sparse matrix. The vocabularies (column of each degree, hobby and skill) are built once from the
+    catalogs, and then each user is encoded with dictionary lookups. The columns are the same of
+    create_training_df_userMatching: the unique names of the degrees, then of the hobbies, then of the skills.
+
+    Parameters:
+    - columns : list
+        Names of the one-hot columns.
+    - degrees, hobbies, skills : dict
+        Dictionaries with the id (str) of each degree, hobby and skill as key and its column as value.
+    '''
+
+    def __init__(self, columns, degrees, hobbies, skills):
+        self.columns = columns
+        self.degrees = degrees
+        self.hobbies = hobbies
+        self.skills = skills
+
+    @classmethod
+    def from_catalogs(cls, df_degrees, df_hobbies, df_skills):
+        '''
+        Build the vocabularies from the dataframes of degrees, hobbies and skills (columns _id and name).
+        '''
+        columns, vocabularies = [], []
+        for df in (df_degrees, df_hobbies, df_skills):
+            names = list(df["name"].unique())
+            name_index = {name : len(columns) + i for i, name in enumerate(names)}
+            vocabularies.append({str(id_) : name_index[name] for id_, name in zip(df["_id"], df["name"])})
+            columns += names
+        return cls(columns, *vocabularies)
+
+    def encode_onehot(self, degrees, hobbies, skills):
+        '''
+        One-hot block of the users, from the lists with the degree, the hobbies and the skills of each user. The
+        ids which are not in the catalogs are ignored.
+
+        Output:
+        - onehot : scipy.sparse.csr_matrix
+            Matrix users x columns (int8).
+        '''
+        indptr, indices = [0], []
+        for degree, user_hobbies, user_skills in zip(degrees, hobbies, skills):
+            columns = set()
+            if str(degree) in self.degrees:
+                columns.add(self.degrees[str(degree)])
+            columns.update(self.hobbies[str(x)] for x in user_hobbies if str(x) in self.hobbies)
+            columns.update(self.skills[str(x)] for x in user_skills if str(x) in self.skills)
+            indices += sorted(columns)
+            indptr.append(len(indices))
+        return sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr),
+                                 shape=(len(indptr) - 1, len(self.columns)))
+
+    def transform(self, df_users, n_jobs=1, chunk_size=None):
+        '''
+        Encode the users. The ids of degrees, hobbies and skills which are not in the catalogs are ignored.
+
+        Input:
+        - df_users : pandas.DataFrame
+            Dataframe of the users, with the columns _id, age, gender, degree, hobbies, skills and following.
+        - n_jobs : int
+            Number of processes encoding chunks of chunk_size users (see parallel_frames.encode_onehot_parallel),
+            -1 for one per CPU. With 1, or less users than parallel_frames.min_parallel_users, everything is
+            encoded in this process.
+        - chunk_size : int
+            Number of users of each chunk, by default 4 chunks per process.
+
+        Output:
+        - features : UsersFeatures
+        '''
+        if n_jobs != 1 and len(df_users) >= parallel_frames.min_parallel_users:
+            onehot = parallel_frames.encode_onehot_parallel(self, df_users, n_jobs, chunk_size)
+        else:
+            onehot = self.encode_onehot(df_users["degree"], df_users["hobbies"], df_users["skills"])
+        dense = np.column_stack((pd.to_numeric(df_users["age"], errors="coerce").to_numpy(dtype=float),
+                                 df_users["gender"].astype(object).map(gender_codes).to_numpy(dtype=float)))
+        return UsersFeatures(df_users["_id"].astype(str).tolist(), list(df_users["following"]),
+                             ["edad", "sexo"] + self.columns, dense, onehot)
+
+_users_feature_encoder = None
+_users_feature_encoder_lock = threading.Lock()
+
+def get_users_feature_encoder(snapshot):
+    '''
+    Return the UsersFeatureEncoder of the catalogs of a DataSnapshot, built only the first time it is asked for
+    each version of the snapshot and then reused by all the requests.
+    '''
+    global _users_feature_encoder
+    with _users_feature_encoder_lock:
+        if _users_feature_encoder is None or _users_feature_encoder[0] != snapshot.version:
+            _users_feature_encoder = (snapshot.version,
+                                      UsersFeatureEncoder.from_catalogs(snapshot.degrees, snapshot.hobbies, snapshot.skills))
+        return _users_feature_encoder[1]
@@ -0,0 +1,89 @@
+import threading
+
+class UsersProfiles:
+    '''
+    Profiles of the users shown in the response of the users matching (username, name of the degree and name of
+    the userType), indexed by the id of the user. They are built once per snapshot of the database, so the
+    response is a dictionary lookup per recommended user instead of scans of the dataframes.
+
+    Parameters:
+    - profiles : dict
+        Dictionary with the id of each user (str) as key and the tuple (username, degree, userType) as value.
+    '''
+
+    columns = ["_id", "username", "degree", "userType"]
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+
+    @classmethod
+    def from_tables(cls, df_users, df_degrees, df_userTypes):
+        '''
+        Build the profiles from the dataframes of users, degrees and usertypes. Degrees or userTypes which are
+        not in their catalog get the name None.
+        '''
+        degrees = dict(zip(df_degrees["_id"].astype(str), df_degrees["name"]))
+        userTypes = dict(zip(df_userTypes["_id"].astype(str), df_userTypes["name"]))
+        profiles = {}
+        for user_id, username, degree, userType in zip(df_users["_id"].astype(str), df_users["username"],
+                                                       df_users["degree"].astype(str), df_users["userType"].astype(str)):
+            # As in the scans of before, the first user with an id wins
+            if user_id not in profiles:
+                profiles[user_id] = (username, degrees.get(degree), userTypes.get(userType))
+        return cls(profiles)
+
+    def matches(self, recommended_ids):
+        '''
+        Information of the recommended users of a single user, in the format wanted by FullStack.
+
+        Input:
+        - recommended_ids : list
+            Ids of the recommended users.
+
+        Output:
+        - matches : dict
+            Dictionary with the keys _id, username, degree and userType, each one with a list with the value of
+            every recommended user.
+        '''
+        matches = {key : [] for key in self.columns}
+        for rec_id in recommended_ids:
+            username, degree, userType = self.profiles[str(rec_id)]
+            matches["_id"].append(str(rec_id))
+            matches["username"].append(username)
+            matches["degree"].append(degree)
+            matches["userType"].append(userType)
+        return matches
+
+    def all_matches(self, users_afinidad, users=None):
+        '''
+        Response of /match_all_users: the information of the recommended users of every user.
+
+        Input:
+        - users_afinidad : dict
+            Output of match_users, {user_id : list of ids of the recommended users}.
+        - users : iterable
+            Ids of the users in the response. The ones which are not in users_afinidad get empty lists. By default
+            the users of users_afinidad.
+
+        Output:
+        - preds : dict
+            Dictionary with the id of each user as key, and the information of his/her recommended users as value.
+        '''
+        if users is None:
+            users = users_afinidad.keys()
+        return {str(user) : self.matches(users_afinidad.get(str(user), [])) for user in users}
+
+_users_profiles = None
+_users_profiles_lock = threading.Lock()
+
+def get_users_profiles(snapshot):
+    '''
+    Return the UsersProfiles of a DataSnapshot, built only the first time they are asked for each version of
+    the snapshot and then reused by all the requests.
+    '''
+    global _users_profiles
+    with _users_profiles_lock:
+        if _users_profiles is None or _users_profiles[0] != snapshot.version:
+            _users_profiles = (snapshot.version,
+                               UsersProfiles.from_tables(snapshot.users, snapshot.degrees, snapshot.usertypes))
+        return _users_profiles[1]